@@ -1,12 +1,23 @@
 # Import necessary modules
 import os
+import time
 from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, relationship
-from sqlalchemy import Float, Integer, String, ForeignKey, or_
+from sqlalchemy import Float, Integer, String, ForeignKey, func, insert, select, update
 from sqlalchemy.orm import Mapped, mapped_column
-from datetime import datetime
 from flask_socketio import SocketIO
+from metrics import instrument_flask, instrument_engine, registry
+from event_log import AsyncLog
+import search_index
+from pagination import parse_page_args, fetch_page
+import storage
+import change_log
+import bulk_load
+import stock_escrow
+import conditional
+import cart
+import threading
 
 # Define a base class for SQLAlchemy models
 class Base(DeclarativeBase):
@@ -15,6 +26,7 @@ class Base(DeclarativeBase):
 # Initialize the Flask application and SocketIO
 app = Flask(__name__)
 socketio = SocketIO(app)
+instrument_flask(app)
 
 # Configure SQLAlchemy with SQLite
 app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(os.getcwd(), 'project.db')
@@ -23,26 +35,72 @@ db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 
 # Define SQLAlchemy models for Catalog and Book
+# version is bumped by a trigger on every update and, with updated_at,
+# validates conditional GETs (ETag / Last-Modified)
 class Catalog(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String)
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default='1')
+    updated_at: Mapped[float] = mapped_column(Float, default=time.time, nullable=True)
 
 class Book(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    name: Mapped[str] = mapped_column(String)
+    name: Mapped[str] = mapped_column(String, index=True)
     count: Mapped[int] = mapped_column(Integer, default=1)
     price: Mapped[float] = mapped_column(Float, default=0)
-    catalog_id: Mapped[int] = mapped_column(ForeignKey(Catalog.id))
+    catalog_id: Mapped[int] = mapped_column(ForeignKey(Catalog.id), index=True)
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default='1')
+    updated_at: Mapped[float] = mapped_column(Float, default=time.time, nullable=True)
     catalog: Mapped[Catalog] = relationship(Catalog)
 
+# Stock escrowed to a remote catalog node. Its share of the book is
+# granted_total - sold_total - released_total; the rest of Book.count is
+# the primary's own share.
+class StockEscrow(db.Model):
+    __tablename__ = 'stock_escrow'
+    book_id: Mapped[int] = mapped_column(ForeignKey(Book.id), primary_key=True)
+    node: Mapped[str] = mapped_column(String, primary_key=True)
+    granted_total: Mapped[int] = mapped_column(Integer, default=0)
+    sold_total: Mapped[int] = mapped_column(Integer, default=0)
+    released_total: Mapped[int] = mapped_column(Integer, default=0)
+    target: Mapped[int] = mapped_column(Integer, default=0)
+
+    @property
+    def share(self):
+        return self.granted_total - self.sold_total - self.released_total
+
 # Create database tables
 with app.app_context():
+    # WAL, busy timeout and cache settings on every connection
+    storage.configure_sqlite(db.engine)
     db.create_all()
+    instrument_engine(db.engine)
+    with db.engine.begin() as conn:
+        storage.ensure_columns(conn, Catalog, Book)
+        storage.ensure_indexes(conn, Book)
+        for model in (Catalog, Book):
+            change_log.ensure_row_versions(conn, model.__tablename__)
+    # Full-text index over Book.name, maintained by triggers on the book table
+    with db.engine.begin() as conn:
+        fts_enabled = search_index.ensure_search_index(conn, Book.__tablename__)
+    # Sequenced log of every catalog and book write, served on /changes
+    with db.engine.begin() as conn:
+        change_log.ensure_change_log(conn, {
+            model.__tablename__: tuple(column.name for column in model.__table__.columns)
+            for model in (Catalog, Book)
+        })
+    # GET endpoints read through read-only connections and never block writers
+    read_session = storage.read_only_session(app, db.engine)
+    # Drops change log entries every replica has applied, and any older than
+    # CATALOG_CHANGE_RETENTION seconds (default one day)
+    change_log_pruner = change_log.ChangeLogPruner(
+        db.engine, retention=float(os.environ.get('CATALOG_CHANGE_RETENTION', change_log.DEFAULT_RETENTION)))
+change_log_pruner.start()
+registry.add_collector(change_log_pruner.collect_metrics)
 
-# Helper function to log messages
-def log(message):
-    with open('./catalog_log.txt', 'a') as logger:
-        logger.write(f'{message}\n')
+# JSON lines event log, written in batches off the request path
+catalog_log = AsyncLog('./catalog_log.txt')
+registry.add_collector(catalog_log.collect_metrics)
 
 # Socket.io event handlers
 @socketio.on('catalog_change')
@@ -86,14 +144,63 @@ def handle_book_change_replica(message):
         app.logger.warning("No book_info found in message")
 
 # API Endpoints
+@app.get('/health')
+def health():
+    """Liveness probe used by the front tier load balancer."""
+    return jsonify({'status': 'ok'})
+
+@app.get('/changes')
+def get_changes():
+    """
+    Changes after sequence number `since`, oldest first (?since=&limit=),
+    for replicas. A replica also sends its `node` name, so the changes it
+    has applied can be pruned. Entries every replica has applied, and any
+    older than CATALOG_CHANGE_RETENTION, are deleted; a `since` inside the
+    pruned part answers 410 and the replica bootstraps again.
+    """
+    try:
+        since, limit = change_log.parse_feed_args(request.args)
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    if request.args.get('node'):
+        change_log_pruner.ack(request.args['node'], since)
+    try:
+        return jsonify(change_log.read_changes(read_session, since, limit))
+    except change_log.ChangesPruned as exc:
+        return make_response(jsonify({'error': str(exc), 'pruned_seq': exc.pruned_seq}), 410)
+
+SNAPSHOT_MODELS = {'catalog': Catalog, 'book': Book}
+
+@app.get('/snapshot/<string:entity>')
+def get_snapshot(entity):
+    """One chunk of catalog or book rows by id (?after=&limit=), for replica bootstrap."""
+    model = SNAPSHOT_MODELS.get(entity)
+    if model is None:
+        return make_response(jsonify({'error': f'unknown entity {entity}'}), 404)
+    try:
+        after, limit = change_log.parse_snapshot_args(request.args)
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    return jsonify(change_log.read_snapshot(read_session, model, after, limit))
+
+CATALOG_FIELDS = ('id', 'name')
+BOOK_FIELDS = ('id', 'name', 'count', 'price', 'catalog_id')
+
 @app.get('/catalogs')
 def get_all_catalogs():
-    """Retrieve all catalogs."""
+    """Retrieve catalogs a page at a time (?limit=&after=&fields=)."""
+    try:
+        limit, after, fields = parse_page_args(request.args, CATALOG_FIELDS)
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
     try:
-        catalogs = db.session.execute(db.select(Catalog).order_by(Catalog.id)).scalars()
-        catalogs_list = [{'id': catalog.id, 'name': catalog.name} for catalog in catalogs]
-        log(f'make GET request on /catalogs > get all catalogs {datetime.now()}')
-        return jsonify({'catalogs': catalogs_list})
+        # The change sequence is read before the rows, so the ETag is never newer than the data
+        seq, changed_at = change_log.head(read_session)
+
+        def build():
+            catalogs_list, next_after = fetch_page(read_session, Catalog, limit, after, fields)
+            return {'catalogs': catalogs_list, 'next_after': next_after}
+        return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
     except Exception as e:
         return make_response(jsonify({'error': str(e)}), 500)
 
@@ -105,7 +212,7 @@ def create_catalog():
         catalog = Catalog(name=name)
         db.session.add(catalog)
         db.session.commit()
-        log(f'make POST request on /catalogs > add new catalog {datetime.now()}')
+        catalog_log.log('catalog_created', catalog_id=catalog.id, name=catalog.name)
         socketio.emit('catalog_change', {'catalog_info': {'id': catalog.id, 'name': catalog.name}}, namespace='/replica')
         return jsonify({'success': True, 'catalog': catalog.name, 'catalog_id': catalog.id})
     except KeyError:
@@ -113,11 +220,18 @@ def create_catalog():
 
 @app.get('/books')
 def get_all_books():
-    """Retrieve all books."""
+    """Retrieve books a page at a time (?limit=&after=&fields=)."""
     try:
-        books = db.session.execute(db.select(Book).order_by(Book.id)).scalars()
-        books_list = [{'id': book.id, 'name': book.name, 'count': book.count, 'price': book.price} for book in books]
-        return jsonify({'books': books_list})
+        limit, after, fields = parse_page_args(request.args, BOOK_FIELDS)
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    try:
+        seq, changed_at = change_log.head(read_session)
+
+        def build():
+            books_list, next_after = fetch_page(read_session, Book, limit, after, fields)
+            return {'books': books_list, 'next_after': next_after}
+        return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
     except Exception as e:
         return make_response(jsonify({'error': str(e)}), 500)
 
@@ -138,38 +252,126 @@ def create_book():
     except Exception as exc:
         return make_response(jsonify({'error': str(exc)}), 400)
 
+def emit_bulk_change(ids):
+    """One coalesced change event for a committed chunk of a bulk load."""
+    socketio.emit('catalog_change', {'catalog_info': {'ids': ids}}, namespace='/replica')
+    socketio.emit('book_change', {'book_info': {'ids': ids}}, namespace='/replica')
+
+@app.post('/books/bulk')
+def create_books_bulk():
+    """
+    Import books from a JSON lines or CSV body (Content-Type text/csv or
+    ?format=csv) with name, catalog, count and price per row. Rows are
+    validated as they are read and inserted in chunks of one transaction
+    each; invalid rows are reported without stopping the load.
+    """
+    report = bulk_load.LoadReport()
+    catalog_ids = set(db.session.scalars(select(Catalog.id)))
+    records = bulk_load.iter_records(request.stream, bulk_load.is_csv(request.content_type, request.args))
+    try:
+        for chunk in bulk_load.validated_chunks(records, bulk_load.parse_book, report):
+            accepted = []
+            for line, row in chunk:
+                if row['catalog_id'] in catalog_ids:
+                    accepted.append((line, row))
+                else:
+                    report.error(line, f"unknown catalog {row['catalog_id']}")
+            if not accepted:
+                continue
+            try:
+                ids = db.session.scalars(insert(Book).returning(Book.id), [row for _, row in accepted]).all()
+                db.session.commit()
+            except Exception as exc:
+                db.session.rollback()
+                for line, _ in accepted:
+                    report.error(line, str(exc))
+                continue
+            report.written += len(ids)
+            report.chunks += 1
+            emit_bulk_change(ids)
+    except bulk_load.UNREADABLE_BODY as exc:
+        return make_response(jsonify(dict(report.as_dict('inserted'), error=f'unreadable body: {exc}')), 400)
+    catalog_log.log('books_bulk_created', rows=report.rows, inserted=report.written, failed=report.failed)
+    return jsonify(report.as_dict('inserted'))
+
 @app.get('/books/search/<string:name>')
 def search_books(name):
-    """Search for books by name."""
-    books = db.session.execute(db.select(Book).filter_by(name=name)).scalars()
-    books_list = [{'name': book.name, 'price': book.price, 'id': book.id} for book in books]
-    return jsonify({'books': books_list})
+    """Search for books by name, best matches first (top `limit`)."""
+    try:
+        limit = search_index.parse_limit(request.args.get('limit'))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    seq, changed_at = change_log.head(read_session)
+
+    def build():
+        books = search_index.search(read_session, Book.__tablename__, name, limit, fts_enabled)
+        return {'books': [{'name': book.name, 'price': book.price, 'id': book.id} for book in books]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
 
 @app.get('/books/find')
 def get_book_by_name():
-    """Get books by name using a search string."""
+    """Get books by name using a search string; every word matches as a prefix."""
     search_string = request.args.get('name', '')
-    books = db.session.query(Book).filter(or_(Book.name.like(f"%{search_string}%"))).all()
-    book_info = [{'id': book.id, 'name': book.name, 'count': book.count} for book in books]
-    return jsonify({'books': book_info})
+    try:
+        limit = search_index.parse_limit(request.args.get('limit'))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    seq, changed_at = change_log.head(read_session)
+
+    def build():
+        books = search_index.search(read_session, Book.__tablename__, search_string, limit, fts_enabled)
+        return {'books': [{'id': book.id, 'name': book.name, 'count': book.count} for book in books]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
+
+# Upper bound on ids per batch lookup, well below SQLite's parameter limit
+MAX_BATCH_IDS = 500
+
+def parse_batch_ids():
+    """Parse the ids query parameter of a batch request, keeping the given order."""
+    ids = list(dict.fromkeys(int(part) for part in request.args.get('ids', '').split(',') if part.strip()))
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'at most {MAX_BATCH_IDS} ids per request')
+    return ids
+
+@app.get('/books/batch')
+def get_books_batch():
+    """Retrieve many books by ID with a single IN query."""
+    try:
+        ids = parse_batch_ids()
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    seq, changed_at = change_log.head(read_session)
+
+    def build():
+        rows = read_session.execute(db.select(Book.id, Book.name, Book.count).where(Book.id.in_(ids))).all() if ids else []
+        books_list = [{'id': row.id, 'name': row.name, 'count': row.count} for row in rows]
+        found = {book['id'] for book in books_list}
+        return {'books': books_list, 'missing': [id for id in ids if id not in found]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
 
 @app.get('/books/<int:id>')
 def get_book(id):
-    """Retrieve book by ID."""
-    try:
-        book = Book.query.filter_by(id=id).first()
-        book_info = {'id': book.id, 'name': book.name, 'count': book.count}
-        return jsonify({'books': book_info})
-    except Exception as exc:
-        return make_response(jsonify({'error': str(exc)}), 404)
+    """Retrieve book by ID; answers 304 when If-None-Match has the current version."""
+    book = read_session.get(Book, id)
+    if book is None:
+        return make_response(jsonify({'error': 'Book not found'}), 404)
+    return conditional.respond(
+        lambda: {'books': {'id': book.id, 'name': book.name, 'count': book.count}},
+        conditional.row_etag(book), book.updated_at)
 
 @app.get('/books/<int:id>/stock/availability')
 def stock_availability(id):
-    """Check stock availability of a book by ID."""
-    book = Book.query.filter_by(id=id).first()
-    if book.count == 0:
+    """
+    Check stock availability of a book by ID: the primary's own share,
+    what take_stock() can sell, without the copies escrowed to replicas.
+    """
+    left = read_session.execute(
+        select(Book.count - remote_shares(Book.id)).where(Book.id == id)).scalar()
+    if left is None:
+        return make_response(jsonify({'error': 'Book not found'}), 404)
+    if left <= 0:
         return make_response(jsonify({'success': False, 'message': 'Out of stock'}), 403)
-    return jsonify({'success': True, 'left': book.count})
+    return jsonify({'success': True, 'left': left})
 
 @app.put('/books/<int:id>/count/increase')
 def increase_book_stock(id):
@@ -183,17 +385,112 @@ def increase_book_stock(id):
     except Exception as e:
         return make_response(jsonify({'error': str(e)}), 404)
 
+# Number of catalog nodes sharing each book's stock (this one included)
+ESCROW_NODES = int(os.environ.get('CATALOG_ESCROW_NODES', 2))
+
+# Copies the primary was asked for but had escrowed to other nodes; the
+# next sync of those nodes asks them to release stock
+release_wanted = {}
+release_wanted_lock = threading.Lock()
+
+def remote_shares(book_id):
+    """SQL expression for the stock of a book escrowed to remote nodes."""
+    return (select(func.coalesce(func.sum(
+                StockEscrow.granted_total - StockEscrow.sold_total - StockEscrow.released_total), 0))
+            .where(StockEscrow.book_id == book_id).scalar_subquery())
+
+def take_stock(id, qty):
+    """
+    Take qty copies of a book out of the primary's share with one
+    conditional UPDATE, so concurrent buyers can never sell stock that is
+    gone or escrowed to a replica. Returns the updated row, with `left`
+    the primary's own share after the sale, or None when the book is
+    missing or its share has too few copies.
+    """
+    return db.session.execute(
+        update(Book)
+        .where(Book.id == id, Book.count - qty >= remote_shares(Book.id))
+        .values(count=Book.count - qty)
+        .returning(Book.id, Book.name, Book.count, Book.price, Book.catalog_id,
+                   (Book.count - remote_shares(Book.id)).label('left'))).first()
+
+def stock_error(id, qty=1):
+    """Explain why take_stock() failed: 404 for an unknown book, 403 when out of stock."""
+    book = db.session.get(Book, id)
+    if book is None:
+        return make_response(jsonify({'error': 'Book not found', 'id': id}), 404)
+    if book.count >= qty:
+        # Stock exists but sits in other nodes' shares; ask for it back
+        with release_wanted_lock:
+            release_wanted[id] = max(release_wanted.get(id, 0), qty)
+    return make_response(jsonify({'success': False, 'message': 'Out of stock', 'id': id}), 403)
+
 @app.put('/books/<int:id>/count/decrease')
 def decrease_book_stock(id):
     """Decrease the stock count of a book by ID."""
+    book = take_stock(id, 1)
+    if book is None:
+        response = stock_error(id)
+        db.session.rollback()
+        return response
+    db.session.commit()
+    socketio.emit('book_change', {'book_info': {'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+    return jsonify({'count': book.count})
+
+@app.post('/books/<int:id>/purchase')
+def purchase_book(id):
+    """
+    Sell qty copies (form or query field, default 1) in one short
+    transaction and return the updated book.
+    """
     try:
-        book = Book.query.filter_by(id=id).first()
-        book.count -= 1
-        db.session.commit()
-        socketio.emit('book_change', {'book_info': {'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
-        return jsonify({'count': book.count})
-    except Exception as e:
-        return make_response(jsonify({'error': str(e)}), 404)
+        qty = int(request.values.get('qty', 1))
+    except ValueError:
+        return make_response(jsonify({'error': 'qty must be an integer'}), 400)
+    if qty < 1:
+        return make_response(jsonify({'error': 'qty must be at least 1'}), 400)
+    book = take_stock(id, qty)
+    if book is None:
+        response = stock_error(id, qty)
+        db.session.rollback()
+        return response
+    db.session.commit()
+    catalog_log.log('stock_taken', book_id=book.id, qty=qty, left=book.left)
+    socketio.emit('book_change', {'book_info': {'id': book.id, 'name': book.name, 'catalog': book.catalog_id}}, namespace='/replica')
+    # What this node can still sell, like the replica's answer and
+    # /stock/availability; the escrowed shares are not counted
+    return jsonify({
+        'books': {'id': book.id, 'name': book.name, 'count': book.left, 'price': book.price},
+        'count': book.left,
+    })
+
+@app.post('/books/purchase')
+def purchase_books():
+    """
+    Sell a cart, {"items": [{"id": 1, "qty": 2}, ...]}, all or nothing:
+    every book is taken in one transaction, and if one is unknown or
+    short the whole cart is rolled back with that book's 404 or 403.
+    """
+    try:
+        items = cart.parse_items(request.get_json(silent=True))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    books = []
+    for id, qty in items:
+        book = take_stock(id, qty)
+        if book is None:
+            response = stock_error(id, qty)
+            db.session.rollback()
+            return response
+        books.append(book)
+    db.session.commit()
+    for book, (_, qty) in zip(books, items):
+        catalog_log.log('stock_taken', book_id=book.id, qty=qty, left=book.left)
+    # One change event for the whole cart
+    socketio.emit('book_change', {'book_info': {'ids': [book.id for book in books]}}, namespace='/replica')
+    return jsonify({'books': [
+        {'id': book.id, 'name': book.name, 'count': book.left, 'price': book.price, 'qty': qty}
+        for book, (_, qty) in zip(books, items)]})
 
 @app.put('/books/<int:id>/price')
 def update_book_price(id):
@@ -208,6 +505,137 @@ def update_book_price(id):
     except Exception as e:
         return make_response(jsonify({'error': str(e)}), 404)
 
+@app.put('/books/prices/bulk')
+def update_book_prices_bulk():
+    """
+    Update prices from a JSON lines or CSV body with id and price per row,
+    in chunks of one transaction each. Unknown ids and invalid rows are
+    reported without stopping the load.
+    """
+    report = bulk_load.LoadReport()
+    records = bulk_load.iter_records(request.stream, bulk_load.is_csv(request.content_type, request.args))
+    try:
+        for chunk in bulk_load.validated_chunks(records, bulk_load.parse_price, report):
+            chunk_ids = {row['id'] for _, row in chunk}
+            existing = set(db.session.scalars(select(Book.id).where(Book.id.in_(chunk_ids))))
+            accepted = []
+            for line, row in chunk:
+                if row['id'] in existing:
+                    accepted.append((line, row))
+                else:
+                    report.error(line, f"unknown book {row['id']}")
+            if not accepted:
+                continue
+            try:
+                # ORM bulk UPDATE by primary key: one executemany per chunk
+                db.session.execute(update(Book), [row for _, row in accepted])
+                db.session.commit()
+            except Exception as exc:
+                db.session.rollback()
+                for line, _ in accepted:
+                    report.error(line, str(exc))
+                continue
+            report.written += len(accepted)
+            report.chunks += 1
+            emit_bulk_change(sorted(existing))
+    except bulk_load.UNREADABLE_BODY as exc:
+        return make_response(jsonify(dict(report.as_dict('updated'), error=f'unreadable body: {exc}')), 400)
+    catalog_log.log('book_prices_bulk_updated', rows=report.rows, updated=report.written, failed=report.failed)
+    return jsonify(report.as_dict('updated'))
+
+@app.post('/stock/sync')
+def sync_stock():
+    """
+    Settle a remote node's escrowed stock. The body is JSON with `node` and
+    `books`, a list of {id, granted_total, sold_total, released_total,
+    want} holding the node's cumulative counters. Reported sales come off
+    Book.count and releases return to the primary's share. The answer has
+    the cumulative grant, share target and any release request per book.
+    """
+    payload = request.get_json(silent=True) or {}
+    node = payload.get('node')
+    if not node or node == 'primary':
+        return make_response(jsonify({'error': 'a remote node name is required'}), 400)
+    try:
+        reports = {int(book['id']): book for book in payload.get('books', [])}
+    except (KeyError, TypeError, ValueError):
+        return make_response(jsonify({'error': 'every book needs an integer id'}), 400)
+    with release_wanted_lock:
+        wanted = dict(release_wanted)
+    # Take the write lock before reading shares so a concurrent purchase
+    # cannot spend stock that is being granted
+    db.session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+    ids = set(reports) | set(wanted)
+    books = {book.id: book for book in db.session.scalars(select(Book).where(Book.id.in_(ids)))}
+    rows = db.session.scalars(select(StockEscrow).where(StockEscrow.book_id.in_(ids))).all()
+    answers = []
+    released = []
+    for book_id in ids:
+        book = books.get(book_id)
+        row = next((row for row in rows if row.book_id == book_id and row.node == node), None)
+        if book is None or (row is None and book_id not in reports):
+            continue
+        if row is None:
+            row = StockEscrow(book_id=book_id, node=node, granted_total=0, sold_total=0,
+                              released_total=0, target=0)
+            db.session.add(row)
+        # Shares of the other remote nodes stay as they are
+        others = sum(other.share for other in rows if other.book_id == book_id and other.node != node)
+        report = reports.get(book_id, {})
+        sold = max(0, int(report.get('sold_total', 0)) - row.sold_total)
+        row.sold_total += sold
+        book.count -= sold
+        row.released_total = max(row.released_total, int(report.get('released_total', 0)))
+        primary_share = book.count - others - row.share
+        target, grant, release = stock_escrow.plan(
+            book.count, ESCROW_NODES, primary_share, row.share,
+            want=int(report.get('want', 0)), primary_wants=wanted.get(book_id, 0))
+        row.granted_total += grant
+        row.target = target
+        if book_id in wanted and (release or not row.share or primary_share >= wanted[book_id]):
+            released.append(book_id)
+        answers.append({'id': book_id, 'granted_total': row.granted_total, 'target': target,
+                        'release': release, 'count': book.count})
+    db.session.commit()
+    with release_wanted_lock:
+        for book_id in released:
+            release_wanted.pop(book_id, None)
+    return jsonify({'books': answers})
+
+@app.get('/stock/allocation')
+def get_stock_allocation():
+    """
+    Total stock and each node's share: summed over all books, plus per
+    book for ?ids=1,2,3.
+    """
+    try:
+        ids = parse_batch_ids()
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    total = read_session.execute(select(func.coalesce(func.sum(Book.count), 0))).scalar()
+    node_totals = dict(read_session.execute(
+        select(StockEscrow.node, func.sum(StockEscrow.granted_total - StockEscrow.sold_total - StockEscrow.released_total))
+        .group_by(StockEscrow.node)).all())
+    books = []
+    if ids:
+        rows = read_session.execute(
+            select(StockEscrow).where(StockEscrow.book_id.in_(ids))).scalars().all()
+        for book in read_session.scalars(select(Book).where(Book.id.in_(ids))):
+            nodes = {row.node: {'share': row.share, 'granted_total': row.granted_total,
+                                'sold_total': row.sold_total, 'released_total': row.released_total,
+                                'target': row.target}
+                     for row in rows if row.book_id == book.id}
+            books.append({'id': book.id, 'count': book.count,
+                          'shares': dict({'primary': book.count - sum(node['share'] for node in nodes.values())},
+                                         **{name: node['share'] for name, node in nodes.items()}),
+                          'nodes': nodes})
+    return jsonify({
+        'count': total,
+        'shares': dict({'primary': total - sum(node_totals.values())}, **node_totals),
+        'release_wanted': len(release_wanted),
+        'books': books,
+    })
+
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 4000 in debug mode
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=4000, debug=True)
@@ -3,14 +3,23 @@ from datetime import datetime
 from flask import Flask, jsonify, make_response, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy import Float, Integer, String, ForeignKey, or_
+from sqlalchemy import Float, Integer, String, ForeignKey
 from flask_socketio import SocketIO
-from book_server import Book
+from metrics import instrument_flask, instrument_engine, registry
+import search_index
+from pagination import parse_page_args, fetch_page
+import storage
+import conditional
+import cart
+from change_log import ReplicationFollower
+from stock_escrow import EscrowClient
+import requests
 
 # Setup SQLAlchemy base and Flask app
 Base = declarative_base()
 app_replica = Flask(__name__)
 socketio_replica = SocketIO(app_replica, cors_allowed_origins="*")
+instrument_flask(app_replica)
 
 # App configuration
 app_replica.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(os.getcwd(), 'project_replica.db')
@@ -22,47 +31,53 @@ class CatalogReplica(db_replica.Model):
     __tablename__ = 'catalog_replica'
     id = db_replica.Column(Integer, primary_key=True)
     name = db_replica.Column(String)
+    # Copied from the primary with each replicated row, so ETags match across nodes
+    version = db_replica.Column(Integer, default=1, server_default='1')
+    updated_at = db_replica.Column(Float)
 
 class BookReplica(db_replica.Model):
     __tablename__ = 'book_replica'
     id = db_replica.Column(Integer, primary_key=True)
-    name = db_replica.Column(String)
+    name = db_replica.Column(String, index=True)
     count = db_replica.Column(Integer, default=1)
     price = db_replica.Column(Float, default=0)
-    catalog_id = db_replica.Column(Integer, ForeignKey(CatalogReplica.id))
+    catalog_id = db_replica.Column(Integer, ForeignKey(CatalogReplica.id), index=True)
+    version = db_replica.Column(Integer, default=1, server_default='1')
+    updated_at = db_replica.Column(Float)
     catalog = relationship(CatalogReplica)
 
 # Create tables
 with app_replica.app_context():
+    storage.configure_sqlite(db_replica.engine)
     db_replica.create_all()
+    instrument_engine(db_replica.engine)
+    with db_replica.engine.begin() as conn:
+        storage.ensure_columns(conn, CatalogReplica, BookReplica)
+        storage.ensure_indexes(conn, BookReplica)
+        fts_enabled = search_index.ensure_search_index(conn, BookReplica.__tablename__)
+    # Read-only connections for GET endpoints
+    read_session = storage.read_only_session(app_replica, db_replica.engine)
 
-# Helper functions
-data_copy_done = False
-def copy_data_from_original_to_replica():
-    try:
-        global data_copy_done
-        if not data_copy_done:
-            with app_replica.app_context():
-                books_original = Book.query.all()
-                for book_original in books_original:
-                    book_replica = BookReplica(
-                        id=book_original.id,
-                        name=book_original.name,
-                        count=book_original.count,
-                        price=book_original.price,
-                        catalog_id=book_original.catalog_id
-                    )
-                    db_replica.session.add(book_replica)
-                    db_replica.session.commit()
-                data_copy_done = True
-        return True
-    except Exception:
-        return False
-
-@app_replica.before_request
-def before_request():
-    with app_replica.app_context():
-        copy_data_from_original_to_replica()
+# Snapshot bootstrap, then incremental sync from the primary's /changes
+# feed, on a background thread; an empty CATALOG_PRIMARY_URL turns it off
+primary_url = os.environ.get('CATALOG_PRIMARY_URL', 'http://127.0.0.1:4000')
+node_name = os.environ.get('CATALOG_NODE_NAME', 'replica')
+with app_replica.app_context():
+    follower = ReplicationFollower(db_replica.engine, primary_url, {
+        'catalog': (CatalogReplica.__tablename__, tuple(column.name for column in CatalogReplica.__table__.columns)),
+        'book': (BookReplica.__tablename__, tuple(column.name for column in BookReplica.__table__.columns)),
+    }, node=node_name)
+    # This node's share of each book's stock, settled with the primary in
+    # the background (see stock_escrow.py). A standalone replica owns its
+    # rows and sells from Book.count directly
+    escrow = None
+    if primary_url:
+        escrow = EscrowClient(db_replica.engine, primary_url, node_name,
+                              book_table=BookReplica.__tablename__)
+registry.add_collector(follower.collect_metrics)
+if primary_url:
+    follower.start()
+    escrow.start()
 
 # Socket.IO Event Handlers
 @socketio_replica.on('catalog_change_replica')
@@ -89,18 +104,48 @@ def handle_book_change_origin(message):
     if book_info:
         print(f"Received book change from Replica to Origin: {book_info}")
 
+def read_only(allow='GET, HEAD'):
+    """
+    Answer for writes to replicated rows while following the primary: a
+    local row would clash with the primary's ids and be overwritten by the
+    change feed, so writes go to the primary.
+    """
+    return make_response(jsonify({'error': 'This catalog replica is read-only; send writes to the primary',
+                                  'primary': primary_url}), 405, {'Allow': allow})
+
 # Endpoint Routes
+@app_replica.route('/health')
+def health_replica():
+    # Not ready for traffic until the bootstrap copy has finished
+    if primary_url and not follower.bootstrapped:
+        return make_response(jsonify({'status': 'bootstrapping'}), 503)
+    return jsonify({'status': 'ok'})
+
+@app_replica.route('/replication/status')
+def replication_status():
+    """Applied sequence number and lag behind the primary, in changes and seconds."""
+    return jsonify(follower.status())
+
 @app_replica.route('/catalogs', methods=['GET', 'POST'])
 def manage_catalogs_replica():
     if request.method == 'GET':
         try:
-            catalogs = db_replica.session.execute(
-                db_replica.select(CatalogReplica).order_by(CatalogReplica.id)).scalars()
-            catalogs_list = [{'id': catalog.id, 'name': catalog.name} for catalog in catalogs]
-            return jsonify({'catalogs': catalogs_list})
+            limit, after, fields = parse_page_args(request.args, ('id', 'name'))
+        except ValueError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+        try:
+            # Validated by the applied sequence number, which is the primary's
+            seq, changed_at = follower.applied()
+
+            def build():
+                catalogs_list, next_after = fetch_page(read_session, CatalogReplica, limit, after, fields)
+                return {'catalogs': catalogs_list, 'next_after': next_after}
+            return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
         except Exception as e:
             return make_response(jsonify({'error': str(e)}), 500)
     elif request.method == 'POST':
+        if primary_url:
+            return read_only()
         try:
             name = request.form['name']
             catalog_replica = CatalogReplica(name=name)
@@ -115,12 +160,22 @@ def manage_catalogs_replica():
 def manage_books_replica():
     if request.method == 'GET':
         try:
-            books = BookReplica.query.all()
-            books_list = [{'id': book.id, 'name': book.name, 'count': book.count, 'price': book.price} for book in books]
-            return jsonify({'books': books_list})
+            limit, after, fields = parse_page_args(
+                request.args, ('id', 'name', 'count', 'price', 'catalog_id'))
+        except ValueError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+        try:
+            seq, changed_at = follower.applied()
+
+            def build():
+                books_list, next_after = fetch_page(read_session, BookReplica, limit, after, fields)
+                return {'books': books_list, 'next_after': next_after}
+            return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
         except Exception as e:
             return make_response(jsonify({'error': str(e)}), 500)
     elif request.method == 'POST':
+        if primary_url:
+            return read_only()
         try:
             name = request.form['name']
             catalog = request.form['catalog']
@@ -136,26 +191,63 @@ def manage_books_replica():
 
 @app_replica.route('/books/search/<string:name>')
 def search_books_replica(name):
-    books = db_replica.session.execute(
-        db_replica.select(BookReplica).filter_by(name=name)).scalars()
-    books_list = [{'name': book.name, 'price': book.price, 'id': book.id} for book in books]
-    return jsonify({'books': books_list})
+    try:
+        limit = search_index.parse_limit(request.args.get('limit'))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    seq, changed_at = follower.applied()
+
+    def build():
+        books = search_index.search(read_session, BookReplica.__tablename__, name, limit, fts_enabled)
+        return {'books': [{'name': book.name, 'price': book.price, 'id': book.id} for book in books]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
 
 @app_replica.route('/books/find')
 def get_book_by_name_replica():
     search_string = request.args.get('name', '')
-    books = db_replica.session.query(BookReplica).filter(BookReplica.name.like(f"%{search_string}%")).all()
-    book_info = [{'id': book.id, 'name': book.name, 'count': book.count} for book in books]
-    return jsonify({'books': book_info})
+    try:
+        limit = search_index.parse_limit(request.args.get('limit'))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    seq, changed_at = follower.applied()
+
+    def build():
+        books = search_index.search(read_session, BookReplica.__tablename__, search_string, limit, fts_enabled)
+        return {'books': [{'id': book.id, 'name': book.name, 'count': book.count} for book in books]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
+
+MAX_BATCH_IDS = 500
+
+@app_replica.route('/books/batch')
+def get_books_batch_replica():
+    try:
+        ids = list(dict.fromkeys(int(part) for part in request.args.get('ids', '').split(',') if part.strip()))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    if len(ids) > MAX_BATCH_IDS:
+        return make_response(jsonify({'error': f'at most {MAX_BATCH_IDS} ids per request'}), 400)
+    seq, changed_at = follower.applied()
+
+    def build():
+        rows = read_session.execute(
+            db_replica.select(BookReplica.id, BookReplica.name, BookReplica.count).where(BookReplica.id.in_(ids))).all() if ids else []
+        books_list = [{'id': row.id, 'name': row.name, 'count': row.count} for row in rows]
+        found = {book['id'] for book in books_list}
+        return {'books': books_list, 'missing': [id for id in ids if id not in found]}
+    return conditional.respond(build, conditional.feed_etag(seq), changed_at, weak=True)
 
 @app_replica.route('/books/<int:id>', methods=['GET', 'PUT'])
 def manage_book_replica(id):
     if request.method == 'GET':
-        book = BookReplica.query.get(id)
+        book = read_session.get(BookReplica, id)
         if book:
-            return jsonify({'id': book.id, 'name': book.name, 'count': book.count})
+            return conditional.respond(
+                lambda: {'books': {'id': book.id, 'name': book.name, 'count': book.count}},
+                conditional.row_etag(book), book.updated_at)
         return make_response(jsonify({'error': 'Book not found'}), 404)
     elif request.method == 'PUT':
+        if primary_url:
+            return read_only()
         price = float(request.form['price'])
         book = BookReplica.query.get(id)
         if book:
@@ -167,6 +259,8 @@ def manage_book_replica(id):
 
 @app_replica.route('/books/<int:id>/count/increase', methods=['PUT'])
 def increase_book_stock_replica(id):
+    if primary_url:
+        return read_only(allow='')
     book = BookReplica.query.get(id)
     if book:
         book.count += 1
@@ -177,6 +271,8 @@ def increase_book_stock_replica(id):
 
 @app_replica.route('/books/<int:id>/count/decrease', methods=['PUT'])
 def decrease_book_stock_replica(id):
+    if primary_url:
+        return read_only(allow='')
     book = BookReplica.query.get(id)
     if book:
         if book.count > 0:
@@ -187,13 +283,128 @@ def decrease_book_stock_replica(id):
         return jsonify({'error': 'Book is already out of stock'}), 403
     return make_response(jsonify({'error': 'Book not found'}), 404)
 
+@app_replica.route('/books/<int:id>/purchase', methods=['POST'])
+def purchase_book_replica(id):
+    try:
+        qty = int(request.values.get('qty', 1))
+    except ValueError:
+        return make_response(jsonify({'error': 'qty must be an integer'}), 400)
+    if qty < 1:
+        return make_response(jsonify({'error': 'qty must be at least 1'}), 400)
+    book = db_replica.session.get(BookReplica, id)
+    if book is None:
+        return make_response(jsonify({'error': 'Book not found'}), 404)
+    # Sell from this node's share without asking the primary
+    if not take_copies(id, qty):
+        db_replica.session.rollback()
+        if escrow is None:
+            return make_response(jsonify({'success': False, 'message': 'Out of stock'}), 403)
+        # Share used up: ask the primary for more, once
+        try:
+            escrow.sync([id], want={id: qty})
+        except requests.RequestException:
+            return make_response(jsonify({'error': 'stock allocation unavailable'}), 503)
+        if not take_copies(id, qty):
+            db_replica.session.rollback()
+            return make_response(jsonify({'success': False, 'message': 'Out of stock'}), 403)
+    # While following, the book row itself is left to replication, so it
+    # stays an exact copy of the primary's version and its count lags until
+    # the sale is settled. What this node can still sell is its share, so
+    # that is the count reported.
+    left = copies_left(db_replica.session, [id])[id]
+    db_replica.session.commit()
+    socketio_replica.emit('book_change_replica', {'book_info': {'id': book.id, 'name': book.name, 'count': left}})
+    return jsonify({
+        'books': {'id': book.id, 'name': book.name, 'count': left, 'price': book.price},
+        'count': left,
+    })
+
+def take_copies(id, qty):
+    """
+    Sell qty copies in the open transaction: from this node's escrowed
+    share while following a primary, otherwise from the book's own count.
+    False if there are too few.
+    """
+    if escrow is not None:
+        return escrow.take(db_replica.session, id, qty)
+    result = db_replica.session.execute(
+        db_replica.update(BookReplica)
+        .where(BookReplica.id == id, BookReplica.count >= qty)
+        .values(count=BookReplica.count - qty))
+    return result.rowcount == 1
+
+def copies_left(session, ids):
+    """{book_id: copies this node can still sell} for `ids`."""
+    if escrow is not None:
+        return escrow.shares(session, ids)
+    counts = dict(session.execute(
+        db_replica.select(BookReplica.id, BookReplica.count).where(BookReplica.id.in_(ids))).all())
+    return {id: counts.get(id, 0) for id in ids}
+
+def take_shares(items):
+    """Take every item in the open transaction; returns the books that were short."""
+    return [id for id, qty in items if not take_copies(id, qty)]
+
+@app_replica.route('/books/purchase', methods=['POST'])
+def purchase_books_replica():
+    """
+    Sell a cart, {"items": [{"id": 1, "qty": 2}, ...]}, all or nothing
+    from this node's shares, in one transaction. Short shares are topped
+    up with a single sync for all of them before the cart is refused.
+    """
+    try:
+        items = cart.parse_items(request.get_json(silent=True))
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    ids = [id for id, _ in items]
+    books = {book.id: book for book in db_replica.session.scalars(
+        db_replica.select(BookReplica).where(BookReplica.id.in_(ids)))}
+    for id in ids:
+        if id not in books:
+            return make_response(jsonify({'error': 'Book not found', 'id': id}), 404)
+    short = take_shares(items)
+    if short and escrow is None:
+        db_replica.session.rollback()
+        return make_response(jsonify({'success': False, 'message': 'Out of stock', 'id': short[0]}), 403)
+    if short:
+        db_replica.session.rollback()
+        wanted = dict(items)
+        try:
+            escrow.sync(short, want={id: wanted[id] for id in short})
+        except requests.RequestException:
+            return make_response(jsonify({'error': 'stock allocation unavailable'}), 503)
+        short = take_shares(items)
+        if short:
+            db_replica.session.rollback()
+            return make_response(jsonify({'success': False, 'message': 'Out of stock', 'id': short[0]}), 403)
+    # Counts are the local shares left, as for a single purchase
+    left = copies_left(db_replica.session, ids)
+    db_replica.session.commit()
+    socketio_replica.emit('book_change_replica', {'book_info': {'ids': ids}})
+    return jsonify({'books': [
+        {'id': id, 'name': books[id].name, 'count': left[id], 'price': books[id].price, 'qty': qty}
+        for id, qty in items]})
+
+@app_replica.route('/stock/allocation')
+def get_stock_allocation_replica():
+    """This node's escrowed shares: totals, plus per book for ?ids=1,2,3."""
+    try:
+        ids = [int(part) for part in request.args.get('ids', '').split(',') if part.strip()][:MAX_BATCH_IDS]
+    except ValueError as exc:
+        return make_response(jsonify({'error': str(exc)}), 400)
+    if escrow is None:
+        return make_response(jsonify({'error': 'standalone replica, its stock is not escrowed'}), 404)
+    return jsonify(escrow.allocation(ids))
+
 @app_replica.route('/books/<int:id>/stock/availability')
 def stock_availability_replica(id):
-    book = BookReplica.query.get(id)
+    """Copies this node can sell without asking the primary: its escrowed share, or its count when standalone."""
+    book = read_session.get(BookReplica, id)
     if book:
-        if book.count == 0:
+        left = copies_left(read_session, [id])[id]
+        if left == 0:
             return make_response(jsonify({'success': False, 'message': 'Out of stock'}), 403)
-        return jsonify({'success': True, 'left': book.count})
+        return jsonify({'success': True, 'left': left})
     return make_response(jsonify({'error': 'Book not found'}), 404)
 
 # Run the application
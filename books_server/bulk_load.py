@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+
+CHUNK_SIZE = 1000
+# Bodies that cannot be read at all, as opposed to single bad rows
+UNREADABLE_BODY = (UnicodeDecodeError, csv.Error)
+# Per-row errors kept in the response; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+def is_csv(content_type, args):
+    return args.get('format') == 'csv' or (content_type or '').split(';')[0].strip() == 'text/csv'
+
+
+def iter_records(stream, csv_format):
+    """
+    Yield (line number, record dict or None, error or None) from a JSON
+    lines or CSV body, reading it a line at a time so the whole body is
+    never held in memory.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if csv_format:
+        reader = csv.DictReader(text)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, None, 'too many fields'
+            else:
+                yield reader.line_num, record, None
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield line_number, None, f'invalid JSON: {exc}'
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, 'expected a JSON object'
+            continue
+        yield line_number, record, None
+
+
+def _field(record, name, convert):
+    value = record.get(name)
+    if value is None or value == '':
+        raise ValueError(f'missing {name}')
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid {name}: {value!r}')
+
+
+def parse_book(record):
+    """Validate one row of a book import: name, catalog, count and price."""
+    count = _field(record, 'count', int)
+    price = _field(record, 'price', float)
+    if count < 0:
+        raise ValueError('count must not be negative')
+    if price < 0:
+        raise ValueError('price must not be negative')
+    return {
+        'name': str(_field(record, 'name', str)).strip(),
+        'catalog_id': _field(record, 'catalog', int),
+        'count': count,
+        'price': price,
+    }
+
+
+def parse_price(record):
+    """Validate one row of a price update: id and price."""
+    price = _field(record, 'price', float)
+    if price < 0:
+        raise ValueError('price must not be negative')
+    return {'id': _field(record, 'id', int), 'price': price}
+
+
+class LoadReport:
+    """Counts and the first MAX_REPORTED_ERRORS per-row errors of a bulk load."""
+
+    def __init__(self):
+        self.rows = 0
+        self.written = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def as_dict(self, written_key):
+        return {
+            'rows': self.rows,
+            written_key: self.written,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+def validated_chunks(records, parse, report, chunk_size=CHUNK_SIZE):
+    """
+    Validate records as they stream in and yield lists of (line, row) of
+    up to chunk_size valid rows; invalid rows go to the report.
+    """
+    chunk = []
+    for line, record, error in records:
+        report.rows += 1
+        if error is None:
+            try:
+                chunk.append((line, parse(record)))
+            except ValueError as exc:
+                error = str(exc)
+        if error is not None:
+            report.error(line, error)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,541 @@
+import json
+import threading
+import time
+
+import requests
+from sqlalchemy import select, text
+
+DEFAULT_FEED_LIMIT = 500
+MAX_FEED_LIMIT = 5000
+POLL_INTERVAL = 0.5
+DEFAULT_SNAPSHOT_CHUNK = 2000
+MAX_SNAPSHOT_CHUNK = 10000
+DEFAULT_RETENTION = 24 * 3600
+PRUNE_INTERVAL = 60
+PRUNE_CHUNK = 5000
+
+# SQLite expression for the current unix time with sub-second precision
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def ensure_change_log(conn, tables):
+    """
+    Create the change_log table and the triggers that append one sequenced
+    row to it for every insert, update and delete on `tables` (a dict of
+    table name -> replicated columns). Writes are captured whatever code
+    path makes them. The first time, the current rows are logged too, so a
+    replica reading from seq 0 ends up with the full data set.
+    """
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_log'").first()
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            data TEXT,
+            created_at REAL NOT NULL
+        )""")
+    # Highest sequence number deleted by ChangeLogPruner
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS change_log_pruned (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL
+        )""")
+    conn.exec_driver_sql('INSERT OR IGNORE INTO change_log_pruned VALUES (1, 0)')
+    for table, columns in tables.items():
+        row_json = 'json_object(' + ', '.join(f"'{column}', new.{column}" for column in columns) + ')'
+        # Recreated on every start so they follow the current columns
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {table}_change_{event.lower()}')
+        for event in ('INSERT', 'UPDATE'):
+            # A versioned row is logged once, by the update that bumps its version
+            when = 'WHEN new.version IS NOT old.version ' if event == 'UPDATE' and 'version' in columns else ''
+            conn.exec_driver_sql(f"""
+                CREATE TRIGGER {table}_change_{event.lower()} AFTER {event} ON {table} {when}BEGIN
+                    INSERT INTO change_log (entity, entity_id, op, data, created_at)
+                    VALUES ('{table}', new.id, 'upsert', {row_json}, {NOW});
+                END""")
+        conn.exec_driver_sql(f"""
+            CREATE TRIGGER {table}_change_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO change_log (entity, entity_id, op, data, created_at)
+                VALUES ('{table}', old.id, 'delete', NULL, {NOW});
+            END""")
+        if exists is None:
+            existing_json = row_json.replace('new.', '')
+            conn.exec_driver_sql(f"""
+                INSERT INTO change_log (entity, entity_id, op, data, created_at)
+                SELECT '{table}', id, 'upsert', {existing_json}, {NOW} FROM {table} ORDER BY id""")
+
+
+def ensure_row_versions(conn, table):
+    """
+    Bump `version` and set `updated_at` on every update of a row in
+    `table` that does not set the version itself, whatever code path
+    writes it. The inner UPDATE does not fire this trigger again because
+    recursive triggers are off.
+    """
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_version AFTER UPDATE ON {table}
+        WHEN new.version IS old.version BEGIN
+            UPDATE {table} SET version = old.version + 1, updated_at = {NOW} WHERE id = new.id;
+        END""")
+
+
+def head(session):
+    """(seq, created_at) of the newest change, or (0, None) for an empty log."""
+    row = session.execute(text(
+        'SELECT seq, created_at FROM change_log ORDER BY seq DESC LIMIT 1')).first()
+    return (row.seq, row.created_at) if row is not None else (0, None)
+
+
+def parse_feed_args(args):
+    try:
+        since = int(args.get('since', 0))
+        limit = int(args.get('limit', DEFAULT_FEED_LIMIT))
+    except ValueError:
+        raise ValueError('since and limit must be integers')
+    return since, max(1, min(limit, MAX_FEED_LIMIT))
+
+
+class ChangesPruned(Exception):
+    """Raised when changes after `since` were pruned; the reader has to bootstrap again."""
+
+    def __init__(self, pruned_seq):
+        super().__init__(f'changes up to seq {pruned_seq} were pruned')
+        self.pruned_seq = pruned_seq
+
+
+def read_changes(session, since, limit):
+    """
+    Return the feed page after `since`: the changes in order plus the head
+    of the log. Raises ChangesPruned when some of them are gone.
+    """
+    pruned_seq = session.execute(text('SELECT seq FROM change_log_pruned WHERE id = 1')).scalar() or 0
+    if since < pruned_seq:
+        raise ChangesPruned(pruned_seq)
+    rows = session.execute(text(
+        'SELECT seq, entity, entity_id, op, data, created_at FROM change_log '
+        'WHERE seq > :since ORDER BY seq LIMIT :limit'), {'since': since, 'limit': limit}).all()
+    last_seq, _ = head(session)
+    changes = [{
+        'seq': row.seq,
+        'entity': row.entity,
+        'id': row.entity_id,
+        'op': row.op,
+        'data': json.loads(row.data) if row.data is not None else None,
+        'ts': row.created_at,
+    } for row in rows]
+    return {
+        'changes': changes,
+        'next_since': changes[-1]['seq'] if changes else since,
+        'last_seq': last_seq,
+        'now': time.time(),
+    }
+
+
+def parse_snapshot_args(args):
+    try:
+        after = int(args.get('after', 0))
+        limit = int(args.get('limit', DEFAULT_SNAPSHOT_CHUNK))
+    except ValueError:
+        raise ValueError('after and limit must be integers')
+    return after, max(1, min(limit, MAX_SNAPSHOT_CHUNK))
+
+
+def read_snapshot(session, model, after, limit):
+    """
+    Return one chunk of `model` rows with id > after, as column names plus
+    row arrays, and the head of the change log read before the rows. The
+    rows are at least as new as that sequence number, so replaying the log
+    from it on top of all the chunks converges on the primary's state.
+    """
+    last_seq, _ = head(session)
+    table = model.__table__
+    columns = [column.name for column in table.columns]
+    rows = session.execute(
+        select(*table.columns).where(table.c.id > after).order_by(table.c.id).limit(limit)).all()
+    return {
+        'columns': columns,
+        'rows': [list(row) for row in rows],
+        'next_after': rows[-1].id if len(rows) == limit else None,
+        'seq': last_seq,
+    }
+
+
+class ChangeLogPruner:
+    """
+    Keeps the change log from growing without bound. Each follower sends
+    its node name and position with every /changes poll (ack()). On a
+    background thread, every `interval` seconds, the pruner deletes the
+    entries that every follower has applied, and any entry older than
+    `retention` seconds, in chunks of `chunk_size`. A follower counts only
+    while it has polled within `retention`. The newest entry is always
+    kept, because it is the ETag of the catalog reads.
+
+    A follower whose position was pruned gets 410 from /changes and
+    bootstraps again from /snapshot.
+    """
+
+    def __init__(self, engine, retention=DEFAULT_RETENTION, interval=PRUNE_INTERVAL, chunk_size=PRUNE_CHUNK):
+        self.engine = engine
+        self.retention = retention
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pruned = 0
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_error = None
+        self._followers = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ack(self, node, seq):
+        """Record that follower `node` has applied every change up to `seq`."""
+        with self._lock:
+            self._followers[node] = (seq, time.time())
+
+    def _acked_seq(self, now):
+        """Lowest position of the followers seen within the retention window, or None."""
+        with self._lock:
+            live = [seq for seq, seen in self._followers.values() if seen > now - self.retention]
+        return min(live) if live else None
+
+    def prune_once(self, now=None):
+        """Delete every entry that is no longer needed; returns how many."""
+        now = now or time.time()
+        acked = self._acked_seq(now)
+        with self.engine.connect() as conn:
+            head_seq = conn.exec_driver_sql('SELECT MAX(seq) FROM change_log').scalar() or 0
+            # Entries are appended in time order, so the old ones are a prefix
+            first_recent = conn.exec_driver_sql(
+                'SELECT seq FROM change_log WHERE created_at >= ? ORDER BY seq LIMIT 1',
+                (now - self.retention,)).scalar()
+        expired = first_recent - 1 if first_recent is not None else head_seq
+        through = min(head_seq - 1, max(expired, acked or 0))
+        deleted = 0
+        while True:
+            with self.engine.begin() as conn:
+                last = conn.exec_driver_sql(
+                    'SELECT MAX(seq) FROM (SELECT seq FROM change_log WHERE seq <= ? ORDER BY seq LIMIT ?)',
+                    (through, self.chunk_size)).scalar()
+                if last is None:
+                    break
+                deleted += conn.exec_driver_sql('DELETE FROM change_log WHERE seq <= ?', (last,)).rowcount
+                conn.exec_driver_sql('UPDATE change_log_pruned SET seq = MAX(seq, ?) WHERE id = 1', (last,))
+        with self._lock:
+            self.pruned += deleted
+            self.runs += 1
+            self.last_run = time.time()
+        return deleted
+
+    def _run(self):
+        while True:
+            try:
+                self.prune_once()
+            except Exception as exc:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = str(exc)
+            time.sleep(self.interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='change-log-pruner', daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'retention': self.retention,
+                'followers': {node: {'seq': seq, 'seen': seen} for node, (seq, seen) in self._followers.items()},
+                'pruned': self.pruned,
+                'runs': self.runs,
+                'errors': self.errors,
+                'last_run': self.last_run,
+                'last_error': self.last_error,
+            }
+
+    def collect_metrics(self):
+        """Registry collector exposing the prune counters on /metrics."""
+        stats = self.stats()
+        yield 'change_log_pruned_total', 'counter', 'Change log entries deleted by retention.', [({}, stats['pruned'])]
+        yield 'change_log_prune_errors_total', 'counter', 'Change log prune runs that failed.', [({}, stats['errors'])]
+
+
+def _upsert_sql(table, columns):
+    # An upsert rather than INSERT OR REPLACE so update triggers (FTS) fire
+    updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column != 'id')
+    return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}")
+
+
+class ReplicationFollower:
+    """
+    Pulls the primary's /changes feed and applies each page in one
+    transaction on the replica, together with the sequence number it
+    reached, so a restart resumes where the last commit left off.
+    `tables` maps primary table names to (replica table, columns), in the
+    order they are bootstrapped.
+
+    A new replica first copies a snapshot with bootstrap(): chunks of
+    /snapshot/<entity> are bulk inserted one transaction each, with a
+    checkpoint so an interrupted bootstrap resumes at the next chunk. Then
+    it follows the feed from the sequence number the snapshot started at.
+    Polls carry `node`, so the primary knows which changes it may prune; a
+    replica that fell behind the pruned part of the log bootstraps again.
+    """
+
+    def __init__(self, engine, primary_url, tables, batch_size=DEFAULT_FEED_LIMIT,
+                 poll_interval=POLL_INTERVAL, timeout=5.0, node='replica'):
+        self.engine = engine
+        self.primary_url = primary_url.rstrip('/')
+        self.node = node
+        self.tables = tables
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.primary_seq = 0
+        self.primary_clock_offset = 0.0
+        self.oldest_pending_ts = None
+        self.last_poll = None
+        self.applied_total = 0
+        self.errors = 0
+        self.last_error = None
+        self.bootstrap_rows = 0
+        self.bootstrap_seconds = 0.0
+        self.rebootstraps = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        with engine.begin() as conn:
+            conn.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS replication_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    applied_seq INTEGER NOT NULL,
+                    applied_ts REAL,
+                    updated_at REAL NOT NULL
+                )""")
+            conn.exec_driver_sql(
+                'INSERT OR IGNORE INTO replication_state VALUES (1, 0, NULL, ?)', (time.time(),))
+            conn.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS bootstrap_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    snapshot_seq INTEGER,
+                    entity TEXT,
+                    after_id INTEGER NOT NULL,
+                    copied INTEGER NOT NULL,
+                    completed INTEGER NOT NULL
+                )""")
+            conn.exec_driver_sql('INSERT OR IGNORE INTO bootstrap_state VALUES (1, NULL, NULL, 0, 0, 0)')
+
+    def applied(self):
+        with self.engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                'SELECT applied_seq, applied_ts FROM replication_state WHERE id = 1').first()
+        return row[0], row[1]
+
+    def _apply(self, conn, change):
+        target = self.tables.get(change['entity'])
+        if target is None:
+            return
+        table, columns = target
+        if change['op'] == 'delete':
+            conn.exec_driver_sql(f'DELETE FROM {table} WHERE id = ?', (change['id'],))
+            return
+        data = change['data']
+        conn.exec_driver_sql(_upsert_sql(table, columns), tuple(data.get(column) for column in columns))
+
+    def bootstrap_state(self):
+        with self.engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                'SELECT snapshot_seq, entity, after_id, copied, completed FROM bootstrap_state WHERE id = 1').first()
+        return {'snapshot_seq': row[0], 'entity': row[1], 'after_id': row[2],
+                'copied': row[3], 'completed': bool(row[4])}
+
+    @property
+    def bootstrapped(self):
+        return self.bootstrap_state()['completed']
+
+    def _finish_bootstrap(self, snapshot_seq):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('UPDATE bootstrap_state SET completed = 1 WHERE id = 1')
+            if snapshot_seq is not None:
+                conn.exec_driver_sql(
+                    'UPDATE replication_state SET applied_seq = ?, updated_at = ? WHERE id = 1',
+                    (snapshot_seq, time.time()))
+
+    def restart_bootstrap(self):
+        """Forget the replica's position so the next bootstrap() copies a fresh snapshot."""
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                'UPDATE bootstrap_state SET snapshot_seq = NULL, entity = NULL, after_id = 0, '
+                'copied = 0, completed = 0 WHERE id = 1')
+            conn.exec_driver_sql(
+                'UPDATE replication_state SET applied_seq = 0, applied_ts = NULL, updated_at = ? WHERE id = 1',
+                (time.time(),))
+        self.rebootstraps += 1
+
+    def bootstrap(self, chunk_size=DEFAULT_SNAPSHOT_CHUNK):
+        """Copy the primary's tables chunk by chunk, resuming from the checkpoint."""
+        state = self.bootstrap_state()
+        if state['completed']:
+            return
+        if state['snapshot_seq'] is None and self.applied()[0] > 0:
+            # Already following the feed, which carries the full data set
+            self._finish_bootstrap(None)
+            return
+        entities = list(self.tables)
+        snapshot_seq = state['snapshot_seq']
+        if snapshot_seq is not None and state['entity'] is None:
+            # Every chunk is in; stopped just before the hand-off
+            self._finish_bootstrap(snapshot_seq)
+            return
+        start_entity = entities.index(state['entity']) if state['entity'] else 0
+        after = state['after_id']
+        started = time.monotonic()
+        copied = 0
+        for position in range(start_entity, len(entities)):
+            entity = entities[position]
+            table, columns = self.tables[entity]
+            while True:
+                response = self.http.get(f'{self.primary_url}/snapshot/{entity}',
+                                         params={'after': after, 'limit': chunk_size},
+                                         timeout=self.timeout)
+                response.raise_for_status()
+                page = response.json()
+                positions = [page['columns'].index(column) for column in columns]
+                rows = [tuple(row[index] for index in positions) for row in page['rows']]
+                if page['next_after'] is not None:
+                    checkpoint = (entity, page['next_after'])
+                elif position + 1 < len(entities):
+                    checkpoint = (entities[position + 1], 0)
+                else:
+                    checkpoint = (None, 0)
+                with self.engine.begin() as conn:
+                    if snapshot_seq is None:
+                        # A fresh bootstrap replaces whatever the replica held
+                        snapshot_seq = page['seq']
+                        for other_table, _ in self.tables.values():
+                            conn.exec_driver_sql(f'DELETE FROM {other_table}')
+                    if rows:
+                        conn.exec_driver_sql(_upsert_sql(table, columns), rows)
+                    conn.exec_driver_sql(
+                        'UPDATE bootstrap_state SET snapshot_seq = ?, entity = ?, after_id = ?, '
+                        'copied = copied + ? WHERE id = 1', (snapshot_seq, checkpoint[0], checkpoint[1], len(rows)))
+                copied += len(rows)
+                self.bootstrap_rows = copied
+                self.bootstrap_seconds = time.monotonic() - started
+                if page['next_after'] is None:
+                    break
+                after = page['next_after']
+            after = 0
+        self._finish_bootstrap(snapshot_seq)
+        self.bootstrap_seconds = time.monotonic() - started
+        print(f'Replica bootstrap copied {copied} rows in {self.bootstrap_seconds:.2f}s '
+              f'({self.bootstrap_rate():.0f} rows/s), following changes from seq {snapshot_seq}')
+
+    def bootstrap_rate(self):
+        return self.bootstrap_rows / self.bootstrap_seconds if self.bootstrap_seconds else 0.0
+
+    def apply_batch(self, changes):
+        """Apply changes past the stored sequence number in one transaction; return how many."""
+        with self.engine.begin() as conn:
+            # Take the write lock first so two followers cannot apply the same page
+            conn.exec_driver_sql('UPDATE replication_state SET updated_at = updated_at WHERE id = 1')
+            applied_seq = conn.exec_driver_sql(
+                'SELECT applied_seq FROM replication_state WHERE id = 1').scalar()
+            pending = [change for change in changes if change['seq'] > applied_seq]
+            for change in pending:
+                self._apply(conn, change)
+            if pending:
+                conn.exec_driver_sql(
+                    'UPDATE replication_state SET applied_seq = ?, applied_ts = ?, updated_at = ? WHERE id = 1',
+                    (pending[-1]['seq'], pending[-1]['ts'], time.time()))
+        return len(pending)
+
+    def poll_once(self):
+        """
+        Fetch and apply one page; return the number of changes applied.
+        When the primary has pruned changes this replica still needs, the
+        bootstrap is restarted instead.
+        """
+        applied_seq, _ = self.applied()
+        response = self.http.get(f'{self.primary_url}/changes',
+                                 params={'since': applied_seq, 'limit': self.batch_size, 'node': self.node},
+                                 timeout=self.timeout)
+        if response.status_code == 410:
+            self.restart_bootstrap()
+            return 0
+        response.raise_for_status()
+        page = response.json()
+        self.primary_seq = page['last_seq']
+        self.primary_clock_offset = page['now'] - time.time()
+        changes = page['changes']
+        if changes:
+            self.oldest_pending_ts = changes[0]['ts']
+        count = self.apply_batch(changes)
+        # Until the next poll the first change still pending is not known
+        self.oldest_pending_ts = None
+        self.applied_total += count
+        self.last_poll = time.time()
+        return count
+
+    def _run(self):
+        while True:
+            try:
+                # Returns at once when done; a failed chunk resumes from the checkpoint
+                self.bootstrap()
+                # Keep pulling full pages without sleeping while catching up
+                while self.poll_once() == self.batch_size:
+                    pass
+            except Exception as exc:
+                self.errors += 1
+                self.last_error = str(exc)
+            time.sleep(self.poll_interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='catalog-replication', daemon=True)
+                self._thread.start()
+
+    def status(self):
+        applied_seq, applied_ts = self.applied()
+        lag_seq = max(0, self.primary_seq - applied_seq)
+        # Age of the oldest change not applied yet, on the primary's clock;
+        # between polls the last applied change stands in for it
+        oldest = self.oldest_pending_ts or applied_ts
+        if lag_seq == 0:
+            lag_seconds = 0.0
+        elif oldest is None:
+            lag_seconds = None
+        else:
+            lag_seconds = max(0.0, time.time() + self.primary_clock_offset - oldest)
+        return {
+            'primary': self.primary_url,
+            'applied_seq': applied_seq,
+            'primary_seq': self.primary_seq,
+            'lag_seq': lag_seq,
+            'lag_seconds': lag_seconds,
+            'applied_total': self.applied_total,
+            'last_poll': self.last_poll,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'rebootstraps': self.rebootstraps,
+            'bootstrap': dict(self.bootstrap_state(), copied_this_run=self.bootstrap_rows,
+                              seconds=round(self.bootstrap_seconds, 3),
+                              rows_per_second=round(self.bootstrap_rate(), 1)),
+        }
+
+    def collect_metrics(self):
+        """Registry collector exposing replication lag on /metrics."""
+        status = self.status()
+        yield 'replication_lag_seq', 'gauge', 'Changes on the primary not yet applied here.', [({}, status['lag_seq'])]
+        if status['lag_seconds'] is not None:
+            yield 'replication_lag_seconds', 'gauge', 'Age of the oldest change not yet applied here.', [({}, status['lag_seconds'])]
+        yield 'replication_bootstrap_rows_per_second', 'gauge', 'Rows per second copied by the last bootstrap.', [({}, status['bootstrap']['rows_per_second'])]
+        yield 'replication_applied_seq', 'gauge', 'Last primary change sequence applied here.', [({}, status['applied_seq'])]
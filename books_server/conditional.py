@@ -0,0 +1,31 @@
+from datetime import datetime, timezone
+
+from flask import jsonify, make_response, request
+
+
+def row_etag(row):
+    """Strong validator of one versioned row."""
+    return f'{row.id}.{row.version}'
+
+
+def feed_etag(seq):
+    """
+    Weak validator for lists and searches: the change sequence number the
+    data was read at. Any write changes it, so it is coarse but never stale.
+    """
+    return f's{seq}'
+
+
+def respond(build, etag, updated_at=None, weak=False):
+    """
+    Answer 304 with no body when the request's If-None-Match already has
+    `etag`; otherwise call build() for the JSON payload. Both carry ETag
+    and, when known, Last-Modified.
+    """
+    # If-None-Match always compares weakly (RFC 9110)
+    matches = request.if_none_match.contains_weak(etag)
+    response = make_response('', 304) if matches else jsonify(build())
+    response.set_etag(etag, weak=weak)
+    if updated_at:
+        response.last_modified = datetime.fromtimestamp(updated_at, timezone.utc)
+    return response
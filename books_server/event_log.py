@@ -0,0 +1,186 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, has_request_context, request
+
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_ROTATE_INTERVAL = 24 * 3600
+DEFAULT_BACKUPS = 5
+
+
+def request_id():
+    """The X-Request-ID of the current request, or a new id kept for the rest of it."""
+    if 'request_id' not in g:
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    return g.request_id
+
+
+def request_fields():
+    """Request id, route and elapsed time of the request being served, if any."""
+    if not has_request_context():
+        return {}
+    fields = {'request_id': request_id(), 'method': request.method, 'path': request.path}
+    start = g.get('metrics_start')
+    if start is not None:
+        fields['latency_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return fields
+
+
+class AsyncLog:
+    """
+    JSON lines log written by a background thread. log() only puts the record
+    on a bounded queue; when the queue is full the record is dropped and
+    counted instead of blocking the request. The writer appends whole
+    batches and rotates the file by size and by age, keeping `backups` old
+    files as path.1 .. path.N. The age counts from the file's first record,
+    so restarting the server does not postpone rotation.
+    """
+
+    def __init__(self, path, max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_bytes=DEFAULT_MAX_BYTES,
+                 rotate_interval=DEFAULT_ROTATE_INTERVAL, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._created_at = 0.0
+        # close() at exit may run while the writer thread is mid-batch
+        self._write_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.write_errors = 0
+        self._writer = threading.Thread(target=self._run, name=f'log-writer:{path}', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def log(self, event, **fields):
+        """Queue one record; request id and latency are added inside a request."""
+        record = {'ts': datetime.now().isoformat(), 'event': event}
+        record.update(request_fields())
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._created_at = self._first_record_time()
+
+    def _first_record_time(self):
+        """
+        When the file was started: the ts of its first record, or its mtime
+        for lines that are not ours; now for a new or empty file.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as existing:
+                first = existing.readline()
+        except OSError:
+            first = ''
+        if not first:
+            return time.time()
+        try:
+            return datetime.fromisoformat(json.loads(first)['ts']).timestamp()
+        except (ValueError, TypeError, KeyError):
+            return os.path.getmtime(self.path)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = f'{self.path}.{index}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.path}.{index + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self._open()
+
+    def _write(self, batch):
+        with self._write_lock:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        if self._file is None:
+            self._open()
+        if (self._file.tell() >= self.max_bytes
+              or time.time() - self._created_at >= self.rotate_interval):
+            self._rotate()
+        self._file.write(''.join(json.dumps(record, default=str) + '\n' for record in batch))
+        self._file.flush()
+        self.written += len(batch)
+        self.batches += 1
+
+    def _drain(self, block):
+        """Take up to batch_size records, waiting up to flush_interval for the first."""
+        batch = []
+        try:
+            batch.append(self._queue.get(block, self.flush_interval if block else None))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain(block=True)
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except OSError:
+                # Keep serving requests; the records of this batch are lost
+                self.write_errors += 1
+                self.dropped += len(batch)
+                self._file = None
+
+    def close(self):
+        """Write whatever is still queued; called at interpreter exit."""
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                break
+            try:
+                self._write(batch)
+            except OSError:
+                self.dropped += len(batch)
+                break
+        with self._write_lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'rotations': self.rotations,
+            'write_errors': self.write_errors,
+        }
+
+    def collect_metrics(self):
+        """Registry collector exposing the log counters on /metrics."""
+        labels = {'path': self.path}
+        stats = self.stats()
+        yield 'log_records_written_total', 'counter', 'Log records written to disk.', [(labels, stats['written'])]
+        yield 'log_records_dropped_total', 'counter', 'Log records dropped because the queue was full or a write failed.', [(labels, stats['dropped'])]
+        yield 'log_queue_depth', 'gauge', 'Log records waiting for the writer.', [(labels, stats['queued'])]
@@ -0,0 +1,189 @@
+import bisect
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import Response, g, request
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            yield self.name, tuple(zip(self.labelnames, labelvalues)), value
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observing costs one bisect and a few adds."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Per-bucket counts plus one overflow slot, then sum
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(labelvalues, list(values)) for labelvalues, values in self._series.items()]
+        for labelvalues, values in series:
+            labels = tuple(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+            yield f'{self.name}_sum', labels, values[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register a callable evaluated at scrape time. It yields
+        (name, kind, documentation, [(labels dict, value), ...]) tuples,
+        for values that already live elsewhere such as cache counters.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds', 'Time spent serving HTTP requests.',
+    ['route', 'method', 'status'])
+UPSTREAM_LATENCY = registry.histogram(
+    'upstream_request_duration_seconds', 'Time spent in calls to other services.',
+    ['upstream', 'method', 'status'])
+DB_TRANSACTION_LATENCY = registry.histogram(
+    'db_transaction_duration_seconds', 'Time from BEGIN to COMMIT or ROLLBACK.',
+    ['outcome'])
+
+
+def instrument_flask(app):
+    """Time every request and serve the registry on /metrics."""
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - start, route, request.method, str(response.status_code))
+        return response
+
+    @app.get('/metrics')
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+def instrument_engine(engine):
+    """Record SQLAlchemy transaction durations of an engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'begin')
+    def _begin(conn):
+        conn.info['metrics_txn_start'] = time.perf_counter()
+
+    def _end(outcome):
+        def listener(conn):
+            start = conn.info.pop('metrics_txn_start', None)
+            if start is not None:
+                DB_TRANSACTION_LATENCY.observe(time.perf_counter() - start, outcome)
+        return listener
+
+    event.listen(engine, 'commit', _end('commit'))
+    event.listen(engine, 'rollback', _end('rollback'))
+
+
+def record_upstream(response, *args, **kwargs):
+    """requests response hook timing calls to other services."""
+    url = urlsplit(response.request.url)
+    upstream = f'{url.scheme}://{url.netloc}'
+    UPSTREAM_LATENCY.observe(
+        response.elapsed.total_seconds(), upstream, response.request.method, str(response.status_code))
+    return response
@@ -0,0 +1,47 @@
+from sqlalchemy import select
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def parse_page_args(args, allowed_fields):
+    """
+    Read limit, after and fields from the query string.
+
+    - limit: page size (default 100, max 1000)
+    - after: id of the last row of the previous page (default 0)
+    - fields: comma separated columns to return (default all allowed)
+    """
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        after = int(args.get('after', 0))
+    except ValueError:
+        raise ValueError('limit and after must be integers')
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    raw_fields = args.get('fields')
+    if raw_fields:
+        fields = [field.strip() for field in raw_fields.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    else:
+        fields = list(allowed_fields)
+    return limit, after, fields
+
+
+def fetch_page(session, model, limit, after, fields):
+    """
+    Return (rows as dicts, next_after) for rows with id > after, selecting
+    only the requested columns so no ORM objects are built.
+    """
+    columns = [getattr(model, field) for field in fields]
+    if 'id' not in fields:
+        columns.append(model.id)
+    # One extra row tells whether there is a next page
+    rows = session.execute(
+        select(*columns).where(model.id > after).order_by(model.id).limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{field: row._mapping[field] for field in fields} for row in rows]
+    next_after = rows[-1].id if more else None
+    return items, next_after
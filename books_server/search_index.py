@@ -0,0 +1,82 @@
+import re
+
+from sqlalchemy import text
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def ensure_search_index(conn, table):
+    """
+    Create an FTS5 index over `table`.name kept in sync by triggers, and
+    fill it from the existing rows the first time. Returns False when the
+    SQLite build has no FTS5, in which case callers fall back to LIKE.
+    """
+    fts = f'{table}_fts'
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).first()
+    if exists is None:
+        try:
+            # unicode61 folds case and, with remove_diacritics, accents
+            conn.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5(name, content='{table}', "
+                f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        except Exception as exc:
+            if 'fts5' in str(exc):
+                return False
+            raise
+        conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name);
+        END""")
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name);
+        END""")
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF name ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name);
+        END""")
+    return True
+
+
+def match_expression(search_string):
+    """Turn free text into an FTS5 query: every token must match as a prefix."""
+    tokens = TOKEN_RE.findall(search_string.lower())
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def parse_limit(raw):
+    try:
+        limit = int(raw) if raw is not None else DEFAULT_LIMIT
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def search(session, table, search_string, limit, fts_enabled=True):
+    """
+    Return the best matching rows (id, name, count, price) of `table`,
+    most relevant first.
+    """
+    expression = match_expression(search_string)
+    if not expression:
+        return []
+    if fts_enabled:
+        return session.execute(text(
+            f"SELECT {table}.id, {table}.name, {table}.count, {table}.price "
+            f"FROM {table}_fts JOIN {table} ON {table}.id = {table}_fts.rowid "
+            f"WHERE {table}_fts MATCH :expression ORDER BY {table}_fts.rank LIMIT :limit"),
+            {'expression': expression, 'limit': limit}).all()
+    # Without FTS5 still honour the limit, and match on every token
+    tokens = TOKEN_RE.findall(search_string.lower())
+    conditions = ' AND '.join(f"lower({table}.name) LIKE :token{i}" for i in range(len(tokens)))
+    params = {f'token{i}': f'%{token}%' for i, token in enumerate(tokens)}
+    params['limit'] = limit
+    return session.execute(text(
+        f"SELECT id, name, count, price FROM {table} WHERE {conditions} ORDER BY id LIMIT :limit"),
+        params).all()
@@ -0,0 +1,194 @@
+import threading
+import time
+
+import requests
+from sqlalchemy import bindparam, text
+
+SYNC_INTERVAL = 1.0
+MAX_SYNC_BOOKS = 500
+
+
+def plan(count, nodes, primary_share, remote_share, want=0, primary_wants=0):
+    """
+    Decide how much of a book's stock moves between the primary and one
+    remote node. Each node aims at an equal share (`target`). A pending
+    purchase (`want` on the remote, `primary_wants` on the primary) may use
+    all of the other side's free stock; otherwise only the surplus over
+    its own target is moved. Returns (target, grant, release): `grant`
+    moves from the primary to the remote node, `release` asks the remote
+    node to hand stock back.
+    """
+    target = count // nodes
+    grant_for_purchase = min(max(0, want - remote_share), primary_share)
+    spare = max(0, primary_share - grant_for_purchase - target)
+    top_up = min(max(0, target - remote_share - grant_for_purchase), spare)
+    grant = grant_for_purchase + top_up
+    release = 0
+    if not grant:
+        short = max(0, primary_wants - primary_share)
+        if primary_share < target // 2 or short:
+            surplus = remote_share if short else max(0, remote_share - target)
+            release = min(surplus, max(short, target - primary_share))
+    return target, grant, release
+
+
+class EscrowClient:
+    """
+    Stock shares held by a catalog replica. The replica sells from its own
+    share with a local conditional UPDATE, so purchases never wait on the
+    primary. A background loop reports sales and releases to the primary
+    and tops up shares that run low; only a purchase that finds its share
+    empty makes a synchronous call for more.
+
+    All counters are cumulative, so a request or response lost in transit
+    is simply corrected by the next sync.
+
+    With `book_table` set, background syncs also report books that have no
+    share yet (as all zero counters), a batch at a time, so every book gets
+    its share without waiting for a purchase to find it empty.
+    """
+
+    def __init__(self, engine, primary_url, node, sync_interval=SYNC_INTERVAL, timeout=2.0, book_table=None):
+        self.engine = engine
+        self.book_table = book_table
+        self.primary_url = primary_url.rstrip('/')
+        self.node = node
+        self.sync_interval = sync_interval
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.syncs = 0
+        self.sync_errors = 0
+        self.last_sync = None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._seed_after = 0
+        with engine.begin() as conn:
+            conn.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS stock_share (
+                    book_id INTEGER PRIMARY KEY,
+                    granted_total INTEGER NOT NULL DEFAULT 0,
+                    sold_total INTEGER NOT NULL DEFAULT 0,
+                    released_total INTEGER NOT NULL DEFAULT 0,
+                    reported_sold INTEGER NOT NULL DEFAULT 0,
+                    reported_released INTEGER NOT NULL DEFAULT 0,
+                    target INTEGER NOT NULL DEFAULT 0
+                )""")
+
+    def take(self, session, book_id, qty):
+        """Sell qty from the local share inside the caller's transaction; False if it is too small."""
+        result = session.execute(text(
+            'UPDATE stock_share SET sold_total = sold_total + :qty WHERE book_id = :id '
+            'AND granted_total - sold_total - released_total >= :qty'), {'id': book_id, 'qty': qty})
+        return result.rowcount == 1
+
+    def shares(self, session, book_ids):
+        """{book_id: copies left in the local share} for `book_ids`, read in the caller's transaction."""
+        rows = session.execute(text(
+            'SELECT book_id, granted_total - sold_total - released_total FROM stock_share '
+            'WHERE book_id IN :ids').bindparams(bindparam('ids', expanding=True)), {'ids': list(book_ids)})
+        return {book_id: 0 for book_id in book_ids} | dict(rows.all())
+
+    def _pending_rows(self, conn, book_ids):
+        columns = 'book_id, granted_total, sold_total, released_total'
+        if book_ids is not None:
+            found = {row[0]: row for row in conn.exec_driver_sql(
+                f"SELECT {columns} FROM stock_share WHERE book_id IN ({', '.join('?' for _ in book_ids)})",
+                tuple(book_ids))}
+            return [found.get(book_id, (book_id, 0, 0, 0)) for book_id in book_ids]
+        # Unreported sales or releases, and shares under half their target
+        rows = conn.exec_driver_sql(
+            f'SELECT {columns} FROM stock_share WHERE sold_total != reported_sold '
+            f'OR released_total != reported_released '
+            f'OR 2 * (granted_total - sold_total - released_total) < target LIMIT ?',
+            (MAX_SYNC_BOOKS,)).all()
+        if self.book_table and len(rows) < MAX_SYNC_BOOKS:
+            # Books without a share yet, walked in id order; the scan starts
+            # over once it runs dry, picking up new books and retrying any
+            # the primary did not know about
+            unshared = [row[0] for row in conn.exec_driver_sql(
+                f'SELECT id FROM {self.book_table} WHERE id > ? '
+                f'AND id NOT IN (SELECT book_id FROM stock_share) ORDER BY id LIMIT ?',
+                (self._seed_after, MAX_SYNC_BOOKS - len(rows)))]
+            self._seed_after = unshared[-1] if unshared else 0
+            rows += [(book_id, 0, 0, 0) for book_id in unshared]
+        return rows
+
+    def sync(self, book_ids=None, want=None):
+        """
+        Report sales and releases for `book_ids` (default: every share that
+        needs it) and apply the grants and release requests in the answer.
+        """
+        want = want or {}
+        with self.engine.connect() as conn:
+            rows = self._pending_rows(conn, book_ids)
+        books = [{'id': row[0], 'granted_total': row[1], 'sold_total': row[2],
+                  'released_total': row[3], 'want': want.get(row[0], 0)} for row in rows]
+        response = self.http.post(f'{self.primary_url}/stock/sync',
+                                  json={'node': self.node, 'books': books}, timeout=self.timeout)
+        response.raise_for_status()
+        reported = {book['id']: book for book in books}
+        with self.engine.begin() as conn:
+            for answer in response.json()['books']:
+                sent = reported.get(answer['id'], {})
+                conn.exec_driver_sql(
+                    'INSERT INTO stock_share (book_id, granted_total, target) VALUES (?, ?, ?) '
+                    'ON CONFLICT(book_id) DO UPDATE SET '
+                    'granted_total = MAX(granted_total, excluded.granted_total), target = excluded.target',
+                    (answer['id'], answer['granted_total'], answer['target']))
+                if sent:
+                    conn.exec_driver_sql(
+                        'UPDATE stock_share SET reported_sold = ?, reported_released = ? WHERE book_id = ?',
+                        (sent['sold_total'], sent['released_total'], answer['id']))
+                if answer['release']:
+                    # Hand back what is still unsold; reported on the next sync
+                    conn.exec_driver_sql(
+                        'UPDATE stock_share SET released_total = released_total + '
+                        'MIN(?, granted_total - sold_total - released_total) WHERE book_id = ?',
+                        (answer['release'], answer['id']))
+                    self._wake.set()
+        self.syncs += 1
+        self.last_sync = time.time()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+            try:
+                self.sync()
+            except Exception as exc:
+                self.sync_errors += 1
+                self.last_error = str(exc)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stock-escrow', daemon=True)
+                self._thread.start()
+
+    def allocation(self, book_ids=None):
+        """Local shares (all books, or `book_ids`) plus the totals and sync counters."""
+        with self.engine.connect() as conn:
+            totals = conn.exec_driver_sql(
+                'SELECT COUNT(*), COALESCE(SUM(granted_total - sold_total - released_total), 0), '
+                'COALESCE(SUM(sold_total - reported_sold), 0) FROM stock_share').first()
+            shares = []
+            if book_ids:
+                shares = [{
+                    'id': row[0], 'share': row[1] - row[2] - row[3], 'granted_total': row[1],
+                    'sold_total': row[2], 'released_total': row[3], 'target': row[4],
+                } for row in conn.exec_driver_sql(
+                    'SELECT book_id, granted_total, sold_total, released_total, target FROM stock_share '
+                    f"WHERE book_id IN ({', '.join('?' for _ in book_ids)})", tuple(book_ids))]
+        return {
+            'node': self.node,
+            'books': totals[0],
+            'share': totals[1],
+            'unreported_sold': totals[2],
+            'shares': shares,
+            'syncs': self.syncs,
+            'sync_errors': self.sync_errors,
+            'last_sync': self.last_sync,
+            'last_error': self.last_error,
+        }
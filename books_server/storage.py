@@ -0,0 +1,93 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the
+# single writer; NORMAL is durable across application crashes in WAL mode.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,       # ms to wait for the write lock before "database is locked"
+    'cache_size': -16000,       # negative means KiB, so 16 MB of page cache
+    'mmap_size': 134217728,     # 128 MB of the file read through mmap
+    'temp_store': 'MEMORY',
+}
+
+# Read-only connections cannot change the journal mode or take the write lock
+READ_ONLY_PRAGMAS = {
+    'busy_timeout': PRAGMAS['busy_timeout'],
+    'cache_size': PRAGMAS['cache_size'],
+    'mmap_size': PRAGMAS['mmap_size'],
+    'query_only': 1,
+}
+
+
+def _set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def configure_sqlite(engine, pragmas=PRAGMAS):
+    """
+    Apply the storage pragmas to every connection of `engine`. Call it
+    before the engine is first used so no connection misses them.
+    """
+    _set_pragmas(engine, pragmas)
+    # Connections opened before this point would not have the pragmas
+    engine.dispose()
+
+
+def ensure_columns(conn, *models):
+    """
+    Add columns declared on the models that an existing table lacks, with
+    their server default; create_all() never alters existing tables.
+    """
+    for model in models:
+        table = model.__table__
+        quote = conn.dialect.identifier_preparer.quote
+        existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({quote(table.name)})')}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = (f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} '
+                   f'{column.type.compile(conn.dialect)}')
+            if column.server_default is not None:
+                ddl += f' DEFAULT {column.server_default.arg}'
+            if not column.nullable and column.server_default is not None:
+                ddl += ' NOT NULL'
+            conn.exec_driver_sql(ddl)
+
+
+def ensure_indexes(conn, *models):
+    """Create the indexes declared on the models; create_all() skips existing tables."""
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def read_only_engine(engine):
+    """
+    Return an engine opening read-only connections to the database file of
+    `engine`. In WAL mode these read the last committed state without
+    waiting on writers.
+    """
+    read_engine = create_engine(f'sqlite:///file:{engine.url.database}?mode=ro&uri=true')
+    _set_pragmas(read_engine, READ_ONLY_PRAGMAS)
+    return read_engine
+
+
+def read_only_session(app, engine):
+    """
+    Return a session on read_only_engine(engine) for GET endpoints,
+    removed at the end of every request.
+    """
+    session = scoped_session(sessionmaker(bind=read_only_engine(engine)))
+
+    @app.teardown_appcontext
+    def _remove_read_session(exc):
+        session.remove()
+
+    return session
@@ -0,0 +1,136 @@
+"""
+Compare the default SQLite setup with the storage profile in storage.py.
+
+Reader threads look books up by id and by catalog while writer threads
+take stock with the same conditional UPDATE as /books/<id>/purchase.
+
+    python storage_bench.py [--books 20000] [--readers 8] [--writers 2] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+import storage
+
+SCHEMA = """
+    CREATE TABLE catalog (id INTEGER PRIMARY KEY, name VARCHAR);
+    CREATE TABLE book (id INTEGER PRIMARY KEY, name VARCHAR, count INTEGER, price FLOAT,
+                       catalog_id INTEGER REFERENCES catalog(id));
+"""
+INDEXES = """
+    CREATE INDEX ix_book_name ON book (name);
+    CREATE INDEX ix_book_catalog_id ON book (catalog_id);
+"""
+CATALOGS = 50
+
+
+def build_database(path, books, indexed):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA + (INDEXES if indexed else ''))
+    conn.executemany('INSERT INTO catalog VALUES (?, ?)',
+                     [(i, f'catalog {i}') for i in range(1, CATALOGS + 1)])
+    conn.executemany('INSERT INTO book VALUES (?, ?, ?, ?, ?)',
+                     [(i, f'book {i}', 1000000, 10.0, i % CATALOGS + 1) for i in range(1, books + 1)])
+    conn.commit()
+    conn.close()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(profile, args):
+    path = os.path.join(tempfile.mkdtemp(), f'{profile}.db')
+    tuned = profile == 'tuned'
+    build_database(path, args.books, indexed=tuned)
+    write_engine = create_engine(f'sqlite:///{path}')
+    if tuned:
+        storage.configure_sqlite(write_engine)
+        read_engine = storage.read_only_engine(write_engine)
+    else:
+        read_engine = write_engine
+
+    stop = threading.Event()
+    results = {'reads': 0, 'writes': 0, 'errors': 0, 'read_latency': [], 'write_latency': []}
+    lock = threading.Lock()
+
+    def reader():
+        rng = random.Random()
+        reads, errors, latency = 0, 0, []
+        with read_engine.connect() as conn:
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    if rng.random() < 0.8:
+                        conn.execute(text('SELECT id, name, count FROM book WHERE id = :id'),
+                                     {'id': rng.randint(1, args.books)}).first()
+                    else:
+                        conn.execute(text('SELECT id, name FROM book WHERE catalog_id = :c'),
+                                     {'c': rng.randint(1, CATALOGS)}).all()
+                    conn.commit()
+                    reads += 1
+                    latency.append(time.perf_counter() - start)
+                except Exception:
+                    conn.rollback()
+                    errors += 1
+        with lock:
+            results['reads'] += reads
+            results['errors'] += errors
+            results['read_latency'] += latency
+
+    def writer():
+        rng = random.Random()
+        writes, errors, latency = 0, 0, []
+        with write_engine.connect() as conn:
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    conn.execute(text('UPDATE book SET count = count - 1 WHERE id = :id AND count >= 1'),
+                                 {'id': rng.randint(1, args.books)})
+                    conn.commit()
+                    writes += 1
+                    latency.append(time.perf_counter() - start)
+                except Exception:
+                    conn.rollback()
+                    errors += 1
+        with lock:
+            results['writes'] += writes
+            results['errors'] += errors
+            results['write_latency'] += latency
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    write_engine.dispose()
+    read_engine.dispose()
+
+    print(f"{profile:>8}: {results['reads'] / args.seconds:9.0f} reads/s "
+          f"(p99 {percentile(results['read_latency'], 0.99) * 1000:6.2f} ms)  "
+          f"{results['writes'] / args.seconds:7.0f} writes/s "
+          f"(p99 {percentile(results['write_latency'], 0.99) * 1000:6.2f} ms)  "
+          f"{results['errors']} errors")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--books', type=int, default=20000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    for profile in ('default', 'tuned'):
+        run(profile, args)
@@ -0,0 +1,59 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# The catalog modules are imported flat, as the services run them.
+# Other services have modules of the same name (metrics, storage, ...), so
+# forget their copies when this directory's tests are collected.
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+for name, module in list(sys.modules.items()):
+    path = os.path.dirname(getattr(module, '__file__', None) or '')
+    if os.path.dirname(path) == os.path.dirname(SERVICE_DIR) and path != SERVICE_DIR:
+        del sys.modules[name]
+
+
+@pytest.fixture(scope='session')
+def catalog(tmp_path_factory):
+    """
+    The primary catalog server module, with its database and log in a
+    temporary directory. The log opens its file lazily, so the directory
+    stays current for the session.
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('catalog'))
+    try:
+        yield importlib.import_module('book_server')
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def client(catalog):
+    return catalog.app.test_client()
+
+
+@pytest.fixture
+def make_book(client):
+    """Create a catalog and a book through the API; returns the book id."""
+    def make(count, price=5.0, name='book'):
+        client.post('/catalogs', data={'name': 'c'})
+        response = client.post('/books', data={'name': name, 'catalog': 1, 'count': count, 'price': price})
+        return response.get_json()['book_id']
+    return make
+
+
+@pytest.fixture(scope='session')
+def standalone_replica(catalog):
+    """The catalog replica module with an empty CATALOG_PRIMARY_URL, in the primary's directory."""
+    previous = os.environ.get('CATALOG_PRIMARY_URL')
+    os.environ['CATALOG_PRIMARY_URL'] = ''
+    try:
+        return importlib.import_module('book_server_replica')
+    finally:
+        if previous is None:
+            del os.environ['CATALOG_PRIMARY_URL']
+        else:
+            os.environ['CATALOG_PRIMARY_URL'] = previous
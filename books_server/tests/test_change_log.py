@@ -0,0 +1,92 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import change_log
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)')
+        change_log.ensure_change_log(conn, {'item': ('id', 'name')})
+    return engine
+
+
+def write(engine, *names):
+    with engine.begin() as conn:
+        for name in names:
+            conn.exec_driver_sql('INSERT INTO item (name) VALUES (?)', (name,))
+
+
+def seqs(engine):
+    with engine.connect() as conn:
+        return [row[0] for row in conn.exec_driver_sql('SELECT seq FROM change_log ORDER BY seq')]
+
+
+def test_entries_past_retention_are_pruned_but_the_newest_is_kept(engine):
+    write(engine, 'a', 'b', 'c')
+    pruner = change_log.ChangeLogPruner(engine, retention=60, chunk_size=2)
+    assert pruner.prune_once() == 0
+    assert pruner.prune_once(now=time.time() + 120) == 2
+    assert seqs(engine) == [3]
+
+
+def test_entries_every_live_follower_applied_are_pruned(engine):
+    write(engine, 'a', 'b', 'c', 'd')
+    pruner = change_log.ChangeLogPruner(engine, retention=60)
+    pruner.ack('east', 3)
+    pruner.ack('west', 2)
+    assert pruner.prune_once() == 2
+    assert seqs(engine) == [3, 4]
+    # A follower that stopped polling no longer holds entries back
+    assert pruner.prune_once(now=time.time() + 120) == 1
+
+
+def test_reading_pruned_changes_raises(engine):
+    write(engine, 'a', 'b', 'c')
+    pruner = change_log.ChangeLogPruner(engine, retention=60)
+    pruner.ack('east', 2)
+    pruner.prune_once()
+    with Session(engine) as session:
+        with pytest.raises(change_log.ChangesPruned) as exc:
+            change_log.read_changes(session, 1, 10)
+        assert exc.value.pruned_seq == 2
+        assert [change['seq'] for change in change_log.read_changes(session, 2, 10)['changes']] == [3]
+
+
+class PrunedFeed:
+    def get(self, url, params, timeout):
+        assert params['node'] == 'replica'
+        return SimpleNamespace(status_code=410)
+
+
+def test_follower_behind_the_pruned_log_bootstraps_again(tmp_path):
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    with replica.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE item_replica (id INTEGER PRIMARY KEY, name TEXT)')
+    follower = change_log.ReplicationFollower(replica, 'http://primary', {'item': ('item_replica', ('id', 'name'))})
+    follower._finish_bootstrap(5)
+    follower.http = PrunedFeed()
+
+    assert follower.poll_once() == 0
+    assert follower.applied()[0] == 0
+    assert not follower.bootstrapped
+    assert follower.status()['rebootstraps'] == 1
+
+
+def test_changes_endpoint_answers_410_for_pruned_positions(catalog, client, make_book):
+    make_book(1)
+    make_book(1)
+    head = client.get('/changes?since=0&node=replica').get_json()['last_seq']
+    catalog.change_log_pruner.ack('replica', head - 1)
+    catalog.change_log_pruner.prune_once()
+
+    response = client.get('/changes?since=0&node=replica')
+    assert response.status_code == 410
+    assert response.get_json()['pruned_seq'] == head - 1
+    assert client.get(f'/changes?since={head - 1}').get_json()['last_seq'] == head
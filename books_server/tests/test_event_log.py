@@ -0,0 +1,53 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from event_log import AsyncLog
+
+
+def write_first_line(path, line, age):
+    path.write_text(line + '\n', encoding='utf-8')
+    then = time.time() - age
+    os.utime(path, (then, then))
+
+
+def record(age=0):
+    return json.dumps({'ts': (datetime.now() - timedelta(seconds=age)).isoformat(), 'event': 'old'})
+
+
+def test_file_started_a_day_ago_is_rotated_on_the_next_write(tmp_path):
+    path = tmp_path / 'log.txt'
+    # Appended to a minute ago, but started two days ago
+    write_first_line(path, record(age=2 * 24 * 3600), age=60)
+    log = AsyncLog(str(path), rotate_interval=24 * 3600)
+    log._write([{'event': 'new'}])
+    assert log.rotations == 1
+    assert (tmp_path / 'log.txt.1').exists()
+    assert [json.loads(line)['event'] for line in path.read_text().splitlines()] == ['new']
+
+
+def test_recent_file_is_kept_across_restarts(tmp_path):
+    path = tmp_path / 'log.txt'
+    write_first_line(path, record(age=3600), age=0)
+    log = AsyncLog(str(path), rotate_interval=24 * 3600)
+    log._write([{'event': 'new'}])
+    assert log.rotations == 0
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_file_of_foreign_lines_ages_by_mtime(tmp_path):
+    path = tmp_path / 'log.txt'
+    write_first_line(path, 'user purchased book test_1', age=2 * 24 * 3600)
+    log = AsyncLog(str(path), rotate_interval=24 * 3600)
+    log._write([{'event': 'new'}])
+    assert log.rotations == 1
+
+
+def test_size_rotation_keeps_the_configured_backups(tmp_path):
+    path = tmp_path / 'log.txt'
+    log = AsyncLog(str(path), max_bytes=1, backups=2)
+    for index in range(4):
+        log._write([{'event': index}])
+    assert log.rotations == 3
+    assert sorted(os.listdir(tmp_path)) == ['log.txt', 'log.txt.1', 'log.txt.2']
@@ -0,0 +1,38 @@
+import pytest
+
+
+@pytest.fixture
+def replica(standalone_replica):
+    return standalone_replica.app_replica.test_client()
+
+
+def make_replica_book(replica, count):
+    replica.post('/catalogs', data={'name': 'c'})
+    response = replica.post('/books', data={'name': 'b', 'catalog': 1, 'count': count, 'price': 4.0})
+    assert response.status_code == 200
+    return response.get_json()['book_id']
+
+
+def test_standalone_replica_sells_from_its_own_count(standalone_replica, replica):
+    assert standalone_replica.escrow is None
+    book_id = make_replica_book(replica, 3)
+
+    answer = replica.post(f'/books/{book_id}/purchase', data={'qty': 2}).get_json()
+    assert answer['count'] == answer['books']['count'] == 1
+    assert replica.get(f'/books/{book_id}/stock/availability').get_json() == {'success': True, 'left': 1}
+    assert replica.post(f'/books/{book_id}/purchase', data={'qty': 2}).status_code == 403
+    assert replica.get(f'/books/{book_id}').get_json()['books']['count'] == 1
+
+
+def test_standalone_replica_sells_carts_all_or_nothing(replica):
+    first, second = make_replica_book(replica, 2), make_replica_book(replica, 1)
+
+    short = replica.post('/books/purchase', json={'items': [{'id': first}, {'id': second, 'qty': 2}]})
+    assert short.status_code == 403
+    assert short.get_json()['id'] == second
+    answer = replica.post('/books/purchase', json={'items': [{'id': first}, {'id': second}]}).get_json()
+    assert [book['count'] for book in answer['books']] == [1, 0]
+
+
+def test_standalone_replica_has_no_allocation(replica):
+    assert replica.get('/stock/allocation').status_code == 404
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+
+import stock_escrow
+
+
+def sync(client, node, books):
+    response = client.post('/stock/sync', json={'node': node, 'books': books})
+    assert response.status_code == 200
+    return {book['id']: book for book in response.get_json()['books']}
+
+
+def test_plan_grants_an_equal_share_to_an_empty_remote():
+    assert stock_escrow.plan(10, 2, primary_share=10, remote_share=0) == (5, 5, 0)
+
+
+def test_plan_grants_a_pending_purchase_beyond_the_target():
+    target, grant, release = stock_escrow.plan(10, 2, primary_share=5, remote_share=0, want=7)
+    assert (target, grant, release) == (5, 5, 0)
+
+
+def test_plan_asks_for_stock_back_when_the_primary_is_short():
+    # Enough for the purchase and for the primary's target
+    assert stock_escrow.plan(10, 2, primary_share=0, remote_share=10, primary_wants=3) == (5, 0, 5)
+
+
+def test_availability_excludes_escrowed_stock(client, make_book):
+    book_id = make_book(10)
+    granted = sync(client, 'replica', [{'id': book_id, 'granted_total': 0, 'sold_total': 0, 'released_total': 0}])
+    assert granted[book_id]['granted_total'] == 5
+
+    assert client.get(f'/books/{book_id}/stock/availability').get_json() == {'success': True, 'left': 5}
+    assert client.post(f'/books/{book_id}/purchase', data={'qty': 5}).status_code == 200
+    # The 5 copies left belong to the replica, so the primary cannot sell them
+    assert client.get(f'/books/{book_id}/stock/availability').status_code == 403
+    assert client.post(f'/books/{book_id}/purchase').status_code == 403
+
+
+def test_purchase_answers_count_only_the_primary_share(client, make_book):
+    book_id, other_id = make_book(10), make_book(4)
+    sync(client, 'replica', [{'id': id, 'granted_total': 0, 'sold_total': 0, 'released_total': 0}
+                             for id in (book_id, other_id)])
+
+    answer = client.post(f'/books/{book_id}/purchase', data={'qty': 2}).get_json()
+    assert answer['count'] == answer['books']['count'] == 3
+    answer = client.post('/books/purchase', json={'items': [{'id': book_id}, {'id': other_id}]}).get_json()
+    assert [book['count'] for book in answer['books']] == [2, 1]
+
+
+def test_sync_settles_remote_sales(client, make_book):
+    book_id = make_book(4)
+    sync(client, 'replica', [{'id': book_id, 'granted_total': 0, 'sold_total': 0, 'released_total': 0}])
+    answer = sync(client, 'replica', [{'id': book_id, 'granted_total': 2, 'sold_total': 2, 'released_total': 0}])
+
+    assert answer[book_id]['count'] == 2
+    assert client.get(f'/books/{book_id}').get_json()['books']['count'] == 2
+
+
+class PrimaryOverTestClient:
+    """Stands in for the escrow client's requests.Session, posting to the primary's test client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def post(self, url, json, timeout):
+        response = self.client.post(url.split('127.0.0.1', 1)[1], json=json)
+        assert response.status_code == 200
+        return SimpleNamespace(raise_for_status=lambda: None, json=response.get_json)
+
+
+def test_background_sync_seeds_shares_for_every_book(client, make_book, tmp_path):
+    book_ids = [make_book(10), make_book(4)]
+    engine = create_engine(f'sqlite:///{tmp_path / "replica.db"}')
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE book_replica (id INTEGER PRIMARY KEY)')
+        conn.exec_driver_sql(f"INSERT INTO book_replica (id) VALUES {', '.join(f'({id})' for id in book_ids)}")
+    escrow = stock_escrow.EscrowClient(engine, 'http://127.0.0.1', 'seeded', book_table='book_replica')
+    escrow.http = PrimaryOverTestClient(client)
+
+    escrow.sync()
+    shares = {share['id']: share['share'] for share in escrow.allocation(book_ids)['shares']}
+    assert shares == {book_ids[0]: 5, book_ids[1]: 2}
+    # Nothing is left to seed, so the next scan starts over from the lowest id
+    with engine.connect() as conn:
+        assert escrow._pending_rows(conn, None) == []
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `burst`."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Take a token; return 0 on success or the seconds until one is available."""
+        # A bucket created after `now` was read must not start in debt
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = max(self.updated, now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class KeyedRateLimiter:
+    """One token bucket per key (client, item), keeping the most recent max_keys."""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_keys:
+                # The oldest key has been idle the longest, its bucket is full
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+class Rejected(Exception):
+    """Raised when a request is shed; retry_after is in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Token-bucket limits per client and per item in front of a cap on the
+    requests in flight. Requests over the cap wait in a short bounded queue;
+    anything beyond that is rejected right away.
+    """
+
+    def __init__(self, client_rate, client_burst, item_rate, item_burst,
+                 max_in_flight, max_queued, queue_timeout):
+        self.clients = KeyedRateLimiter(client_rate, client_burst)
+        self.items = KeyedRateLimiter(item_rate, item_burst)
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.shed = {'client_rate': 0, 'item_rate': 0, 'queue_full': 0, 'queue_timeout': 0}
+
+    def _reject(self, reason, retry_after, refund=()):
+        # Do not charge the client or the items for a request that never ran
+        for bucket in refund:
+            bucket.refund()
+        self.shed[reason] += 1
+        raise Rejected(reason, retry_after)
+
+    def acquire(self, client, *items):
+        """
+        Admit a request for one or more items (a cart takes a token from
+        each) or raise Rejected. Call release() when it is done.
+        """
+        with self._lock:
+            now = time.monotonic()
+            client_bucket = self.clients.bucket(client)
+            wait = client_bucket.take(now)
+            if wait:
+                self._reject('client_rate', wait)
+            taken = [client_bucket]
+            for item in items:
+                bucket = self.items.bucket(item)
+                wait = bucket.take(now)
+                if wait:
+                    self._reject('item_rate', wait, taken)
+                taken.append(bucket)
+
+            if self.in_flight >= self.max_in_flight:
+                if self.queued >= self.max_queued:
+                    self._reject('queue_full', self.queue_timeout, taken)
+                self.queued += 1
+                self.queued_total += 1
+                deadline = now + self.queue_timeout
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject('queue_timeout', self.queue_timeout, taken)
+                        self._slot_freed.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._slot_freed.notify()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'queued_total': self.queued_total,
+                'shed': dict(self.shed),
+                'limits': {
+                    'client_rate': self.clients.rate,
+                    'client_burst': self.clients.burst,
+                    'item_rate': self.items.rate,
+                    'item_burst': self.items.burst,
+                    'max_in_flight': self.max_in_flight,
+                    'max_queued': self.max_queued,
+                    'queue_timeout': self.queue_timeout,
+                },
+            }
@@ -0,0 +1,231 @@
+import itertools
+import threading
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from http_client import get_client
+
+# Passive ejection: a node is taken out of rotation after this many
+# consecutive failures and stays out until a health probe succeeds or the
+# ejection window runs out
+EJECT_AFTER_FAILURES = 3
+EJECT_SECONDS = 10.0
+PROBE_INTERVAL = 2.0
+PROBE_TIMEOUT = (0.5, 1.0)
+EWMA_DECAY = 0.3
+
+
+class Node:
+    """Runtime state of one backend replica."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.last_error = None
+
+    def is_ejected(self, now):
+        return self.ejected_until > now
+
+    def stats(self, now):
+        return {
+            'url': self.url,
+            'healthy': not self.is_ejected(now),
+            'outstanding': self.outstanding,
+            'ewma_latency_ms': None if self.ewma_latency is None else round(self.ewma_latency * 1000, 3),
+            'requests': self.requests,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'ejections': self.ejections,
+            'last_error': self.last_error,
+        }
+
+
+class RoundRobinPolicy:
+    name = 'round_robin'
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def order(self, nodes):
+        start = next(self._counter) % len(nodes)
+        return nodes[start:] + nodes[:start]
+
+
+class LeastOutstandingPolicy(RoundRobinPolicy):
+    name = 'least_outstanding'
+
+    def order(self, nodes):
+        # Rotate first so that ties are spread instead of always hitting the
+        # first replica; sorted() is stable
+        return sorted(super().order(nodes), key=lambda node: node.outstanding)
+
+
+class EwmaLatencyPolicy(RoundRobinPolicy):
+    name = 'ewma'
+
+    def order(self, nodes):
+        # Expected wait is the smoothed latency times the queue in front of
+        # us. Nodes without samples score 0 so they get measured.
+        def score(node):
+            if node.ewma_latency is None:
+                return 0.0
+            return node.ewma_latency * (node.outstanding + 1)
+        return sorted(super().order(nodes), key=score)
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (RoundRobinPolicy, LeastOutstandingPolicy, EwmaLatencyPolicy)
+}
+
+
+def is_connect_failure(exc):
+    """True if the request never reached the backend, so any method may be resent."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class Balancer:
+    """Pick a replica per request and fail over to the others."""
+
+    def __init__(self, name, urls, policy='ewma', health_path='health',
+                 eject_after=EJECT_AFTER_FAILURES, eject_seconds=EJECT_SECONDS,
+                 probe_interval=PROBE_INTERVAL):
+        self.name = name
+        self.nodes = [Node(url) for url in urls]
+        self.policy = POLICIES[policy]()
+        self.health_path = health_path
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def candidates(self):
+        """Healthy nodes in policy order, followed by ejected ones as a last resort."""
+        now = time.monotonic()
+        with self._lock:
+            healthy = [node for node in self.nodes if not node.is_ejected(now)]
+            ejected = [node for node in self.nodes if node.is_ejected(now)]
+            ordered = self.policy.order(healthy) if healthy else []
+        return ordered + sorted(ejected, key=lambda node: node.ejected_until)
+
+    def _begin(self, node):
+        with self._lock:
+            node.outstanding += 1
+            node.requests += 1
+
+    def _succeed(self, node, elapsed):
+        with self._lock:
+            node.outstanding -= 1
+            node.consecutive_failures = 0
+            node.ejected_until = 0.0
+            if node.ewma_latency is None:
+                node.ewma_latency = elapsed
+            else:
+                node.ewma_latency += EWMA_DECAY * (elapsed - node.ewma_latency)
+
+    def _fail(self, node, error, in_flight=True):
+        with self._lock:
+            if in_flight:
+                node.outstanding -= 1
+            node.failures += 1
+            node.consecutive_failures += 1
+            node.last_error = error
+            if node.consecutive_failures >= self.eject_after:
+                if not node.is_ejected(time.monotonic()):
+                    node.ejections += 1
+                node.ejected_until = time.monotonic() + self.eject_seconds
+
+    def request(self, method, path, idempotent=None, **kwargs):
+        """
+        Send a request to the best replica.
+
+        GETs fail over on any transport error or 5xx; other methods only
+        when the connection could not be established, unless the caller
+        passes idempotent=True, e.g. for a POST with an Idempotency-Key.
+        Returns (server_url, response).
+        """
+        self.start_health_checks()
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        last_exc = None
+        last = None
+        for node in self.candidates():
+            self._begin(node)
+            start = time.monotonic()
+            try:
+                response = get_client(node.url).request(method, path, **kwargs)
+            except requests.exceptions.RequestException as exc:
+                self._fail(node, str(exc))
+                last_exc = exc
+                if idempotent or is_connect_failure(exc):
+                    continue
+                raise
+            if response.status_code >= 500:
+                self._fail(node, f'HTTP {response.status_code}')
+                last = (node.url, response)
+                if idempotent:
+                    continue
+                return last
+            self._succeed(node, time.monotonic() - start)
+            return node.url, response
+        if last is not None:
+            return last
+        raise last_exc
+
+    def probe(self):
+        """Actively check every node and readmit or eject it."""
+        for node in list(self.nodes):
+            try:
+                response = get_client(node.url).get(self.health_path, timeout=PROBE_TIMEOUT)
+                ok = response.status_code == 200
+                error = None if ok else f'health HTTP {response.status_code}'
+            except requests.exceptions.RequestException as exc:
+                ok = False
+                error = str(exc)
+            if ok:
+                with self._lock:
+                    node.consecutive_failures = 0
+                    node.ejected_until = 0.0
+            else:
+                # Probes fail the node immediately; there is no need to wait
+                # for client traffic to run into it
+                with self._lock:
+                    node.consecutive_failures = max(node.consecutive_failures, self.eject_after - 1)
+                self._fail(node, error, in_flight=False)
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probe()
+
+    def start_health_checks(self):
+        if self._prober is not None:
+            return
+        with self._lock:
+            if self._prober is None:
+                self._prober = threading.Thread(
+                    target=self._probe_loop, name=f'{self.name}-health', daemon=True)
+                self._prober.start()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'name': self.name,
+                'policy': self.policy.name,
+                'nodes': [node.stats(now) for node in self.nodes],
+            }
@@ -0,0 +1,349 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def deep_sizeof(value):
+    """Approximate memory held by a decoded JSON value, in bytes."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_sizeof(key) + deep_sizeof(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += deep_sizeof(item)
+    return size
+
+
+class CacheEntry:
+    __slots__ = ('value', 'size', 'expires_at', 'stale_until', 'negative')
+
+    def __init__(self, value, size, expires_at, stale_until, negative):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+        self.negative = negative
+
+
+class _Flight:
+    """A backend load in progress that other requests can wait on."""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CacheNamespace:
+    """
+    LRU cache for one kind of entry, bounded by bytes and expired by TTL.
+
+    An entry is fresh for `ttl` seconds, then may still be served stale for
+    `stale_ttl` seconds while a background refresh runs. Negative entries
+    (not found, empty results) live for `negative_ttl` seconds.
+
+    With a `shared` SharedCache the namespace is the L1 in front of it:
+    L1 misses are looked up in the shared L2, stores go to both and
+    invalidations are broadcast to the other worker processes.
+    """
+
+    def __init__(self, name, ttl, max_bytes, stale_ttl=0, negative_ttl=0, shared=None):
+        self.name = name
+        self.shared = shared
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._flights = {}
+        # Bumped on every invalidation so a load that raced with one does
+        # not store the data it fetched before the change
+        self._generation = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.l2_hits = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+    def lookup(self, key):
+        """Return (value, stale). A miss returns (None, False)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stale_until <= now:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                generation = self._generation
+            else:
+                self._entries.move_to_end(key)
+                if entry.negative:
+                    self.negative_hits += 1
+                if entry.expires_at <= now:
+                    self.stale_hits += 1
+                    return entry.value, True
+                self.hits += 1
+                return entry.value, False
+        if self.shared is None:
+            return None, False
+        found = self.shared.get(self.name, key)
+        if found is None:
+            return None, False
+        value, expires_in, stale_for, negative = found
+        size = deep_sizeof(key) + deep_sizeof(value)
+        with self._lock:
+            self.l2_hits += 1
+            if generation == self._generation:
+                self._store(key, value, size, negative, expires_in, stale_for)
+        return value, expires_in <= 0
+
+    def get(self, key):
+        """Return the value only if it is fresh."""
+        value, stale = self.lookup(key)
+        return None if stale else value
+
+    def _peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                return None
+            return entry.value
+
+    def load(self, key, loader):
+        """
+        Run loader() for a missed key, sharing the result with every
+        concurrent caller missing on the same key (single flight).
+
+        loader returns (value, kind) where kind is 'positive', 'negative',
+        or None for values that must not be cached (backend errors).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self.generation
+                self.loads += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            # Another leader may have filled the entry just before we
+            # registered our flight
+            value = self._peek(key)
+            if value is None:
+                value, kind = loader()
+                if kind is not None:
+                    self.set(key, value, negative=kind == 'negative',
+                             generation=generation)
+            flight.value = value
+            return value
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _refresh(self, key, loader):
+        try:
+            self.load(key, loader)
+        except Exception:
+            # Keep serving the stale value, the next lookup retries
+            with self._lock:
+                self.refresh_errors += 1
+
+    def refresh(self, key, loader):
+        """Reload a stale key in the background unless a load is already running."""
+        with self._lock:
+            if key in self._flights:
+                return False
+            self.refreshes += 1
+        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+        return True
+
+    @property
+    def generation(self):
+        """Token to pass to set() for values read from the backend after this point."""
+        return self._generation, self.shared.last_seq if self.shared is not None else None
+
+    def _store(self, key, value, size, negative, expires_in, stale_for):
+        """Insert into the local LRU; the caller holds the lock."""
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            # A single entry larger than the whole budget would flush
+            # everything else and still not fit
+            self.rejected += 1
+            return False
+        while self._entries and self.bytes + size > self.max_bytes:
+            _, oldest = self._entries.popitem(last=False)
+            self.bytes -= oldest.size
+            self.evictions += 1
+        now = time.monotonic()
+        self._entries[key] = CacheEntry(
+            value, size, now + expires_in, now + expires_in + stale_for, negative)
+        self.bytes += size
+        return True
+
+    def set(self, key, value, negative=False, generation=None):
+        """
+        Store a value. When `generation` is given the value is dropped if
+        an invalidation happened since it was read.
+        """
+        if negative:
+            # Negative entries are never served stale, an item created
+            # in the meantime must show up once they expire
+            ttl, stale_ttl = self.negative_ttl, 0
+        else:
+            ttl, stale_ttl = self.ttl, self.stale_ttl
+        local_generation, seen_seq = generation if generation is not None else (None, None)
+        size = deep_sizeof(key) + deep_sizeof(value)
+        with self._lock:
+            if local_generation is not None and local_generation != self._generation:
+                return False
+            stored = self._store(key, value, size, negative, ttl, stale_ttl)
+        if stored and self.shared is not None:
+            self.shared.set(self.name, key, value, ttl, stale_ttl, negative, seen_seq=seen_seq)
+        return stored
+
+    def drop_local(self, key=None):
+        """Forget a key (or everything) in this process only."""
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+                self.bytes = 0
+                return True
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def pop(self, key):
+        dropped = self.drop_local(key)
+        if self.shared is not None:
+            self.shared.invalidate(self.name, key)
+        return dropped
+
+    def pop_many(self, keys):
+        """Forget several keys under one lock and one shared write; returns how many were cached."""
+        with self._lock:
+            self._generation += 1
+            dropped = [key for key in keys if key in self._entries]
+            for key in dropped:
+                self._remove(key)
+        if self.shared is not None:
+            self.shared.invalidate_many(self.name, keys)
+        return len(dropped)
+
+    def clear(self):
+        self.drop_local()
+        if self.shared is not None:
+            self.shared.invalidate(self.name)
+
+    def keys(self):
+        """Snapshot of the cached keys, least recently used first."""
+        with self._lock:
+            return list(self._entries)
+
+    def peek(self, key):
+        """
+        Return the servable entry for a key without touching LRU order or
+        hit counters, for inspection.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.stale_until <= time.monotonic():
+                return None
+            return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'negative_ttl': self.negative_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected': self.rejected,
+                'loads': self.loads,
+                'coalesced': self.coalesced,
+                'l2_hits': self.l2_hits,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'loads_in_flight': len(self._flights),
+            }
+
+
+class NamespacedCache:
+    """Front tier cache keyed by (namespace, key), e.g. ('info', 12)."""
+
+    def __init__(self, namespaces, shared=None):
+        self.shared = shared
+        self.namespaces = {
+            name: CacheNamespace(
+                name, config['ttl'], config['max_bytes'],
+                stale_ttl=config.get('stale_ttl', 0),
+                negative_ttl=config.get('negative_ttl', 0),
+                shared=shared)
+            for name, config in namespaces.items()
+        }
+        if shared is not None:
+            shared.subscribe(self._on_shared_invalidation)
+
+    def _on_shared_invalidation(self, namespace, key):
+        if namespace in self.namespaces:
+            self.namespaces[namespace].drop_local(key)
+
+    def __getitem__(self, name):
+        return self.namespaces[name]
+
+    def get(self, namespace, key):
+        return self.namespaces[namespace].get(key)
+
+    def set(self, namespace, key, value):
+        return self.namespaces[namespace].set(key, value)
+
+    def invalidate(self, namespace, key):
+        return self.namespaces[namespace].pop(key)
+
+    def invalidate_many(self, namespace, keys):
+        return self.namespaces[namespace].pop_many(keys)
+
+    def stats(self):
+        return {name: ns.stats() for name, ns in self.namespaces.items()}
+
+    def shared_stats(self):
+        return self.shared.stats() if self.shared is not None else None
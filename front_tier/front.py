@@ -1,69 +1,244 @@
-from flask import Flask, request, jsonify
-import requests
-from cachetools import LRUCache
+from flask import Flask, Response, request, jsonify
+import json
+import math
+import os
 from flask_socketio import SocketIO
+import threading
 import time
+import uuid
+import requests
+from http_client import CONNECT_TIMEOUT, get_client, pool_stats
+from balancer import Balancer
+from cache import NamespacedCache
+from shared_cache import SharedCache
+from admission import AdmissionController, Rejected
+from metrics import instrument_flask, registry
 
 app = Flask(__name__)
 socketio = SocketIO(app)
-
-cache = LRUCache(maxsize=1000)
+instrument_flask(app)
+
+# Search results and book info live in separate namespaces, each with its
+# own expiry and memory budget. Search entries are list-valued and larger,
+# book info changes on every purchase so it expires sooner. Expired entries
+# are served for another stale_ttl seconds while they are refreshed in the
+# background; unknown ids and empty results are cached for negative_ttl.
+#
+# When several worker processes run on one host, point FRONT_L2_CACHE_PATH
+# at a file to share a second-level cache between them. Each process keeps
+# its LRU as L1, and invalidations reach the L1 of every worker.
+FRONT_L2_CACHE_PATH = os.environ.get('FRONT_L2_CACHE_PATH')
+cache = NamespacedCache({
+    'search': {'ttl': 60, 'stale_ttl': 120, 'negative_ttl': 5,
+               'max_bytes': 8 * 1024 * 1024},
+    'info': {'ttl': 30, 'stale_ttl': 30, 'negative_ttl': 5,
+             'max_bytes': 16 * 1024 * 1024},
+}, shared=SharedCache(FRONT_L2_CACHE_PATH) if FRONT_L2_CACHE_PATH else None)
 
 CATALOG_SERVER_IPS = ["http://127.0.0.1:4000", "http://127.0.0.1:4001"]
 ORDER_SERVER_URLS = ["http://127.0.0.1:3000", "http://127.0.0.1:3001"]
 
-# round robin algorithm to detect the server ip 
-server_indices = {
-    'search': 0,
-    'info': 0,
-    'purchase': 0
-}
+# Admission control for purchases. Each client and each item has a token
+# bucket. At most max_in_flight purchases run at once, a few more may wait
+# briefly, and the rest are refused with 429 so a flash sale cannot pile
+# up requests on the order and catalog servers.
+purchase_admission = AdmissionController(
+    client_rate=5, client_burst=10,
+    item_rate=50, item_burst=100,
+    max_in_flight=32, max_queued=64, queue_timeout=0.5)
+
+# Expired entries that carry the catalog's ETag are revalidated with
+# If-None-Match; a 304 renews them without transferring the body
+revalidations = {'not_modified': 0, 'modified': 0}
+revalidations_lock = threading.Lock()
+
+# Cache counters are read at scrape time for /metrics
+
+
+def collect_cache_metrics():
+    stats = cache.stats()
+    counters = [
+        ('hits', 'Fresh cache hits.'),
+        ('stale_hits', 'Hits served stale while refreshing.'),
+        ('misses', 'Cache misses.'),
+        ('evictions', 'Entries evicted to stay within the byte budget.'),
+        ('expirations', 'Entries dropped after their TTL.'),
+        ('coalesced', 'Misses that waited on another request for the same key.'),
+        ('l2_hits', 'Local misses answered by the shared L2 cache.'),
+    ]
+    for field, documentation in counters:
+        yield (f'front_cache_{field}_total', 'counter', documentation,
+               [({'namespace': name}, ns[field]) for name, ns in stats.items()])
+    yield ('front_cache_entries', 'gauge', 'Entries currently cached.',
+           [({'namespace': name}, ns['entries']) for name, ns in stats.items()])
+    yield ('front_cache_bytes', 'gauge', 'Approximate memory held by cached entries.',
+           [({'namespace': name}, ns['bytes']) for name, ns in stats.items()])
+    yield ('front_cache_revalidations_total', 'counter',
+           'Conditional refreshes of expired entries, by catalog answer.',
+           [({'result': result}, count) for result, count in revalidations.items()])
+
+
+registry.add_collector(collect_cache_metrics)
+
+
+def collect_admission_metrics():
+    stats = purchase_admission.stats()
+    yield ('front_purchase_shed_total', 'counter', 'Purchases refused with 429.',
+           [({'reason': reason}, count) for reason, count in stats['shed'].items()])
+    yield ('front_purchase_queued_total', 'counter', 'Purchases that waited for a slot.',
+           [({}, stats['queued_total'])])
+    yield ('front_purchase_in_flight', 'gauge', 'Purchases being processed.',
+           [({}, stats['in_flight'])])
+
+
+registry.add_collector(collect_admission_metrics)
+
+# Every purchase carries an Idempotency-Key, the client's or a new one, so
+# it can be resent to either order server without buying twice. Each try
+# gets FRONT_PURCHASE_TIMEOUT seconds before failing over; the purchase is
+# retried until FRONT_PURCHASE_DEADLINE while the order servers answer 409
+# (the key is still in progress) or 503.
+PURCHASE_TIMEOUT = float(os.environ.get('FRONT_PURCHASE_TIMEOUT', 2.0))
+PURCHASE_DEADLINE = float(os.environ.get('FRONT_PURCHASE_DEADLINE', 10.0))
+PURCHASE_RETRY_WAIT = 0.2
+RETRY_STATUSES = (409, 503)
+
+# Load balancers picking a replica per request. Catalog reads follow the
+# lowest smoothed latency, purchases the fewest requests in flight. Dead
+# replicas are ejected and requests fail over to the other one.
+catalog_balancer = Balancer('catalog', CATALOG_SERVER_IPS, policy='ewma')
+order_balancer = Balancer('order', ORDER_SERVER_URLS, policy='least_outstanding')
+
+
+def is_empty_result(data):
+    return isinstance(data, dict) and data.get('books') in ([], {})
+
+
+def fetch_from_server(key, endpoint, cached=None):
+    """
+    Fetch from the catalog, returning ((body, status, etag), cache kind).
+    With a `cached` value that has an ETag, the request is conditional and
+    a 304 keeps that value.
+    """
+    etag = cached[2] if cached is not None and len(cached) > 2 else None
+    headers = {'If-None-Match': etag} if etag else None
+    server_url, response = catalog_balancer.request('GET', endpoint, headers=headers)
+    if etag:
+        with revalidations_lock:
+            revalidations['not_modified' if response.status_code == 304 else 'modified'] += 1
+    if response.status_code == 304 and etag:
+        app.logger.info(f"Data not modified on server {server_url} for key: {key}")
+        return cached, 'negative' if is_empty_result(cached[0]) else 'positive'
+    if response.status_code == 200:
+        data = response.json()
+        app.logger.info(
+            f"Data retrieved from server {server_url} for key: {key}")
+        return (data, 200, response.headers.get('ETag')), 'negative' if is_empty_result(data) else 'positive'
+    if response.status_code == 404:
+        return (response.json(), 404, None), 'negative'
+    return ({'error': f'Server {server_url} failed to respond'}, 500, None), None
+
+
+def get_data_from_cache_or_server(key, endpoint, request_type):
+    """Return (body, status) for a catalog read, from the cache when possible."""
+    namespace = cache[request_type]
+    cached_data, stale = namespace.lookup(key)
+    if cached_data is not None:
+        if stale:
+            # Answer from the stale copy and revalidate it off the request path
+            namespace.refresh(key, lambda: fetch_from_server(key, endpoint, cached_data))
+        app.logger.info(f"Data retrieved from cache for key: {key}")
+        return cached_data[:2]
+    # Concurrent misses on the same key wait for a single catalog request
+    return namespace.load(key, lambda: fetch_from_server(key, endpoint))[:2]
 
 
-def get_order_server_url():
-    index = server_indices['purchase']
-    server_indices['purchase'] = (index + 1) % len(ORDER_SERVER_URLS)
-    return ORDER_SERVER_URLS[index]
+MAX_BATCH_IDS = 200
 
 
-def get_catalog_server_url(request_type):
-    index = server_indices[request_type]
-    server_indices[request_type] = (index + 1) % len(CATALOG_SERVER_IPS)
-    return CATALOG_SERVER_IPS[index]
+def parse_ids(raw):
+    """Parse '1,2,3' into a list of unique ints, keeping the given order."""
+    try:
+        ids = list(dict.fromkeys(int(part) for part in raw.split(',') if part.strip()))
+    except ValueError:
+        raise ValueError('ids must be a comma separated list of integers')
+    if not ids:
+        raise ValueError('no ids were provided')
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'at most {MAX_BATCH_IDS} ids per request')
+    return ids
 
 
-def get_data_from_cache_or_server(key, server_url, endpoint, request_type):
-    cached_data = cache.get(key)
-    if cached_data:
-        app.logger.info(f"Data retrieved from cache for key: {key}")
-        return cached_data
-    else:
-        response = requests.get(f"{server_url}/{endpoint}")
-        if response.status_code == 200:
-            data = response.json()
-            app.logger.info(f"Data retrieved from server {
-                            server_url} for key: {key}")
-            cache[key] = data  # Cache the data
-            return data
-        return {'error': f'Server {server_url} failed to respond'}, 500
-
-
-def invalidate_cache(key):
-    app.logger.info(f"Invalidating cache for key: {key}")
-    if key in cache:
-        cache.pop(key)
+def get_many_from_cache_or_server(ids):
+    """
+    Look up many books, serving hits from the info cache and fetching all
+    misses from the catalog in one batch request.
+    Returns ({id: book}, set of missing ids).
+    """
+    namespace = cache['info']
+    found = {}
+    missing = set()
+    misses = []
+    for item_id in ids:
+        cached_data, stale = namespace.lookup(item_id)
+        if cached_data is None:
+            misses.append(item_id)
+            continue
+        if stale:
+            namespace.refresh(item_id, lambda item_id=item_id, cached_data=cached_data: fetch_from_server(
+                item_id, f"books/{item_id}", cached_data))
+        data, status = cached_data[:2]
+        if status == 200:
+            found[item_id] = data['books']
+        else:
+            missing.add(item_id)
+    if not misses:
+        return found, missing
+
+    generation = namespace.generation
+    server_url, response = catalog_balancer.request(
+        'GET', 'books/batch', params={'ids': ','.join(map(str, misses))})
+    if response.status_code != 200:
+        raise RuntimeError(f'Server {server_url} failed to respond')
+    data = response.json()
+    app.logger.info(
+        f"Batch of {len(misses)} retrieved from server {server_url}")
+    # Fill the cache with the same entries /info/<id> would have stored
+    # (without an ETag: the batch only carries the catalog's sequence number)
+    for book in data['books']:
+        found[book['id']] = book
+        namespace.set(book['id'], ({'books': book}, 200, None), generation=generation)
+    for item_id in data['missing']:
+        missing.add(item_id)
+        namespace.set(item_id, ({'error': 'Book not found'}, 404, None),
+                      negative=True, generation=generation)
+    return found, missing
+
+
+def invalidate_cache(key, namespace='info'):
+    app.logger.info(f"Invalidating {namespace} cache for key: {key}")
+    if cache.invalidate(namespace, key):
         app.logger.info(f"Cache invalidated successfully for key: {key}")
     else:
         app.logger.warning(
             f"Key not found in the cache for invalidation: {key}")
 
-# Socket.io event handler for cache invalidation
+
+def invalidate_cache_many(keys, namespace='info'):
+    """Drop the entries of several books at once, e.g. after a cart purchase."""
+    dropped = cache.invalidate_many(namespace, keys)
+    app.logger.info(f"Invalidated {dropped} of {len(keys)} {namespace} cache entries")
+
+# Socket.io event handler for cache invalidation, of one key or a list of keys
 
 
 @socketio.on('cache_invalidate')
 def handle_cache_invalidate(message):
+    if message.get('keys'):
+        invalidate_cache_many(message['keys'], message.get('namespace', 'info'))
+        return
     key = message.get('key')
-    invalidate_cache(key)
+    invalidate_cache(key, message.get('namespace', 'info'))
     app.logger.info(f"Cache invalidated for key: {key}")
 
 # Socket.io event handler for handling catalog change
@@ -72,10 +247,17 @@ def handle_cache_invalidate(message):
 @socketio.on('catalog_change')
 def handle_catalog_change(message):
     catalog_info = message.get('catalog_info')
-    if catalog_info:
+    if catalog_info and catalog_info.get('ids'):
+        # One event per chunk of a bulk load
+        invalidate_cache_many(catalog_info['ids'])
+        cache['search'].clear()
+        app.logger.info(f"Received bulk catalog change for {len(catalog_info['ids'])} books")
+    elif catalog_info:
         key = catalog_info.get('id')
         if key:
             invalidate_cache(key)
+            # Any search result may include the changed entry
+            cache['search'].clear()
             socketio.emit('cache_invalidate', {
                           'key': key}, callback=handle_ack)
             app.logger.info(f"Received catalog change: {catalog_info}")
@@ -131,17 +313,15 @@ def search(item_type):
     """
     
     try:
-        server_url = get_catalog_server_url('search')
         start_time = time.time()
 
-        data = get_data_from_cache_or_server(
-            item_type, server_url, f"books/search/{item_type}", 'search')
+        data, status = get_data_from_cache_or_server(
+            item_type, f"books/search/{item_type}", 'search')
 
         end_time = time.time()
         response_time = end_time - start_time
-        print(f"Request to Catalog Server ({server_url})")
         print(f"Request processing time: {response_time} seconds")
-        return jsonify(data)
+        return jsonify(data), status
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -164,25 +344,81 @@ def info(item_number):
     - GET request: /info/123
     """
     try:
-        server_url = get_catalog_server_url('info')
         start_time = time.time()
 
-        data = get_data_from_cache_or_server(
-            item_number, server_url, f"books/{item_number}", 'info')
+        data, status = get_data_from_cache_or_server(
+            item_number, f"books/{item_number}", 'info')
 
         end_time = time.time()
         response_time = end_time - start_time
-        print(f"Request to Catalog Server ({server_url})")
         print(f"Request processing time: {response_time} seconds")
 
-        # Emit a socket.io event for cache invalidation
-        socketio.emit('cache_invalidate', {'key': item_number})
+        return jsonify(data), status
+    except Exception as e:
+        app.logger.error(f"Exception: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# Endpoint for retrieving information about many items in one request
+
 
-        return jsonify(data)
+@app.route('/info', methods=['GET'])
+def info_batch():
+    """
+    Retrieve information about several items in the catalog.
+
+    Input:
+    - ids: Comma separated item identifiers (query string)
+
+    Output:
+    - JSON response with the found items and the ids that do not exist
+
+    Example:
+    - GET request: /info?ids=1,2,3
+    """
+    try:
+        ids = parse_ids(request.args.get('ids', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        start_time = time.time()
+
+        found, missing = get_many_from_cache_or_server(ids)
+
+        end_time = time.time()
+        response_time = end_time - start_time
+        print(f"Request processing time: {response_time} seconds")
+
+        return jsonify({
+            'books': [found[item_id] for item_id in ids if item_id in found],
+            'found': [item_id for item_id in ids if item_id in found],
+            'missing': [item_id for item_id in ids if item_id in missing],
+        })
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Send a purchase with its Idempotency-Key, failing over and retrying until
+# an order server gives a final answer or PURCHASE_DEADLINE passes
+
+
+def send_purchase(path, key, **kwargs):
+    """Returns (server_url, response), or (None, None) when no answer came in time."""
+    deadline = time.monotonic() + PURCHASE_DEADLINE
+    headers = dict(kwargs.pop('headers', {}), **{'Idempotency-Key': key})
+    while True:
+        try:
+            server_url, response = order_balancer.request(
+                'POST', path, idempotent=True, headers=headers,
+                timeout=(CONNECT_TIMEOUT, PURCHASE_TIMEOUT), **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                return server_url, response
+        except requests.exceptions.RequestException as e:
+            app.logger.warning(f"Purchase {key} not answered: {e}")
+            server_url, response = None, None
+        if time.monotonic() + PURCHASE_RETRY_WAIT >= deadline:
+            return server_url, response
+        time.sleep(PURCHASE_RETRY_WAIT)
+
 # Endpoint for making a purchase request for a specific item
 
 
@@ -193,18 +429,29 @@ def purchase(item_id):
 
     Input:
     - item_id: The unique identifier of the item to purchase (integer)
+    - Idempotency-Key header (optional): Sending the request again with the
+      same key never buys twice; one is generated when it is missing
 
     Output:
-    - JSON response confirming the purchase
+    - JSON response confirming the purchase, with the Idempotency-Key header
 
     Example:
     - POST request: /purchase/456
     """
     try:
-        server_url = get_order_server_url()
+        purchase_admission.acquire(request.remote_addr, item_id)
+    except Rejected as e:
+        app.logger.warning(f"Purchase of {item_id} shed: {e.reason}")
+        return (jsonify({'error': 'Too many purchase requests', 'reason': e.reason}), 429,
+                {'Retry-After': str(max(1, math.ceil(e.retry_after)))})
+    key = request.headers.get('Idempotency-Key') or uuid.uuid4().hex
+    try:
         start_time = time.time()
 
-        response = requests.post(f"{server_url}/purchase/{item_id}")
+        server_url, response = send_purchase(f"purchase/{item_id}", key)
+        if response is None:
+            return (jsonify({'error': 'Order servers did not answer in time, retry with the same Idempotency-Key'}),
+                    504, {'Idempotency-Key': key})
         data = response.json()
         end_time = time.time()
         response_time = end_time - start_time
@@ -219,24 +466,206 @@ def purchase(item_id):
 
         app.logger.info(f"Response from order server {server_url}: {data}")
         print(f"Request to Order Server ({server_url})")
-        return jsonify(data)
+        return jsonify(data), response.status_code, {'Idempotency-Key': key}
+    except Exception as e:
+        app.logger.error(f"Exception: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        purchase_admission.release()
+
+# Endpoint for buying several items in one request
+
+
+@app.route('/purchase', methods=['POST'])
+def purchase_cart():
+    """
+    Buy a cart of items in one order server request, all or nothing.
+
+    Input:
+    - JSON body: {"items": [{"id": 1, "qty": 2}, {"id": 7}]}, qty defaults to 1
+    - Idempotency-Key header (optional), as for /purchase/<item_id>
+
+    Output:
+    - JSON response with one order line per item, or the 404/403 of the
+      first item that is unknown or out of stock, in which case nothing is bought
+
+    Example:
+    - POST request: /purchase with {"items": [{"id": 1, "qty": 2}, {"id": 3}]}
+    """
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items or not all(
+            isinstance(item, dict) and type(item.get('id')) is int for item in items):
+        return jsonify({'error': 'items must be a non-empty list of {"id", "qty"}'}), 400
+    item_ids = list(dict.fromkeys(item['id'] for item in items))
+    try:
+        purchase_admission.acquire(request.remote_addr, *item_ids)
+    except Rejected as e:
+        app.logger.warning(f"Cart purchase of {item_ids} shed: {e.reason}")
+        return (jsonify({'error': 'Too many purchase requests', 'reason': e.reason}), 429,
+                {'Retry-After': str(max(1, math.ceil(e.retry_after)))})
+    key = request.headers.get('Idempotency-Key') or uuid.uuid4().hex
+    try:
+        server_url, response = send_purchase("purchase", key, json=payload)
+        if response is None:
+            return (jsonify({'error': 'Order servers did not answer in time, retry with the same Idempotency-Key'}),
+                    504, {'Idempotency-Key': key})
+        data = response.json()
+
+        if response.status_code == 200:
+            # One batch invalidation for every item of the cart
+            invalidate_cache_many(item_ids)
+            socketio.emit('cache_invalidate', {'keys': item_ids})
+
+        app.logger.info(f"Response from order server {server_url}: {data}")
+        return jsonify(data), response.status_code, {'Idempotency-Key': key}
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        purchase_admission.release()
+
+# Endpoint to poll an order accepted with 202 by an order server
+
+
+@app.route('/orders/<string:order_id>', methods=['GET'])
+def order_status(order_id):
+    """
+    Status of an order: queued, processing, completed or failed. Orders
+    are kept by the order server that accepted them, so each is asked.
+
+    Example:
+    - GET request: /orders/3f2a...
+    """
+    for server_url in ORDER_SERVER_URLS:
+        try:
+            response = get_client(server_url).get(f"orders/{order_id}")
+        except requests.RequestException:
+            continue
+        if response.status_code != 404:
+            return jsonify(response.json()), response.status_code
+    return jsonify({'error': 'Order not found'}), 404
 
 # Endpoint to get all cached data
 
 
+MAX_CACHE_PAGE = 1000
+
+
+def cache_item(name, key, entry, now):
+    data, status = entry.value[:2]
+    return {
+        'key': f"{name}:{key}",
+        'status': status,
+        'bytes': entry.size,
+        'expires_in': round(entry.expires_at - now, 3),
+        'stale': entry.expires_at <= now,
+        'negative': entry.negative,
+        'data': data,
+    }
+
+
+def iter_cache_keys(prefix):
+    """Yield (namespace, key, 'namespace:key') for keys matching a prefix."""
+    for name, namespace in cache.namespaces.items():
+        if not (f"{name}:".startswith(prefix) or prefix.startswith(f"{name}:")):
+            continue
+        for key in namespace.keys():
+            full_key = f"{name}:{key}"
+            if full_key.startswith(prefix):
+                yield name, key, full_key
+
+
+def stream_cache_items(prefix, batch_size=100):
+    """Stream every matching entry as JSON lines, one small batch at a time."""
+    batch = []
+    for name, key, full_key in iter_cache_keys(prefix):
+        entry = cache[name].peek(key)
+        if entry is not None:
+            batch.append(json.dumps(cache_item(name, key, entry, time.monotonic())))
+        if len(batch) >= batch_size:
+            yield '\n'.join(batch) + '\n'
+            batch = []
+    if batch:
+        yield '\n'.join(batch) + '\n'
+
+
 @app.route('/cached_data', methods=['GET'])
 def get_cached_data():
+    """
+    Inspect the cache without dumping it in one response.
+
+    Input:
+    - prefix: Only keys starting with it, e.g. info: or search:har
+    - limit, cursor: Page size and the next_cursor of the previous page
+    - summary: If 1, only entry counts and byte sizes per namespace
+    - stream: If 1, stream every matching entry as JSON lines
+
+    Example:
+    - GET request: /cached_data?prefix=info:&limit=50
+    """
     try:
-        cached_data = {key: cache[key] for key in cache.keys()}
-        app.logger.info(f"All cached data: {cached_data}")
-        return jsonify(cached_data)
+        prefix = request.args.get('prefix', '')
+        if request.args.get('summary') == '1':
+            return jsonify({
+                name: {'entries': stats['entries'], 'bytes': stats['bytes'],
+                       'max_bytes': stats['max_bytes']}
+                for name, stats in cache.stats().items()
+            })
+        if request.args.get('stream') == '1':
+            return Response(stream_cache_items(prefix), mimetype='application/x-ndjson')
+
+        limit = max(1, min(int(request.args.get('limit', 100)), MAX_CACHE_PAGE))
+        cursor = request.args.get('cursor', '')
+        # Only the keys are sorted; values are read for the page alone
+        keys = sorted((full_key, name, key) for name, key, full_key in iter_cache_keys(prefix)
+                      if full_key > cursor)
+        items = []
+        now = time.monotonic()
+        for full_key, name, key in keys:
+            if len(items) >= limit:
+                break
+            entry = cache[name].peek(key)
+            if entry is not None:
+                items.append(cache_item(name, key, entry, now))
+        more = bool(items) and len(items) >= limit and keys[-1][0] > items[-1]['key']
+        app.logger.info(f"Returned {len(items)} cached entries after cursor {cursor!r}")
+        return jsonify({'items': items, 'next_cursor': items[-1]['key'] if more else None})
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
     except Exception as e:
         app.logger.error(f"Exception: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Endpoint to get hit, miss and eviction counters of every cache namespace
+
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'namespaces': cache.stats(), 'l2': cache.shared_stats(),
+                    'revalidations': dict(revalidations)})
+
+# Endpoint to get the purchase admission counters
+
+
+@app.route('/admission_stats', methods=['GET'])
+def get_admission_stats():
+    return jsonify(purchase_admission.stats())
+
+# Endpoint to inspect the connection pools towards the backends
+
+
+@app.route('/pool_stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify({'pools': pool_stats()})
+
+# Endpoint to inspect the load balancer state of every replica
+
+
+@app.route('/balancer_stats', methods=['GET'])
+def get_balancer_stats():
+    return jsonify({'balancers': [catalog_balancer.stats(), order_balancer.stats()]})
+
 
 # Run the Flask application on host 0.0.0.0 and port 5000 in debug mode
 if __name__ == '__main__':
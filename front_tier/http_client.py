@@ -0,0 +1,134 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import UPSTREAM_LATENCY
+
+# Defaults for every backend client, tuned for the catalog and order servers
+# running on the same host or the same docker network
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 5.0
+POOL_MAXSIZE = 20
+GET_RETRIES = 2
+RETRY_BACKOFF = 0.05
+
+
+class BackendClient:
+    """Keep-alive HTTP client bound to a single backend base URL."""
+
+    def __init__(self, base_url, pool_maxsize=POOL_MAXSIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 retries=GET_RETRIES):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+
+        # Only idempotent methods are retried after the request was sent;
+        # connection failures are retried for any method since nothing
+        # reached the backend yet
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=0,
+            backoff_factor=RETRY_BACKOFF,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+        self._errors = 0
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self._requests += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(
+                time.perf_counter() - start, self.base_url, method, status)
+            with self._lock:
+                self._in_flight -= 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def stats(self):
+        """Return request counters and the state of the underlying pool."""
+        opened = 0
+        served = 0
+        idle = 0
+        for pool_key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+            if pool.pool is not None:
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        with self._lock:
+            return {
+                'base_url': self.base_url,
+                'pool_maxsize': self.pool_maxsize,
+                'connections_opened': opened,
+                'connections_idle': idle,
+                'pool_requests': served,
+                'requests': self._requests,
+                'errors': self._errors,
+                'in_flight': self._in_flight,
+                'peak_in_flight': self._peak_in_flight,
+                'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            }
+
+
+# One shared client per backend so every Flask worker thread reuses the
+# same connection pool
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url):
+    """Return the shared client for a backend, creating it on first use."""
+    client = _clients.get(base_url)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(base_url)
+            if client is None:
+                client = BackendClient(base_url)
+                _clients[base_url] = client
+    return client
+
+
+def pool_stats():
+    return [client.stats() for client in list(_clients.values())]
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import threading
+import time
+
+POLL_INTERVAL = 0.2
+# Invalidations are kept long enough for every worker to have seen them
+INVALIDATION_RETENTION = 300
+PURGE_INTERVAL = 30
+
+
+class SharedCache:
+    """
+    Second-level cache in a SQLite file shared by every front tier worker
+    process on a host. Invalidations are appended to a sequenced table that
+    each process polls, so an invalidation received by one worker reaches
+    the process-local caches of all of them.
+    """
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.last_seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped_writes = 0
+        self.invalidations_applied = 0
+        self._local = threading.local()
+        self._subscribers = []
+        self._poller = None
+        self._lock = threading.Lock()
+
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entry (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    negative INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    stale_until REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_invalidation (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    namespace TEXT NOT NULL,
+                    key TEXT,
+                    created_at REAL NOT NULL
+                )""")
+        # Start after the invalidations that happened before this process
+        row = conn.execute('SELECT MAX(seq) FROM cache_invalidation').fetchone()
+        self.last_seq = row[0] or 0
+
+    def _conn(self):
+        # sqlite3 connections must stay on the thread that created them
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        """Return (value, expires_in, stale_for, negative) or None."""
+        row = self._conn().execute(
+            'SELECT value, negative, expires_at, stale_until FROM cache_entry '
+            'WHERE namespace = ? AND key = ?', (namespace, json.dumps(key))).fetchone()
+        now = time.time()
+        if row is None or row[3] <= now:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tuple(json.loads(row[0])), row[2] - now, row[3] - row[2], bool(row[1])
+
+    def set(self, namespace, key, value, ttl, stale_ttl, negative, seen_seq=None):
+        """
+        Store an entry. With `seen_seq`, the write is skipped if the key was
+        invalidated by any worker after that sequence number, so a load that
+        raced with an invalidation cannot reinstate old data.
+        """
+        now = time.time()
+        encoded_key = json.dumps(key)
+        params = (namespace, encoded_key, json.dumps(value), int(negative),
+                  now + ttl, now + ttl + stale_ttl)
+        conn = self._conn()
+        if seen_seq is None:
+            cursor = conn.execute(
+                'INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?, ?, ?, ?)', params)
+        else:
+            cursor = conn.execute(
+                'INSERT OR REPLACE INTO cache_entry '
+                'SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS ('
+                '  SELECT 1 FROM cache_invalidation WHERE seq > ? AND namespace = ? '
+                '  AND (key = ? OR key IS NULL))',
+                params + (seen_seq, namespace, encoded_key))
+        if cursor.rowcount:
+            self.writes += 1
+        else:
+            self.skipped_writes += 1
+
+    def invalidate(self, namespace, key=None):
+        """Drop a key (or the whole namespace) for every worker."""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if key is None:
+                conn.execute('DELETE FROM cache_entry WHERE namespace = ?', (namespace,))
+                conn.execute(
+                    'INSERT INTO cache_invalidation (namespace, key, created_at) VALUES (?, NULL, ?)',
+                    (namespace, now))
+            else:
+                encoded_key = json.dumps(key)
+                conn.execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?',
+                             (namespace, encoded_key))
+                conn.execute(
+                    'INSERT INTO cache_invalidation (namespace, key, created_at) VALUES (?, ?, ?)',
+                    (namespace, encoded_key, now))
+
+    def invalidate_many(self, namespace, keys):
+        """Drop several keys for every worker in one transaction."""
+        now = time.time()
+        encoded_keys = [json.dumps(key) for key in keys]
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('DELETE FROM cache_entry WHERE namespace = ? AND key = ?',
+                             [(namespace, key) for key in encoded_keys])
+            conn.executemany(
+                'INSERT INTO cache_invalidation (namespace, key, created_at) VALUES (?, ?, ?)',
+                [(namespace, key, now) for key in encoded_keys])
+
+    def subscribe(self, callback):
+        """Call callback(namespace, key) for each invalidation from any worker; key None means all."""
+        self._subscribers.append(callback)
+        self._start_poller()
+
+    def poll(self):
+        rows = self._conn().execute(
+            'SELECT seq, namespace, key FROM cache_invalidation WHERE seq > ? ORDER BY seq',
+            (self.last_seq,)).fetchall()
+        for seq, namespace, key in rows:
+            decoded = None if key is None else json.loads(key)
+            for callback in self._subscribers:
+                callback(namespace, decoded)
+            self.last_seq = seq
+            self.invalidations_applied += 1
+
+    def purge(self):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM cache_entry WHERE stale_until <= ?', (now,))
+            conn.execute('DELETE FROM cache_invalidation WHERE created_at <= ?',
+                         (now - INVALIDATION_RETENTION,))
+
+    def _poll_loop(self):
+        last_purge = time.monotonic()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+                if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                    self.purge()
+                    last_purge = time.monotonic()
+            except sqlite3.Error:
+                # The file is busy or briefly unavailable, retry next tick
+                continue
+
+    def _start_poller(self):
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(
+                    target=self._poll_loop, name='l2-cache-invalidations', daemon=True)
+                self._poller.start()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'skipped_writes': self.skipped_writes,
+            'last_seq': self.last_seq,
+            'invalidations_applied': self.invalidations_applied,
+        }
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+from front_fakes import FakeBalancer
+
+# The front tier modules are imported flat, as the service runs them.
+# Other services have modules of the same name (metrics, storage, ...), so
+# forget their copies when this directory's tests are collected.
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+for name, module in list(sys.modules.items()):
+    path = os.path.dirname(getattr(module, '__file__', None) or '')
+    if os.path.dirname(path) == os.path.dirname(SERVICE_DIR) and path != SERVICE_DIR:
+        del sys.modules[name]
+
+
+@pytest.fixture
+def front():
+    import front
+    for namespace in front.cache.namespaces.values():
+        namespace.drop_local()
+    return front
+
+
+@pytest.fixture
+def fake_catalog(front, monkeypatch):
+    def install(handler):
+        balancer = FakeBalancer(handler)
+        monkeypatch.setattr(front, 'catalog_balancer', balancer)
+        return balancer
+    return install
@@ -0,0 +1,24 @@
+"""Stand-ins for the catalog and order servers in front tier tests."""
+import json
+
+import requests
+
+
+def make_response(status, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = b'' if body is None else json.dumps(body).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+class FakeBalancer:
+    """Stands in for a Balancer; answers from handler(method, path, params) and records the calls."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+
+    def request(self, method, path, **kwargs):
+        self.calls.append((method, path, kwargs.get('params')))
+        return 'http://catalog', self.handler(method, path, kwargs.get('params') or {})
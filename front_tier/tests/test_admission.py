@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+from admission import AdmissionController, Rejected, TokenBucket
+
+
+def controller(**limits):
+    settings = dict(client_rate=0.001, client_burst=2, item_rate=0.001, item_burst=2,
+                    max_in_flight=10, max_queued=10, queue_timeout=1.0)
+    settings.update(limits)
+    return AdmissionController(**settings)
+
+
+def rejected(admission, client, *items):
+    with pytest.raises(Rejected) as exc:
+        admission.acquire(client, *items)
+    return exc.value.reason
+
+
+def test_token_bucket_allows_a_burst_then_reports_the_wait():
+    bucket = TokenBucket(rate=2, burst=2)
+    now = bucket.updated
+    assert bucket.take(now) == 0
+    assert bucket.take(now) == 0
+    assert bucket.take(now) == pytest.approx(0.5)
+    assert bucket.take(now + 0.5) == 0
+
+
+def test_client_over_its_rate_is_shed():
+    admission = controller()
+    admission.acquire('a', 1)
+    admission.acquire('a', 2)
+    assert rejected(admission, 'a', 3) == 'client_rate'
+    # Another client is not affected
+    admission.acquire('b', 3)
+
+
+def test_item_rejection_refunds_the_client_and_the_other_items():
+    admission = controller(item_burst=1)
+    admission.acquire('a', 1)
+    assert rejected(admission, 'b', 2, 1) == 'item_rate'
+    # Neither b's token nor item 2's was spent
+    assert admission.clients.bucket('b').tokens == pytest.approx(2, abs=0.01)
+    assert admission.items.bucket(2).tokens == pytest.approx(1, abs=0.01)
+
+
+def test_queue_full_refunds_tokens():
+    admission = controller(max_in_flight=1, max_queued=0)
+    admission.acquire('a', 1)
+    assert rejected(admission, 'b', 2) == 'queue_full'
+    assert admission.clients.bucket('b').tokens == pytest.approx(2, abs=0.01)
+    assert admission.items.bucket(2).tokens == pytest.approx(2, abs=0.01)
+    assert admission.stats()['shed']['queue_full'] == 1
+
+
+def test_queue_timeout_refunds_tokens():
+    admission = controller(max_in_flight=1, queue_timeout=0.05)
+    admission.acquire('a', 1)
+    assert rejected(admission, 'b', 2) == 'queue_timeout'
+    assert admission.clients.bucket('b').tokens == pytest.approx(2, abs=0.01)
+    assert admission.items.bucket(2).tokens == pytest.approx(2, abs=0.01)
+    assert admission.stats()['queued'] == 0
+
+
+def test_queued_request_runs_when_a_slot_is_freed():
+    admission = controller(max_in_flight=1)
+    admission.acquire('a', 1)
+    waiter = threading.Thread(target=admission.acquire, args=('b', 2))
+    waiter.start()
+    admission.release()
+    waiter.join(1)
+    assert not waiter.is_alive()
+    stats = admission.stats()
+    assert (stats['in_flight'], stats['queued_total'], stats['admitted']) == (1, 1, 2)
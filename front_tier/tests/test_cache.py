@@ -0,0 +1,148 @@
+import threading
+import time
+
+import pytest
+
+from cache import CacheNamespace, deep_sizeof
+from shared_cache import SharedCache
+
+
+def namespace(**options):
+    settings = dict(ttl=60, max_bytes=1 << 20)
+    settings.update(options)
+    return CacheNamespace('info', **settings)
+
+
+def wait_for(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_misses_share_one_load():
+    cache = namespace()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return {'id': 1}, 'positive'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.load(1, loader)))
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=lambda: results.append(cache.load(1, loader))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    wait_for(lambda: cache.stats()['coalesced'] == 3)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(1)
+
+    assert calls == [1]
+    assert results == [{'id': 1}] * 4
+    stats = cache.stats()
+    assert (stats['loads'], stats['coalesced'], stats['loads_in_flight']) == (1, 3, 0)
+    assert cache.get(1) == {'id': 1}
+
+
+def test_load_error_reaches_every_waiter_and_is_not_cached():
+    cache = namespace()
+    started, release = threading.Event(), threading.Event()
+
+    def loader():
+        started.set()
+        release.wait(1)
+        raise ConnectionError('catalog down')
+
+    errors = []
+
+    def load():
+        try:
+            cache.load(1, loader)
+        except ConnectionError as exc:
+            errors.append(str(exc))
+
+    threads = [threading.Thread(target=load)]
+    threads[0].start()
+    started.wait(1)
+    threads.append(threading.Thread(target=load))
+    threads[1].start()
+    wait_for(lambda: cache.stats()['coalesced'] == 1)
+    release.set()
+    for thread in threads:
+        thread.join(1)
+
+    assert errors == ['catalog down'] * 2
+    assert cache.get(1) is None
+
+
+def test_load_racing_with_an_invalidation_is_not_stored():
+    cache = namespace()
+
+    def loader():
+        # The book changes while its old version is being read
+        cache.pop(1)
+        return {'id': 1, 'count': 5}, 'positive'
+
+    assert cache.load(1, loader) == {'id': 1, 'count': 5}
+    assert cache.get(1) is None
+
+
+def test_set_with_an_old_generation_is_dropped():
+    cache = namespace()
+    generation = cache.generation
+    cache.pop_many([1, 2])
+    assert not cache.set(1, 'old', generation=generation)
+    assert cache.set(1, 'new', generation=cache.generation)
+    assert cache.get(1) == 'new'
+
+
+def test_pop_many_drops_only_the_given_keys():
+    cache = namespace()
+    for key in (1, 2, 3):
+        cache.set(key, key)
+    assert cache.pop_many([1, 3, 4]) == 2
+    assert cache.keys() == [2]
+
+
+def test_uncacheable_load_is_returned_but_not_stored():
+    cache = namespace()
+    assert cache.load(1, lambda: ({'error': 'bad gateway'}, None)) == {'error': 'bad gateway'}
+    assert cache.get(1) is None
+
+
+def test_lru_eviction_keeps_within_max_bytes():
+    size = deep_sizeof(1) + deep_sizeof('x' * 100)
+    cache = namespace(max_bytes=2 * size)
+    for key in (1, 2, 3):
+        cache.set(key, 'x' * 100)
+    assert cache.keys() == [2, 3]
+    assert cache.stats()['evictions'] == 1
+
+
+@pytest.fixture
+def shared(tmp_path):
+    return SharedCache(str(tmp_path / 'l2.db'))
+
+
+def test_l2_skips_a_store_invalidated_by_another_worker(shared, tmp_path):
+    worker = namespace(shared=shared)
+    other = SharedCache(str(tmp_path / 'l2.db'))
+    generation = worker.generation
+    other.invalidate('info', 1)
+    worker.set(1, ['stale'], generation=generation)
+    assert shared.get('info', 1) is None
+    assert shared.skipped_writes == 1
+
+
+def test_l1_miss_is_filled_from_l2(shared):
+    first = namespace(shared=shared)
+    second = namespace(shared=shared)
+    first.set(1, ['body', 200])
+    assert second.lookup(1) == (('body', 200), False)
+    assert second.stats()['l2_hits'] == 1
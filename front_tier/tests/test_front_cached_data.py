@@ -0,0 +1,33 @@
+import pytest
+
+
+def fill(front, count):
+    for id in range(1, count + 1):
+        front.cache['info'].set(id, ({'books': {'id': id}}, 200))
+
+
+@pytest.mark.parametrize('limit', ['0', '-1'])
+def test_non_positive_limit_returns_one_entry(front, limit):
+    fill(front, 3)
+    body = front.app.test_client().get(f'/cached_data?prefix=info:&limit={limit}').get_json()
+    assert [item['key'] for item in body['items']] == ['info:1']
+    assert body['next_cursor'] == 'info:1'
+
+
+def test_pages_follow_the_cursor_to_the_end(front):
+    fill(front, 3)
+    client = front.app.test_client()
+    first = client.get('/cached_data?prefix=info:&limit=2').get_json()
+    assert [item['key'] for item in first['items']] == ['info:1', 'info:2']
+    last = client.get(f"/cached_data?prefix=info:&limit=2&cursor={first['next_cursor']}").get_json()
+    assert [item['key'] for item in last['items']] == ['info:3']
+    assert last['next_cursor'] is None
+
+
+def test_empty_page_has_no_cursor(front):
+    body = front.app.test_client().get('/cached_data?prefix=info:&limit=0').get_json()
+    assert body == {'items': [], 'next_cursor': None}
+
+
+def test_bad_limit_is_rejected(front):
+    assert front.app.test_client().get('/cached_data?limit=ten').status_code == 400
@@ -0,0 +1,42 @@
+from front_fakes import make_response
+
+BOOKS = {1: {'id': 1, 'name': 'harry', 'count': 3}, 2: {'id': 2, 'name': 'potter', 'count': 0}}
+
+
+def catalog(method, path, params):
+    """Both catalog nodes: GET /books/<id> wraps the book in 'books'."""
+    if path == 'books/batch':
+        ids = [int(part) for part in params['ids'].split(',')]
+        return make_response(200, {'books': [BOOKS[id] for id in ids if id in BOOKS],
+                                   'missing': [id for id in ids if id not in BOOKS]})
+    id = int(path.split('/')[1])
+    if id not in BOOKS:
+        return make_response(404, {'error': 'Book not found'})
+    return make_response(200, {'books': BOOKS[id]}, {'ETag': f'"{id}.1"'})
+
+
+def test_batch_info_uses_entries_cached_by_single_info(front, fake_catalog):
+    balancer = fake_catalog(catalog)
+    client = front.app.test_client()
+
+    assert client.get('/info/1').get_json() == {'books': BOOKS[1]}
+    response = client.get('/info?ids=1,2,9')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'books': [BOOKS[1], BOOKS[2]], 'found': [1, 2], 'missing': [9]}
+    # Only the misses went to the catalog, in one request
+    assert balancer.calls[1:] == [('GET', 'books/batch', {'ids': '2,9'})]
+
+
+def test_single_info_uses_entries_cached_by_batch(front, fake_catalog):
+    balancer = fake_catalog(catalog)
+    client = front.app.test_client()
+
+    client.get('/info?ids=1,9')
+    assert client.get('/info/1').get_json() == {'books': BOOKS[1]}
+    assert client.get('/info/9').status_code == 404
+    assert len(balancer.calls) == 1
+
+
+def test_batch_info_rejects_bad_ids(front):
+    assert front.app.test_client().get('/info?ids=1,x').status_code == 400
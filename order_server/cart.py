@@ -0,0 +1,27 @@
+MAX_ITEMS = 100
+
+
+def parse_items(payload, max_items=MAX_ITEMS):
+    """
+    [(book_id, qty), ...] from a {"items": [{"id": 1, "qty": 2}, ...]}
+    body, qty defaulting to 1. Repeated books are merged and the list is
+    sorted by id, so concurrent carts take their rows in the same order.
+    Raises ValueError for a malformed cart.
+    """
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('items must be a non-empty list of {"id", "qty"}')
+    totals = {}
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('each item must be an object with id and qty')
+        book_id = item.get('id')
+        qty = item.get('qty', 1)
+        if type(book_id) is not int or type(qty) is not int:
+            raise ValueError('id and qty must be integers')
+        if qty < 1:
+            raise ValueError('qty must be at least 1')
+        totals[book_id] = totals.get(book_id, 0) + qty
+    if len(totals) > max_items:
+        raise ValueError(f'at most {max_items} books per cart')
+    return sorted(totals.items())
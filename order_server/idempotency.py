@@ -0,0 +1,244 @@
+import functools
+import hashlib
+import threading
+import time
+
+import requests
+from flask import jsonify, make_response, request
+from urllib3.exceptions import NewConnectionError
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_MAX_KEYS = 100000
+PURGE_INTERVAL = 60
+PEER_TIMEOUT = (0.5, 1.0)
+MAX_KEY_LENGTH = 255
+
+
+def is_refused(exc):
+    """
+    True if the peer refused the connection: it is not running, so it is
+    not working on the key either. A timeout proves nothing.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class IdempotencyStore:
+    """
+    Results of requests sent with an Idempotency-Key, kept for `ttl`
+    seconds and at most `max_keys` of them, so a retried request gets the
+    original answer instead of running twice.
+
+    A key is claimed with a pending row before the request runs. Because
+    the front tier may retry on the other order server, the claim also
+    asks `peer_url`. When the peer has already answered, its result is
+    replayed. When both servers hold a pending claim, the older claim
+    wins, with the node name as tie-break, and the other server answers
+    409. Both servers compare the same pair of claims, so exactly one
+    of them runs the request.
+    """
+
+    def __init__(self, engine, node, peer_url=None, ttl=DEFAULT_TTL, max_keys=DEFAULT_MAX_KEYS):
+        self.engine = engine
+        self.node = node
+        self.peer_url = (peer_url or '').rstrip('/')
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.http = requests.Session()
+        self.replays = 0
+        self.peer_replays = 0
+        self.conflicts = 0
+        self.purged = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        with engine.begin() as conn:
+            conn.exec_driver_sql("""
+                CREATE TABLE IF NOT EXISTS idempotency_key (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    status INTEGER,
+                    body TEXT,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )""")
+            conn.exec_driver_sql(
+                'CREATE INDEX IF NOT EXISTS ix_idempotency_key_expires_at ON idempotency_key (expires_at)')
+            # Claims of requests that died with the previous process
+            conn.exec_driver_sql("DELETE FROM idempotency_key WHERE state = 'pending'")
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def lookup(self, key):
+        """This node's record of `key`: state unknown, pending or done."""
+        with self.engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                'SELECT state, status, body, created_at, fingerprint FROM idempotency_key '
+                'WHERE key = ? AND expires_at > ?', (key, time.time())).first()
+        if row is None:
+            return {'state': 'unknown', 'node': self.node}
+        return {'state': row[0], 'status': row[1], 'body': row[2], 'created_at': row[3],
+                'fingerprint': row[4], 'node': self.node}
+
+    def _claim(self, key, fingerprint):
+        """Insert a pending row; returns (created_at, None) or (None, existing record)."""
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('DELETE FROM idempotency_key WHERE key = ? AND expires_at <= ?', (key, now))
+            inserted = conn.exec_driver_sql(
+                "INSERT INTO idempotency_key (key, fingerprint, state, created_at, expires_at) "
+                "VALUES (?, ?, 'pending', ?, ?) ON CONFLICT(key) DO NOTHING",
+                (key, fingerprint, now, now + self.ttl)).rowcount
+        if inserted:
+            return now, None
+        return None, self.lookup(key)
+
+    def _ask_peer(self, key):
+        """The peer's record of `key`, {'state': 'unknown'} when it is down, or None when it cannot tell."""
+        if not self.peer_url:
+            return {'state': 'unknown'}
+        try:
+            response = self.http.get(f'{self.peer_url}/idempotency/{key}', timeout=PEER_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as exc:
+            return {'state': 'unknown'} if is_refused(exc) else None
+
+    def begin(self, key, fingerprint):
+        """
+        Claim `key` before running a request. Returns one of
+        ('run', None), ('replay', (status, body)), ('conflict', message),
+        ('mismatch', message) or ('unavailable', message).
+        """
+        created_at, existing = self._claim(key, fingerprint)
+        if existing is not None:
+            if existing['fingerprint'] != fingerprint:
+                return 'mismatch', 'Idempotency-Key was used for a different request'
+            if existing['state'] == 'done':
+                self._count('replays')
+                return 'replay', (existing['status'], existing['body'])
+            self._count('conflicts')
+            return 'conflict', 'A request with this Idempotency-Key is in progress'
+        peer = self._ask_peer(key)
+        if peer is None:
+            self.abandon(key)
+            return 'unavailable', 'Could not check the Idempotency-Key with the other order server'
+        if peer['state'] == 'done':
+            if peer.get('fingerprint') != fingerprint:
+                self.abandon(key)
+                return 'mismatch', 'Idempotency-Key was used for a different request'
+            self.complete(key, peer['status'], peer['body'])
+            self._count('peer_replays')
+            return 'replay', (peer['status'], peer['body'])
+        if peer['state'] == 'pending' and (peer['created_at'], peer['node']) < (created_at, self.node):
+            self.abandon(key)
+            self._count('conflicts')
+            return 'conflict', 'A request with this Idempotency-Key is in progress on the other order server'
+        return 'run', None
+
+    def complete(self, key, status, body):
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "UPDATE idempotency_key SET state = 'done', status = ?, body = ?, expires_at = ? WHERE key = ?",
+                (status, body, now + self.ttl, key))
+
+    def abandon(self, key):
+        """Drop a pending claim whose request did not run, so it can be retried."""
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM idempotency_key WHERE key = ? AND state = 'pending'", (key,))
+
+    def purge(self):
+        """Delete expired keys, then the oldest ones beyond max_keys."""
+        with self.engine.begin() as conn:
+            deleted = conn.exec_driver_sql(
+                'DELETE FROM idempotency_key WHERE expires_at <= ?', (time.time(),)).rowcount
+            deleted += conn.exec_driver_sql(
+                'DELETE FROM idempotency_key WHERE key IN (SELECT key FROM idempotency_key '
+                'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_keys,)).rowcount
+        with self._lock:
+            self.purged += deleted
+        return deleted
+
+    def _run(self):
+        while True:
+            time.sleep(PURGE_INTERVAL)
+            try:
+                self.purge()
+            except Exception:
+                pass
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='idempotency-purge', daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        with self.engine.connect() as conn:
+            keys = conn.exec_driver_sql('SELECT COUNT(*) FROM idempotency_key').scalar()
+        with self._lock:
+            return {'node': self.node, 'peer_url': self.peer_url, 'keys': keys, 'max_keys': self.max_keys,
+                    'ttl': self.ttl, 'replays': self.replays, 'peer_replays': self.peer_replays,
+                    'conflicts': self.conflicts, 'purged': self.purged}
+
+    def collect_metrics(self):
+        """Registry collector exposing replay and conflict counters on /metrics."""
+        stats = self.stats()
+        yield 'order_idempotency_keys', 'gauge', 'Idempotency keys stored.', [({}, stats['keys'])]
+        yield ('order_idempotent_replays_total', 'counter', 'Requests answered from a stored result.',
+               [({'source': 'local'}, stats['replays']), ({'source': 'peer'}, stats['peer_replays'])])
+        yield ('order_idempotency_conflicts_total', 'counter', 'Requests refused while their key was in progress.',
+               [({}, stats['conflicts'])])
+
+
+def idempotent(store):
+    """
+    Decorator for views that must not run twice for one Idempotency-Key.
+    Requests without the header run as before. A replay answers with the
+    stored status and body plus an Idempotent-Replayed header.
+
+    A 503 answer means nothing ran, so the key is released for a retry.
+    Every other answer is stored, including 502 and 504 whose outcome is
+    unknown: running the request again could sell the stock twice.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH or '/' in key:
+                return make_response(jsonify({'error': 'invalid Idempotency-Key'}), 400)
+            fingerprint = f'{request.method} {request.path} ' + hashlib.sha256(request.get_data()).hexdigest()
+            outcome, detail = store.begin(key, fingerprint)
+            if outcome == 'replay':
+                status, body = detail
+                return make_response(body, status, {
+                    'Content-Type': 'application/json', 'Idempotency-Key': key, 'Idempotent-Replayed': 'true'})
+            if outcome == 'conflict':
+                return make_response(jsonify({'error': detail}), 409, {'Retry-After': '1'})
+            if outcome == 'mismatch':
+                return make_response(jsonify({'error': detail}), 422)
+            if outcome == 'unavailable':
+                return make_response(jsonify({'error': detail}), 503, {'Retry-After': '1'})
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                store.abandon(key)
+                raise
+            if response.status_code == 503:
+                # Nothing ran; a retry may run the request again
+                store.abandon(key)
+            else:
+                store.complete(key, response.status_code, response.get_data(as_text=True))
+            response.headers['Idempotency-Key'] = key
+            return response
+        return wrapper
+    return decorator
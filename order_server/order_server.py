@@ -1,12 +1,25 @@
 # original.py
+import os
+import queue
+import time
+import uuid
 from datetime import datetime
-from flask import Flask, make_response, jsonify
+from typing import Optional
+from flask import Flask, make_response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Integer, JSON, DATETIME
+from sqlalchemy import Float, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column
 import requests
 from flask_socketio import SocketIO
+from metrics import instrument_flask, instrument_engine, record_upstream, registry
+from event_log import AsyncLog
+import storage
+from purchase_pipeline import PurchasePipeline
+import order_store
+import sales_rollup
+import cart
+import idempotency
 
 # Define a base class for SQLAlchemy models
 
@@ -18,6 +31,7 @@ class Base(DeclarativeBase):
 # Create a Flask web application
 app = Flask(__name__)
 socketio = SocketIO(app)
+instrument_flask(app)
 
 # Configure SQLAlchemy to use SQLite and set the database URI
 db = SQLAlchemy(model_class=Base)
@@ -25,22 +39,161 @@ app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///project.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
-# Define SQLAlchemy model for Order
-
-
+# One compact row per order: the book, its price when it was sold, the
+# quantity and the time as epoch seconds, indexed by book and by time
 class Order(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    book_data: Mapped[dict] = mapped_column(JSON)
-    purchase_date: Mapped[datetime] = mapped_column(DATETIME)
-    count: Mapped[int] = mapped_column(Integer)
+    # Order id given to the client, also for orders queued before they have a row
+    ref: Mapped[Optional[str]] = mapped_column(String(32), index=True, unique=True)
+    book_id: Mapped[int] = mapped_column(Integer, index=True)
+    unit_price: Mapped[float] = mapped_column(Float)
+    quantity: Mapped[int] = mapped_column(Integer, default=1)
+    purchased_at: Mapped[float] = mapped_column(Float, index=True, default=time.time)
 
 
 # Create the Order table in the database
 with app.app_context():
+    # WAL, busy timeout and cache settings on every connection
+    storage.configure_sqlite(db.engine)
     db.create_all()
+    instrument_engine(db.engine)
+    with db.engine.begin() as conn:
+        storage.ensure_columns(conn, Order)
+        storage.ensure_indexes(conn, Order)
+    # Orders from before the columns above keep everything in a JSON blob
+    order_store.migrate_legacy_orders(db.engine, Order.__tablename__)
+    # When ORDER_RETENTION_DAYS is set, older orders move to the order_archive table
+    order_archiver = order_store.OrderArchiver(
+        db.engine, Order.__tablename__,
+        retention_days=float(os.environ['ORDER_RETENTION_DAYS']) if os.environ.get('ORDER_RETENTION_DAYS') else None)
+    # Hourly and daily sales per book, kept up to date by triggers on insert
+    with db.engine.begin() as conn:
+        sales_rollup.ensure_rollups(conn, Order.__tablename__, Order.__tablename__ + '_archive')
+    # Read-only connections for the reporting endpoints
+    read_session = storage.read_only_session(app, db.engine)
+    # Results of purchases sent with an Idempotency-Key, shared with the other order server
+    idempotency_store = idempotency.IdempotencyStore(
+        db.engine, os.environ.get('ORDER_NODE_NAME', 'order'),
+        os.environ.get('ORDER_PEER_URL', 'http://127.0.0.1:3001'),
+        ttl=float(os.environ.get('IDEMPOTENCY_TTL', idempotency.DEFAULT_TTL)),
+        max_keys=int(os.environ.get('IDEMPOTENCY_MAX_KEYS', idempotency.DEFAULT_MAX_KEYS)))
+order_archiver.start()
+registry.add_collector(order_archiver.collect_metrics)
+idempotency_store.start()
+registry.add_collector(idempotency_store.collect_metrics)
+
+# Shared session for catalog calls, timed for /metrics
+catalog_session = requests.Session()
+catalog_session.hooks['response'].append(record_upstream)
+# (connect, read) timeouts for catalog calls, as in front_tier/http_client.py
+CATALOG_TIMEOUT = (1.0, 5.0)
 
 server_url = "http://127.0.0.1:4000"
 
+# JSON lines order log, written in batches off the request path
+order_log = AsyncLog('./order_log.txt')
+registry.add_collector(order_log.collect_metrics)
+
+
+def post_to_catalog(url, **kwargs):
+    """
+    POST to the catalog and return (status code, JSON body). A catalog that
+    could not be connected to gives 503: nothing was sold and the purchase
+    can be retried. Once the request was sent, the catalog may have taken
+    the stock even if its answer is lost, so a read timeout or a dropped
+    connection gives 504 and an answer that is not JSON 502; neither is
+    retried under the same Idempotency-Key.
+    """
+    try:
+        response = catalog_session.post(url, timeout=CATALOG_TIMEOUT, **kwargs)
+    except requests.RequestException as exc:
+        if isinstance(exc, requests.exceptions.ConnectTimeout) or idempotency.is_refused(exc):
+            return 503, {'error': f'catalog unavailable: {exc}'}
+        return 504, {'error': f'catalog did not answer, the purchase may have gone through: {exc}'}
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return 502, {'error': f'catalog answered {response.status_code} without a JSON body'}
+
+
+def take_from_catalog(id, qty=1):
+    """
+    Take the book out of stock and read it back in a single catalog call;
+    the catalog decrements with a conditional UPDATE so it cannot oversell.
+    Returns (status code, body).
+    """
+    return post_to_catalog(f'{server_url}/books/{id}/purchase', data={'qty': qty})
+
+
+def take_cart_from_catalog(items):
+    """
+    Take every (book id, qty) of a cart in one catalog call and one
+    catalog transaction: all of them or none. Returns (status code, body).
+    """
+    return post_to_catalog(
+        f'{server_url}/books/purchase', json={'items': [{'id': id, 'qty': qty} for id, qty in items]})
+
+
+def order_info(order):
+    return {
+        'id': order.ref,
+        'book_id': order.book_id,
+        'unit_price': order.unit_price,
+        'quantity': order.quantity,
+        'purchased_at': order.purchased_at,
+    }
+
+
+def confirmation(order, result):
+    """order_info() plus the catalog's answer, as purchases have always returned."""
+    return dict(order_info(order), book_info={'books': result['books']}, count=order.quantity,
+                purchase_date=datetime.fromtimestamp(order.purchased_at))
+
+
+def confirm_order(info, order_id, id, result):
+    """Log the order and emit its confirmation."""
+    order_log.log('book_purchased', order_id=order_id, ref=info['id'], book_id=id,
+                  name=result['books']['name'], left=result['count'])
+    socketio.emit('order_confirmation_original', {'order_info': info})
+
+
+# Asynchronous purchases: /purchase/<id> answers 202 with an order id and
+# a worker pool makes the catalog calls; the resulting orders are written
+# in group commits. On for every purchase with ORDER_ASYNC_PURCHASES=1,
+# or per request with a `Prefer: respond-async` header.
+ASYNC_PURCHASES = os.environ.get('ORDER_ASYNC_PURCHASES') == '1'
+
+
+def commit_orders(jobs):
+    with app.app_context():
+        orders = [Order(ref=job.ref, book_id=job.book_id, unit_price=job.result['books']['price'],
+                        quantity=job.qty) for job in jobs]
+        db.session.add_all(orders)
+        db.session.commit()
+        for job, order in zip(jobs, orders):
+            job.order_id = order.id
+            job.result['order'] = confirmation(order, job.result)
+
+
+def publish_orders(jobs):
+    for job in jobs:
+        confirm_order(job.result['order'], job.order_id, job.book_id, job.result)
+    # One invalidation per book of the batch
+    for id in dict.fromkeys(job.book_id for job in jobs):
+        socketio.emit('cache_invalidate', {'key': id})
+
+
+def orders_lost(jobs, exc):
+    for job in jobs:
+        order_log.log('order_commit_failed', ref=job.ref, book_id=job.book_id, error=str(exc))
+
+
+purchase_pipeline = PurchasePipeline(
+    lambda job: take_from_catalog(job.book_id, job.qty), commit_orders, publish_orders,
+    workers=int(os.environ.get('ORDER_PURCHASE_WORKERS', 8)), on_error=orders_lost)
+purchase_pipeline.start()
+registry.add_collector(purchase_pipeline.collect_metrics)
+
 # SocketIO event handler for handling order confirmation
 
 
@@ -54,10 +207,18 @@ def handle_order_confirmation_original(message):
     else:
         print("No order_info found in message")
 
+# Liveness probe used by the front tier load balancer
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
 # Endpoint to purchase a book
 
 
 @app.route('/purchase/<int:id>', methods=['POST'])
+@idempotency.idempotent(idempotency_store)
 def purchase_book(id):
     """
     Make a purchase request for a specific item.
@@ -66,63 +227,197 @@ def purchase_book(id):
     - item_id: The unique identifier of the item to purchase (integer)
 
     Output:
-    - JSON response confirming the purchase
+    - JSON response confirming the purchase, or 202 with the order id to
+      poll at /orders/<order_id> in asynchronous mode
+
+    A request sent again with the same Idempotency-Key header, to either
+    order server, gets the first answer back and buys nothing.
 
     Example:
     - POST request: /purchase/456
     """
+    if ASYNC_PURCHASES or 'respond-async' in request.headers.get('Prefer', ''):
+        try:
+            job = purchase_pipeline.submit(id)
+        except queue.Full:
+            return make_response(jsonify({'error': 'Too many pending purchases'}), 503, {'Retry-After': '1'})
+        return make_response(jsonify({'order': job.as_dict()}), 202,
+                             {'Location': f'/orders/{job.ref}', 'Preference-Applied': 'respond-async'})
 
-    # Check stock availability from the catalog server
-    av_response = requests.get(f'{server_url}/books/{id}/stock/availability')
-
-    if av_response.status_code == 200:
-        # Decrease the stock count if the book is available
-        decrease_response = requests.put(
-            f'{server_url}/books/{id}/count/decrease')
-
-        # Check if the stock count decrease was successful
-        if decrease_response.status_code == 404:
-            return make_response(decrease_response.json(), 404)
-
-        # Retrieve book information after the stock count decrease
-        book_info = requests.get(f'{server_url}/books/{id}')
-        book = book_info.json()
+    status, result = take_from_catalog(id)
 
+    if status == 200:
         # Create an Order record in the database
-        order = Order(book_data=book, purchase_date=datetime.now(), count=1)
+        order = Order(ref=uuid.uuid4().hex, book_id=id, unit_price=result['books']['price'], quantity=1)
         db.session.add(order)
         db.session.commit()
 
-        # Log the order information
-        with open('./order_log.txt', 'a') as log:
-            log.write(f"user purchased book {book['books']['name']} at {
-                      datetime.now()}, in stock left {decrease_response.json()['count']}\n")
-
-        # Emit a notification about the order confirmation
-        socketio.emit('order_confirmation_original', {'order_info': {
-            'book_info': book,
-            'purchase_date': datetime.now(),
-            'count': 1,
-        }})
+        info = confirmation(order, result)
+        confirm_order(info, order.id, id, result)
 
         # Emit a cache invalidation event
         socketio.emit('cache_invalidate', {'key': id})
 
         # Return a JSON response confirming the order
-        json_response = jsonify({
-            'order': {
-                'book_info': book,
-                'purchase_date': datetime.now(),
-                'count': 1,
-            }
-        })
-        return json_response
+        return jsonify({'order': info})
 
     else:
-        # Return an error response if the book is not available
-        json_response = av_response.json()
-        return make_response(json_response, 403)
+        # Return the catalog's answer: 404 unknown book, 403 out of stock,
+        # 503 when it is unreachable, 502/504 when the outcome is unknown
+        return make_response(result, status)
+
+# Endpoint to purchase several books at once
+
+
+@app.route('/purchase', methods=['POST'])
+@idempotency.idempotent(idempotency_store)
+def purchase_cart():
+    """
+    Buy a cart of books in one request, all or nothing.
+
+    Input:
+    - JSON body: {"items": [{"id": 1, "qty": 2}, {"id": 7}]}, qty defaults to 1
+
+    Output:
+    - JSON response with one order per book, or the catalog's 404 or 403
+      for the first book that is unknown or short, with nothing bought
+
+    Carts are always processed synchronously and honor Idempotency-Key
+    like /purchase/<id>.
+
+    Example:
+    - POST request: /purchase with {"items": [{"id": 1, "qty": 2}, {"id": 3}]}
+    """
+    try:
+        items = cart.parse_items(request.get_json(silent=True))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+
+    status, result = take_cart_from_catalog(items)
+    if status != 200:
+        # Return the catalog's answer: 404 unknown book, 403 out of stock,
+        # 503 when it is unreachable, 502/504 when the outcome is unknown
+        return make_response(result, status)
+
+    # Create the Order records, one per book, in a single commit
+    orders = [Order(ref=uuid.uuid4().hex, book_id=book['id'], unit_price=book['price'], quantity=book['qty'])
+              for book in result['books']]
+    db.session.add_all(orders)
+    db.session.commit()
+
+    lines = []
+    for order, book in zip(orders, result['books']):
+        info = confirmation(order, {'books': book})
+        order_log.log('book_purchased', order_id=order.id, ref=info['id'], book_id=order.book_id,
+                      name=book['name'], left=book['count'])
+        lines.append(info)
+
+    # One cache invalidation event for every book of the cart
+    socketio.emit('cache_invalidate', {'keys': [order.book_id for order in orders]})
+    return jsonify({'orders': lines})
+
+# Endpoint to poll the state of an order
+
+
+@app.route('/orders/<string:order_id>', methods=['GET'])
+def get_order(order_id):
+    """
+    Status of an order: queued, processing, completed or failed.
+
+    Example:
+    - GET request: /orders/3f2a...
+    """
+    job = purchase_pipeline.get(order_id)
+    if job is not None and job.status != 'completed':
+        return jsonify({'order': job.as_dict(), 'http_status': job.http_status})
+    order = db.session.execute(db.select(Order).where(Order.ref == order_id)).scalar()
+    if order is None and order_id.isdigit():
+        # Orders placed before order ids were handed out
+        order = db.session.get(Order, int(order_id))
+    if order is None:
+        return make_response(jsonify({'error': 'Order not found'}), 404)
+    return jsonify({'order': dict(order_info(order), status='completed', order_id=order.id)})
+
+# Endpoint to list orders by book and time range
+
+
+@app.route('/orders', methods=['GET'])
+def list_orders():
+    """
+    Orders oldest first, one page at a time. Orders past the retention
+    period are archived and only counted in /sales/rollups.
+
+    Input:
+    - book_id: Only orders of this book
+    - since, until: Time range, epoch seconds or ISO 8601 (UTC by default)
+    - limit, after: Page size (default 100, max 1000) and the next_after of the previous page
+
+    Example:
+    - GET request: /orders?book_id=3&since=2024-05-01&until=2024-06-01
+    """
+    try:
+        filters = sales_rollup.parse_filters(request.args)
+        after = int(request.args.get('after', 0))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    orders, next_after = sales_rollup.query_orders(read_session, Order.__tablename__, filters, after)
+    return jsonify({'orders': orders, 'next_after': next_after})
+
+# Endpoint to read units sold and revenue per book and hour or day
+
+
+@app.route('/sales/rollups', methods=['GET'])
+def sales_rollups():
+    """
+    Orders, units and revenue per book per time bucket, read from
+    aggregate tables updated with every order, so no order is scanned.
+
+    Input:
+    - granularity: hour (default) or day, UTC aligned
+    - book_id, since, until: As for /orders; since and until apply to bucket starts
+    - limit, after: Page size and the next_after of the previous page
+
+    Example:
+    - GET request: /sales/rollups?granularity=day&since=2024-05-01
+    """
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in sales_rollup.GRANULARITIES:
+        return make_response(jsonify({'error': f"granularity must be one of {', '.join(sales_rollup.GRANULARITIES)}"}), 400)
+    try:
+        filters = sales_rollup.parse_filters(request.args)
+        after = sales_rollup.parse_rollup_cursor(request.args.get('after'))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    rollups, next_after = sales_rollup.query_rollups(read_session, granularity, filters, after)
+    return jsonify({'granularity': granularity, 'rollups': rollups, 'next_after': next_after})
+
+# Queue depth and group commit counters of the asynchronous purchase mode
+
+
+@app.route('/purchase_stats', methods=['GET'])
+def get_purchase_stats():
+    return jsonify(purchase_pipeline.stats())
+
+# Retention settings and counters of the order archive
+
+
+@app.route('/archive_stats', methods=['GET'])
+def get_archive_stats():
+    return jsonify(order_archiver.stats())
+
+# This server's record of an Idempotency-Key, asked by the other order server
+
+
+@app.route('/idempotency/<string:key>', methods=['GET'])
+def get_idempotency_key(key):
+    return jsonify(idempotency_store.lookup(key))
+
+# Stored keys, replays and conflicts of idempotent purchases
+
 
+@app.route('/idempotency_stats', methods=['GET'])
+def get_idempotency_stats():
+    return jsonify(idempotency_store.stats())
 
 
 
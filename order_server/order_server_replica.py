@@ -1,11 +1,22 @@
 # order_server_replica.py
+import os
+import queue
+import time
+import uuid
 from datetime import datetime
 from flask import Flask, make_response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Integer, JSON, DATETIME
+from sqlalchemy import Float, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column
 from flask_socketio import SocketIO
+from metrics import instrument_flask, instrument_engine, record_upstream, registry
+import storage
+from purchase_pipeline import PurchasePipeline
+import order_store
+import sales_rollup
+import cart
+import idempotency
 import requests
 
 # Define a base class for SQLAlchemy models
@@ -18,6 +29,7 @@ class Base(DeclarativeBase):
 # Create a Flask web application
 app_replica = Flask(__name__)
 socketio_replica = SocketIO(app_replica, cors_allowed_origins="*")
+instrument_flask(app_replica)
 
 # Configure SQLAlchemy to use SQLite and set the database URI
 app_replica.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///project_replica.db"
@@ -31,17 +43,132 @@ db_replica.init_app(app_replica)
 class OrderReplica(db_replica.Model):
     __tablename__ = 'order_replica'  # Specify the table name
     id = db_replica.Column(db_replica.Integer, primary_key=True)
-    book_data = db_replica.Column(db_replica.JSON)
-    purchase_date = db_replica.Column(db_replica.DATETIME)
-    count = db_replica.Column(db_replica.Integer)
+    ref = db_replica.Column(String(32), index=True, unique=True)
+    book_id = db_replica.Column(Integer, index=True)
+    unit_price = db_replica.Column(Float)
+    quantity = db_replica.Column(Integer, default=1)
+    purchased_at = db_replica.Column(Float, index=True, default=time.time)
 
 
 # Create the Order replica table in the database
 with app_replica.app_context():
+    # WAL, busy timeout and cache settings on every connection
+    storage.configure_sqlite(db_replica.engine)
     db_replica.create_all()
+    instrument_engine(db_replica.engine)
+    with db_replica.engine.begin() as conn:
+        storage.ensure_columns(conn, OrderReplica)
+        storage.ensure_indexes(conn, OrderReplica)
+    order_store.migrate_legacy_orders(db_replica.engine, OrderReplica.__tablename__)
+    order_archiver = order_store.OrderArchiver(
+        db_replica.engine, OrderReplica.__tablename__,
+        retention_days=float(os.environ['ORDER_RETENTION_DAYS']) if os.environ.get('ORDER_RETENTION_DAYS') else None)
+    # Hourly and daily sales per book, kept up to date by triggers on insert
+    with db_replica.engine.begin() as conn:
+        sales_rollup.ensure_rollups(conn, OrderReplica.__tablename__, OrderReplica.__tablename__ + '_archive')
+    # Read-only connections for the reporting endpoints
+    read_session = storage.read_only_session(app_replica, db_replica.engine)
+    # Results of purchases sent with an Idempotency-Key, shared with the other order server
+    idempotency_store = idempotency.IdempotencyStore(
+        db_replica.engine, os.environ.get('ORDER_NODE_NAME', 'order-replica'),
+        os.environ.get('ORDER_PEER_URL', 'http://127.0.0.1:3000'),
+        ttl=float(os.environ.get('IDEMPOTENCY_TTL', idempotency.DEFAULT_TTL)),
+        max_keys=int(os.environ.get('IDEMPOTENCY_MAX_KEYS', idempotency.DEFAULT_MAX_KEYS)))
+order_archiver.start()
+registry.add_collector(order_archiver.collect_metrics)
+idempotency_store.start()
+registry.add_collector(idempotency_store.collect_metrics)
+
+# Shared session for catalog calls, timed for /metrics
+catalog_session = requests.Session()
+catalog_session.hooks['response'].append(record_upstream)
+# (connect, read) timeouts for catalog calls, as in front_tier/http_client.py
+CATALOG_TIMEOUT = (1.0, 5.0)
 
 catalog_replica_url = "http://127.0.0.1:4001"
 
+
+def post_to_catalog(url, **kwargs):
+    """
+    POST to the catalog and return (status code, JSON body). A catalog that
+    could not be connected to gives 503: nothing was sold and the purchase
+    can be retried. Once the request was sent, the catalog may have taken
+    the stock even if its answer is lost, so a read timeout or a dropped
+    connection gives 504 and an answer that is not JSON 502; neither is
+    retried under the same Idempotency-Key.
+    """
+    try:
+        response = catalog_session.post(url, timeout=CATALOG_TIMEOUT, **kwargs)
+    except requests.RequestException as exc:
+        if isinstance(exc, requests.exceptions.ConnectTimeout) or idempotency.is_refused(exc):
+            return 503, {'error': f'catalog unavailable: {exc}'}
+        return 504, {'error': f'catalog did not answer, the purchase may have gone through: {exc}'}
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return 502, {'error': f'catalog answered {response.status_code} without a JSON body'}
+
+
+def take_from_catalog(id, qty=1):
+    """
+    Take the book out of stock and read it back in a single catalog call;
+    the catalog decrements with a conditional UPDATE so it cannot oversell.
+    Returns (status code, body).
+    """
+    return post_to_catalog(f'{catalog_replica_url}/books/{id}/purchase', data={'qty': qty})
+
+
+def take_cart_from_catalog(items):
+    """
+    Take every (book id, qty) of a cart in one catalog call and one
+    catalog transaction: all of them or none. Returns (status code, body).
+    """
+    return post_to_catalog(
+        f'{catalog_replica_url}/books/purchase', json={'items': [{'id': id, 'qty': qty} for id, qty in items]})
+
+
+def order_info(order):
+    return {
+        'id': order.ref,
+        'book_id': order.book_id,
+        'unit_price': order.unit_price,
+        'quantity': order.quantity,
+        'purchased_at': order.purchased_at,
+    }
+
+
+def confirmation(order, result):
+    return dict(order_info(order), book_info={'books': result['books']}, count=order.quantity,
+                purchase_date=datetime.fromtimestamp(order.purchased_at))
+
+
+# Asynchronous purchases, as in order_server.py: 202 with an order id,
+# catalog calls on a worker pool, orders written in group commits
+ASYNC_PURCHASES = os.environ.get('ORDER_ASYNC_PURCHASES') == '1'
+
+
+def commit_orders(jobs):
+    with app_replica.app_context():
+        orders = [OrderReplica(ref=job.ref, book_id=job.book_id, unit_price=job.result['books']['price'],
+                               quantity=job.qty) for job in jobs]
+        db_replica.session.add_all(orders)
+        db_replica.session.commit()
+        for job, order in zip(jobs, orders):
+            job.order_id = order.id
+            job.result['order'] = confirmation(order, job.result)
+
+
+def publish_orders(jobs):
+    for job in jobs:
+        socketio_replica.emit('order_confirmation_replica', {'order_info': job.result['order']})
+
+
+purchase_pipeline = PurchasePipeline(
+    lambda job: take_from_catalog(job.book_id, job.qty), commit_orders, publish_orders,
+    workers=int(os.environ.get('ORDER_PURCHASE_WORKERS', 8)))
+purchase_pipeline.start()
+registry.add_collector(purchase_pipeline.collect_metrics)
+
 # SocketIO event handler for handling order confirmation in the replica
 
 
@@ -61,57 +188,190 @@ catalog_indices = {'purchase': 0}
 
 
 
-# Endpoint to purchase a book
+# Liveness probe used by the front tier load balancer
 
 
-@app_replica.route('/purchase/<int:id>', methods=['POST'])
-def purchase_book(id):
-   
+@app_replica.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
 
-    # Check stock availability from the catalog replica server
-    av_response = requests.get(
-        f'{catalog_replica_url}/books/{id}/stock/availability')
+# Endpoint to purchase a book
 
-    if av_response.status_code == 200:
-        # Decrease the stock count if the book is available
-        decrease_response = requests.put(
-            f'{catalog_replica_url}/books/{id}/count/decrease')
 
-        # Check if the stock count decrease was successful
-        if decrease_response.status_code == 404:
-            return make_response(decrease_response.json(), 404)
+@app_replica.route('/purchase/<int:id>', methods=['POST'])
+@idempotency.idempotent(idempotency_store)
+def purchase_book(id):
+    if ASYNC_PURCHASES or 'respond-async' in request.headers.get('Prefer', ''):
+        try:
+            job = purchase_pipeline.submit(id)
+        except queue.Full:
+            return make_response(jsonify({'error': 'Too many pending purchases'}), 503, {'Retry-After': '1'})
+        return make_response(jsonify({'order': job.as_dict()}), 202,
+                             {'Location': f'/orders/{job.ref}', 'Preference-Applied': 'respond-async'})
 
-        # Retrieve book information after the stock count decrease
-        book_info = requests.get(f'{catalog_replica_url}/books/{id}')
-        book = book_info.json()
+    status, result = take_from_catalog(id)
 
+    if status == 200:
         # Create an Order replica record in the database
-        order_replica = OrderReplica(
-            book_data=book, purchase_date=datetime.now(), count=1)
+        order_replica = OrderReplica(ref=uuid.uuid4().hex, book_id=id,
+                                     unit_price=result['books']['price'], quantity=1)
         db_replica.session.add(order_replica)
         db_replica.session.commit()
+        info = confirmation(order_replica, result)
 
         # Emit a notification about the order confirmation
-        socketio_replica.emit('order_confirmation_replica', {'order_info': {
-            'book_info': book,
-            'purchase_date': datetime.now(),
-            'count': 1,
-        }})
+        socketio_replica.emit('order_confirmation_replica', {'order_info': info})
 
         # Return a JSON response confirming the order
-        json_response = jsonify({
-            'order': {
-                'book_info': book,
-                'purchase_date': datetime.now(),
-                'count': 1,
-            }
-        })
-        return json_response
+        return jsonify({'order': info})
 
     else:
-        # Return an error response if the book is not available
-        json_response = av_response.json()
-        return make_response(json_response, 403)
+        # Return the catalog's answer: 404 unknown book, 403 out of stock,
+        # 503 when it is unreachable, 502/504 when the outcome is unknown
+        return make_response(result, status)
+
+# Endpoint to purchase several books at once
+
+
+@app_replica.route('/purchase', methods=['POST'])
+@idempotency.idempotent(idempotency_store)
+def purchase_cart():
+    """
+    Buy a cart of books in one request, all or nothing.
+
+    Input:
+    - JSON body: {"items": [{"id": 1, "qty": 2}, {"id": 7}]}, qty defaults to 1
+
+    Output:
+    - JSON response with one order per book, or the catalog's 404 or 403
+      for the first book that is unknown or short, with nothing bought
+
+    Carts are always processed synchronously and honor Idempotency-Key
+    like /purchase/<id>.
+
+    Example:
+    - POST request: /purchase with {"items": [{"id": 1, "qty": 2}, {"id": 3}]}
+    """
+    try:
+        items = cart.parse_items(request.get_json(silent=True))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+
+    status, result = take_cart_from_catalog(items)
+    if status != 200:
+        # Return the catalog's answer: 404 unknown book, 403 out of stock,
+        # 503 when it is unreachable, 502/504 when the outcome is unknown
+        return make_response(result, status)
+
+    # Create the Order replica records, one per book, in a single commit
+    orders = [OrderReplica(ref=uuid.uuid4().hex, book_id=book['id'], unit_price=book['price'], quantity=book['qty'])
+              for book in result['books']]
+    db_replica.session.add_all(orders)
+    db_replica.session.commit()
+
+    lines = [confirmation(order, {'books': book}) for order, book in zip(orders, result['books'])]
+
+    # One cache invalidation event for every book of the cart
+    socketio_replica.emit('cache_invalidate', {'keys': [order.book_id for order in orders]})
+    return jsonify({'orders': lines})
+
+# Endpoint to poll the state of an order
+
+
+@app_replica.route('/orders/<string:order_id>', methods=['GET'])
+def get_order(order_id):
+    job = purchase_pipeline.get(order_id)
+    if job is not None and job.status != 'completed':
+        return jsonify({'order': job.as_dict(), 'http_status': job.http_status})
+    order = db_replica.session.execute(
+        db_replica.select(OrderReplica).where(OrderReplica.ref == order_id)).scalar()
+    if order is None and order_id.isdigit():
+        # Orders placed before order ids were handed out
+        order = db_replica.session.get(OrderReplica, int(order_id))
+    if order is None:
+        return make_response(jsonify({'error': 'Order not found'}), 404)
+    return jsonify({'order': dict(order_info(order), status='completed', order_id=order.id)})
+
+# Endpoint to list orders by book and time range
+
+
+@app_replica.route('/orders', methods=['GET'])
+def list_orders():
+    """
+    Orders oldest first, one page at a time. Orders past the retention
+    period are archived and only counted in /sales/rollups.
+
+    Input:
+    - book_id: Only orders of this book
+    - since, until: Time range, epoch seconds or ISO 8601 (UTC by default)
+    - limit, after: Page size (default 100, max 1000) and the next_after of the previous page
+
+    Example:
+    - GET request: /orders?book_id=3&since=2024-05-01&until=2024-06-01
+    """
+    try:
+        filters = sales_rollup.parse_filters(request.args)
+        after = int(request.args.get('after', 0))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    orders, next_after = sales_rollup.query_orders(read_session, OrderReplica.__tablename__, filters, after)
+    return jsonify({'orders': orders, 'next_after': next_after})
+
+# Endpoint to read units sold and revenue per book and hour or day
+
+
+@app_replica.route('/sales/rollups', methods=['GET'])
+def sales_rollups():
+    """
+    Orders, units and revenue per book per time bucket, read from
+    aggregate tables updated with every order, so no order is scanned.
+
+    Input:
+    - granularity: hour (default) or day, UTC aligned
+    - book_id, since, until: As for /orders; since and until apply to bucket starts
+    - limit, after: Page size and the next_after of the previous page
+
+    Example:
+    - GET request: /sales/rollups?granularity=day&since=2024-05-01
+    """
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in sales_rollup.GRANULARITIES:
+        return make_response(jsonify({'error': f"granularity must be one of {', '.join(sales_rollup.GRANULARITIES)}"}), 400)
+    try:
+        filters = sales_rollup.parse_filters(request.args)
+        after = sales_rollup.parse_rollup_cursor(request.args.get('after'))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    rollups, next_after = sales_rollup.query_rollups(read_session, granularity, filters, after)
+    return jsonify({'granularity': granularity, 'rollups': rollups, 'next_after': next_after})
+
+# Queue depth and group commit counters of the asynchronous purchase mode
+
+
+@app_replica.route('/purchase_stats', methods=['GET'])
+def get_purchase_stats():
+    return jsonify(purchase_pipeline.stats())
+
+# Retention settings and counters of the order archive
+
+
+@app_replica.route('/archive_stats', methods=['GET'])
+def get_archive_stats():
+    return jsonify(order_archiver.stats())
+
+# This server's record of an Idempotency-Key, asked by the other order server
+
+
+@app_replica.route('/idempotency/<string:key>', methods=['GET'])
+def get_idempotency_key(key):
+    return jsonify(idempotency_store.lookup(key))
+
+# Stored keys, replays and conflicts of idempotent purchases
+
+
+@app_replica.route('/idempotency_stats', methods=['GET'])
+def get_idempotency_stats():
+    return jsonify(idempotency_store.stats())
 
 
 # Run the Flask application with SocketIO on host 0.0.0.0 and port 3001 in debug mode
@@ -0,0 +1,206 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+MIGRATION_CHUNK = 1000
+ARCHIVE_CHUNK = 1000
+DEFAULT_ARCHIVE_INTERVAL = 3600
+# Columns of the order table before book_id, unit_price, quantity and purchased_at
+LEGACY_COLUMNS = ('book_data', 'purchase_date', 'count')
+ARCHIVE_COLUMNS = ('id', 'ref', 'book_id', 'unit_price', 'quantity', 'purchased_at')
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({_quote(conn, table)})')}
+
+
+def _legacy_values(book_data, purchase_date, count):
+    """
+    (book_id, unit_price, quantity, purchased_at) of one legacy row.
+    Legacy orders did not record the price, so unit_price is None unless
+    book_data happens to carry one. Raises ValueError when the book id or
+    the purchase date is missing.
+    """
+    if isinstance(book_data, str):
+        book_data = json.loads(book_data)
+    book = (book_data or {}).get('books') or {}
+    if not isinstance(book.get('id'), int):
+        raise ValueError('no book id')
+    if not purchase_date:
+        raise ValueError('no purchase date')
+    purchased_at = datetime.fromisoformat(str(purchase_date)).timestamp()
+    return book['id'], book.get('price'), count or 1, purchased_at
+
+
+def migrate_legacy_orders(engine, table, chunk_size=MIGRATION_CHUNK, log=print):
+    """
+    Fill book_id, unit_price, quantity and purchased_at from the JSON
+    book_data of orders written before those columns existed, then drop
+    the legacy columns. Rows are read and rewritten a chunk at a time, one
+    transaction each, so the table is never loaded in memory and an
+    interrupted migration resumes with the rows still missing book_id.
+    Rows without a readable book id and purchase date are moved as they
+    were to `{table}_legacy` before any column is dropped. unit_price
+    stays NULL for orders whose JSON has no price, which is all of them
+    in the original schema. Returns the number of rows converted.
+    """
+    with engine.begin() as conn:
+        if not set(LEGACY_COLUMNS) & _columns(conn, table):
+            return 0
+        name = _quote(conn, table)
+        legacy = _quote(conn, table + '_legacy')
+        conn.exec_driver_sql(f"""
+            CREATE TABLE IF NOT EXISTS {legacy} (
+                id INTEGER PRIMARY KEY, book_data JSON, purchase_date DATETIME, count INTEGER
+            )""")
+    converted = 0
+    failed = 0
+    after = 0
+    started = time.monotonic()
+    while True:
+        with engine.begin() as conn:
+            rows = conn.exec_driver_sql(
+                f'SELECT id, book_data, purchase_date, count FROM {name} '
+                f'WHERE book_id IS NULL AND id > ? ORDER BY id LIMIT ?', (after, chunk_size)).all()
+            if not rows:
+                break
+            updates = []
+            unreadable = []
+            for row in rows:
+                try:
+                    updates.append(_legacy_values(row[1], row[2], row[3]) + (row[0],))
+                except (TypeError, ValueError, AttributeError):
+                    unreadable.append(tuple(row))
+            if updates:
+                conn.exec_driver_sql(
+                    f'UPDATE {name} SET book_id = ?, unit_price = ?, quantity = ?, purchased_at = ? '
+                    f'WHERE id = ?', updates)
+            if unreadable:
+                conn.exec_driver_sql(f'INSERT OR REPLACE INTO {legacy} VALUES (?, ?, ?, ?)', unreadable)
+                conn.exec_driver_sql(f'DELETE FROM {name} WHERE id = ?', [(row[0],) for row in unreadable])
+            converted += len(updates)
+            failed += len(unreadable)
+            after = rows[-1][0]
+    with engine.begin() as conn:
+        existing = _columns(conn, table)
+        for column in LEGACY_COLUMNS:
+            if column in existing:
+                conn.exec_driver_sql(f'ALTER TABLE {name} DROP COLUMN {_quote(conn, column)}')
+    # Give the space of the JSON blobs back to the file system
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('VACUUM')
+    log(f'Order migration of {table}: {converted} rows converted, {failed} kept in '
+        f'{table}_legacy, in {time.monotonic() - started:.1f}s')
+    return converted
+
+
+def ensure_archive(conn, table):
+    """Create `{table}_archive`: the order columns and no secondary index."""
+    conn.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS {_quote(conn, table + '_archive')} (
+            id INTEGER PRIMARY KEY,
+            ref VARCHAR(32),
+            book_id INTEGER,
+            unit_price FLOAT,
+            quantity INTEGER,
+            purchased_at FLOAT
+        )""")
+
+
+class OrderArchiver:
+    """
+    Moves orders older than `retention_days` from `table` to
+    `{table}_archive` on a background thread, in chunks of `chunk_size`
+    rows, each copied and deleted in one short transaction so purchases
+    are not held up. Keeps the hot table and its indexes small.
+
+    Archiving is opt-in: with retention_days None, start() does nothing,
+    so an upgrade never moves existing orders out of /orders.
+    """
+
+    def __init__(self, engine, table, retention_days=None,
+                 interval=DEFAULT_ARCHIVE_INTERVAL, chunk_size=ARCHIVE_CHUNK):
+        self.engine = engine
+        self.table = table
+        self.retention_days = retention_days
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.archived = 0
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        with engine.begin() as conn:
+            ensure_archive(conn, table)
+            self._name = _quote(conn, table)
+            self._archive = _quote(conn, table + '_archive')
+
+    def archive_once(self, now=None):
+        """Archive every order past retention; returns the number moved."""
+        cutoff = (now or time.time()) - self.retention_days * 86400
+        columns = ', '.join(ARCHIVE_COLUMNS)
+        moved = 0
+        while True:
+            with self.engine.begin() as conn:
+                ids = [row[0] for row in conn.exec_driver_sql(
+                    f'SELECT id FROM {self._name} WHERE purchased_at < ? ORDER BY purchased_at LIMIT ?',
+                    (cutoff, self.chunk_size))]
+                if not ids:
+                    break
+                marks = ', '.join('?' for _ in ids)
+                conn.exec_driver_sql(
+                    f'INSERT OR REPLACE INTO {self._archive} ({columns}) '
+                    f'SELECT {columns} FROM {self._name} WHERE id IN ({marks})', tuple(ids))
+                conn.exec_driver_sql(f'DELETE FROM {self._name} WHERE id IN ({marks})', tuple(ids))
+            moved += len(ids)
+        with self._lock:
+            self.archived += moved
+            self.runs += 1
+            self.last_run = time.time()
+        return moved
+
+    def _run(self):
+        while True:
+            try:
+                self.archive_once()
+            except Exception as exc:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = str(exc)
+            time.sleep(self.interval)
+
+    @property
+    def enabled(self):
+        return self.retention_days is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self.enabled:
+                self._thread = threading.Thread(target=self._run, name='order-archiver', daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'retention_days': self.retention_days,
+                'archived': self.archived,
+                'runs': self.runs,
+                'errors': self.errors,
+                'last_run': self.last_run,
+                'last_error': self.last_error,
+            }
+
+    def collect_metrics(self):
+        """Registry collector exposing the archive counters on /metrics."""
+        stats = self.stats()
+        labels = {'table': self.table}
+        yield 'order_archived_total', 'counter', 'Orders moved to the archive table.', [(labels, stats['archived'])]
+        yield 'order_archive_errors_total', 'counter', 'Archive runs that failed.', [(labels, stats['errors'])]
@@ -0,0 +1,210 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import registry
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_BATCH_SIZE = 128
+DEFAULT_BATCH_WAIT = 0.005
+# Finished orders whose status stays in memory; older ones are read from the database
+DEFAULT_MAX_TRACKED = 100000
+
+BATCH_SIZE = registry.histogram(
+    'order_commit_batch_size', 'Orders written per group commit.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class Job:
+    """One queued purchase and its outcome."""
+
+    __slots__ = ('ref', 'book_id', 'qty', 'status', 'http_status', 'result', 'error',
+                 'order_id', 'created_at', 'finished_at')
+
+    def __init__(self, book_id, qty):
+        self.ref = uuid.uuid4().hex
+        self.book_id = book_id
+        self.qty = qty
+        self.status = 'queued'
+        self.http_status = None
+        self.result = None
+        self.error = None
+        self.order_id = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def as_dict(self):
+        return {
+            'id': self.ref,
+            'status': self.status,
+            'book_id': self.book_id,
+            'qty': self.qty,
+            'order_id': self.order_id,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class PurchasePipeline:
+    """
+    Purchases accepted with 202 and processed off the request path.
+
+    submit() puts a Job on a bounded queue. `workers` threads take jobs and
+    call execute(job), the blocking catalog call, which returns
+    (http status, body). Successful jobs go to a single committer thread
+    that waits up to `batch_wait` for more and hands up to `batch_size` of
+    them to commit(jobs) in one transaction; commit sets job.order_id.
+    publish(jobs) then sends the confirmations of the whole batch.
+    """
+
+    def __init__(self, execute, commit, publish, workers=DEFAULT_WORKERS,
+                 max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_wait=DEFAULT_BATCH_WAIT, max_tracked=DEFAULT_MAX_TRACKED, on_error=None):
+        self.execute = execute
+        self.commit = commit
+        self.publish = publish
+        self.on_error = on_error
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_tracked = max_tracked
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._done = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                self._threads.append(threading.Thread(
+                    target=self._work, name=f'purchase-worker-{number}', daemon=True))
+            self._threads.append(threading.Thread(
+                target=self._commit_batches, name='purchase-committer', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, book_id, qty=1):
+        """Queue a purchase and return its Job; raises queue.Full when the queue is full."""
+        job = Job(book_id, qty)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise
+        with self._lock:
+            self.submitted += 1
+            self._jobs[job.ref] = job
+            while len(self._jobs) > self.max_tracked:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.finished_at is None:
+                    break
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, ref):
+        with self._lock:
+            return self._jobs.get(ref)
+
+    def _finish(self, job, status, http_status, error=None):
+        job.status = status
+        job.http_status = http_status
+        job.error = error
+        job.finished_at = time.time()
+        with self._lock:
+            if status == 'completed':
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = 'processing'
+            try:
+                http_status, body = self.execute(job)
+            except Exception as exc:
+                self._finish(job, 'failed', 502, f'catalog unavailable: {exc}')
+                continue
+            if http_status != 200:
+                self._finish(job, 'failed', http_status, body.get('message') or body.get('error'))
+                continue
+            job.result = body
+            self._done.put(job)
+
+    def _next_batch(self):
+        batch = [self._done.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._done.get(timeout=timeout) if timeout > 0 else self._done.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit_batches(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.commit(batch)
+            except Exception as exc:
+                # The stock is already taken; report it, the order row is lost
+                for job in batch:
+                    self._finish(job, 'failed', 500, f'order could not be saved: {exc}')
+                if self.on_error is not None:
+                    self.on_error(batch, exc)
+                continue
+            for job in batch:
+                self._finish(job, 'completed', 200)
+            with self._lock:
+                self.batches += 1
+                self.last_batch_size = len(batch)
+                self.max_batch_size = max(self.max_batch_size, len(batch))
+            BATCH_SIZE.observe(len(batch))
+            try:
+                self.publish(batch)
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self._queue.qsize(),
+                'awaiting_commit': self._done.qsize(),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+                'mean_batch_size': round(self.completed / self.batches, 2) if self.batches else 0,
+                'batch_limit': self.batch_size,
+            }
+
+    def collect_metrics(self):
+        """Registry collector exposing queue depth and outcomes on /metrics."""
+        stats = self.stats()
+        yield ('order_purchase_queue_depth', 'gauge', 'Purchases waiting for a worker.',
+               [({'stage': 'catalog'}, stats['queued']), ({'stage': 'commit'}, stats['awaiting_commit'])])
+        yield ('order_purchases_total', 'counter', 'Asynchronous purchases by outcome.',
+               [({'outcome': 'completed'}, stats['completed']), ({'outcome': 'failed'}, stats['failed']),
+                ({'outcome': 'rejected'}, stats['rejected'])])
+        yield ('order_commit_batches_total', 'counter', 'Group commits of order rows.',
+               [({}, stats['batches'])])
@@ -0,0 +1,172 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rollup tables by granularity: bucket width in seconds, UTC aligned
+GRANULARITIES = {'hour': 3600, 'day': 86400}
+ORDER_FIELDS = ('id', 'ref', 'book_id', 'unit_price', 'quantity', 'purchased_at')
+
+
+def rollup_table(granularity):
+    return f'sales_{granularity}'
+
+
+def ensure_rollups(conn, table, archive_table=None):
+    """
+    Create the sales_hour and sales_day tables, one row per (bucket, book)
+    with order, unit and revenue totals, and the triggers that add every
+    order inserted into `table` to them in the same transaction. The
+    first time, they are filled from the orders already in `table` and
+    `archive_table`. Archiving deletes orders but never touches the
+    totals. Orders without a unit_price (converted legacy orders) count
+    as units with no revenue.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    sources = [table] + ([archive_table] if archive_table else [])
+    for granularity, seconds in GRANULARITIES.items():
+        rollup = rollup_table(granularity)
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rollup,)).first()
+        conn.exec_driver_sql(f"""
+            CREATE TABLE IF NOT EXISTS {rollup} (
+                bucket INTEGER NOT NULL,
+                book_id INTEGER NOT NULL,
+                orders INTEGER NOT NULL,
+                units INTEGER NOT NULL,
+                revenue FLOAT NOT NULL,
+                PRIMARY KEY (bucket, book_id)
+            ) WITHOUT ROWID""")
+        conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS ix_{rollup}_book ON {rollup} (book_id, bucket)')
+        # Recreated on every start so existing databases get the current body
+        conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {table}_{rollup}')
+        conn.exec_driver_sql(f"""
+            CREATE TRIGGER {table}_{rollup} AFTER INSERT ON {quote(table)}
+            WHEN new.book_id IS NOT NULL AND new.purchased_at IS NOT NULL BEGIN
+                INSERT INTO {rollup} (bucket, book_id, orders, units, revenue)
+                VALUES (CAST(new.purchased_at / {seconds} AS INTEGER) * {seconds}, new.book_id, 1,
+                        new.quantity, new.quantity * COALESCE(new.unit_price, 0))
+                ON CONFLICT (bucket, book_id) DO UPDATE SET
+                    orders = orders + 1, units = units + excluded.units,
+                    revenue = revenue + excluded.revenue;
+            END""")
+        if not exists:
+            union = ' UNION ALL '.join(
+                f'SELECT book_id, quantity, unit_price, purchased_at FROM {quote(source)}' for source in sources)
+            conn.exec_driver_sql(f"""
+                INSERT INTO {rollup} (bucket, book_id, orders, units, revenue)
+                SELECT CAST(purchased_at / {seconds} AS INTEGER) * {seconds}, book_id,
+                       COUNT(*), SUM(quantity), SUM(quantity * COALESCE(unit_price, 0))
+                FROM ({union})
+                WHERE book_id IS NOT NULL AND purchased_at IS NOT NULL
+                GROUP BY 1, 2""")
+
+
+def parse_time(value, name):
+    """Epoch seconds or an ISO 8601 date/time (UTC unless it has an offset)."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be epoch seconds or an ISO 8601 time')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _parse_int(args, name, default=None):
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+
+
+def parse_filters(args):
+    """book_id, since (inclusive), until (exclusive) and limit from the query string."""
+    limit = _parse_int(args, 'limit', DEFAULT_PAGE_SIZE)
+    return {
+        'book_id': _parse_int(args, 'book_id'),
+        'since': parse_time(args.get('since'), 'since'),
+        'until': parse_time(args.get('until'), 'until'),
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+    }
+
+
+def _conditions(filters, time_column):
+    conditions = []
+    params = {}
+    if filters['book_id'] is not None:
+        conditions.append('book_id = :book_id')
+        params['book_id'] = filters['book_id']
+    if filters['since'] is not None:
+        conditions.append(f'{time_column} >= :since')
+        params['since'] = filters['since']
+    if filters['until'] is not None:
+        conditions.append(f'{time_column} < :until')
+        params['until'] = filters['until']
+    return conditions, params
+
+
+def query_orders(session, table, filters, after=0):
+    """
+    One page of orders matching `filters`, oldest first, with id > after.
+    Returns (orders, next_after). The book and time filters use the
+    book_id and purchased_at indexes.
+    """
+    conditions, params = _conditions(filters, 'purchased_at')
+    conditions.append('id > :after')
+    params.update(after=after, limit=filters['limit'] + 1)
+    name = session.get_bind().dialect.identifier_preparer.quote(table)
+    rows = session.execute(text(
+        f"SELECT {', '.join(ORDER_FIELDS)} FROM {name} WHERE {' AND '.join(conditions)} "
+        f'ORDER BY id LIMIT :limit'), params).all()
+    more = len(rows) > filters['limit']
+    rows = rows[:filters['limit']]
+    return [dict(row._mapping) for row in rows], rows[-1].id if more else None
+
+
+def parse_rollup_cursor(value):
+    """'<bucket>:<book_id>' of the last row of the previous page."""
+    if not value:
+        return None
+    try:
+        bucket, book_id = value.split(':')
+        return int(bucket), int(book_id)
+    except ValueError:
+        raise ValueError('after must be <bucket>:<book_id> from next_after')
+
+
+def query_rollups(session, granularity, filters, after=None):
+    """
+    One page of (bucket, book) totals in time order. `since` and `until`
+    select whole buckets by their start. Returns (rows, next_after).
+    """
+    conditions, params = _conditions(filters, 'bucket')
+    if after is not None:
+        conditions.append('(bucket > :after_bucket OR (bucket = :after_bucket AND book_id > :after_book))')
+        params.update(after_bucket=after[0], after_book=after[1])
+    params['limit'] = filters['limit'] + 1
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+    rows = session.execute(text(
+        f'SELECT bucket, book_id, orders, units, revenue FROM {rollup_table(granularity)} '
+        f'{where}ORDER BY bucket, book_id LIMIT :limit'), params).all()
+    more = len(rows) > filters['limit']
+    rows = rows[:filters['limit']]
+    items = [{
+        'bucket': row.bucket,
+        'bucket_start': datetime.fromtimestamp(row.bucket, timezone.utc).isoformat(),
+        'book_id': row.book_id,
+        'orders': row.orders,
+        'units': row.units,
+        'revenue': round(row.revenue, 2),
+    } for row in rows]
+    return items, f'{rows[-1].bucket}:{rows[-1].book_id}' if more else None
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+
+# The order server modules are imported flat, as the services run them.
+# Other services have modules of the same name (metrics, storage, ...), so
+# forget their copies when this directory's tests are collected.
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+for name, module in list(sys.modules.items()):
+    path = os.path.dirname(getattr(module, '__file__', None) or '')
+    if os.path.dirname(path) == os.path.dirname(SERVICE_DIR) and path != SERVICE_DIR:
+        del sys.modules[name]
+
+# Legacy denormalized order table: the whole book as JSON on every row
+LEGACY_SCHEMA = """
+    CREATE TABLE "order" (
+        id INTEGER NOT NULL,
+        book_data JSON NOT NULL,
+        purchase_date DATETIME NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (id)
+    )"""
+CURRENT_COLUMNS = ('ref VARCHAR(32)', 'book_id INTEGER', 'unit_price FLOAT',
+                   'quantity INTEGER', 'purchased_at FLOAT')
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'orders.db'}")
+
+
+@pytest.fixture
+def legacy_engine(engine):
+    """A legacy order table with the new columns added, as ensure_columns leaves it."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql(LEGACY_SCHEMA)
+        for column in CURRENT_COLUMNS:
+            conn.exec_driver_sql(f'ALTER TABLE "order" ADD COLUMN {column}')
+    return engine
+
+
+@pytest.fixture
+def add_legacy_order():
+    def add(engine, book_data, purchase_date='2024-01-03 18:13:28.974441', count=1):
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                'INSERT INTO "order" (book_data, purchase_date, count) VALUES (?, ?, ?)',
+                (book_data, purchase_date, count))
+    return add
@@ -0,0 +1,136 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from flask import Flask, jsonify, make_response
+
+import idempotency
+
+
+@pytest.fixture
+def store(engine):
+    return idempotency.IdempotencyStore(engine, 'order')
+
+
+class FakePeer:
+    """Answers /idempotency/<key> for the store's requests.Session."""
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def get(self, url, timeout):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return SimpleNamespace(raise_for_status=lambda: None, json=lambda: self.answer)
+
+
+def with_peer(store, answer):
+    store.peer_url = 'http://peer'
+    store.http = FakePeer(answer)
+    return store
+
+
+def test_completed_key_is_replayed(store):
+    assert store.begin('k', 'POST /purchase/1 abc') == ('run', None)
+    store.complete('k', 200, '{"order": 1}')
+    assert store.begin('k', 'POST /purchase/1 abc') == ('replay', (200, '{"order": 1}'))
+    assert store.stats()['replays'] == 1
+
+
+def test_pending_key_conflicts_and_other_requests_mismatch(store):
+    store.begin('k', 'POST /purchase/1 abc')
+    assert store.begin('k', 'POST /purchase/1 abc')[0] == 'conflict'
+    assert store.begin('k', 'POST /purchase/2 abc')[0] == 'mismatch'
+
+
+def test_abandoned_key_runs_again(store):
+    store.begin('k', 'f')
+    store.abandon('k')
+    assert store.begin('k', 'f') == ('run', None)
+
+
+def test_expired_key_runs_again(store):
+    store.ttl = 0
+    store.begin('k', 'f')
+    store.complete('k', 200, '{}')
+    assert store.begin('k', 'f') == ('run', None)
+
+
+def test_peer_result_is_replayed_and_kept(store):
+    with_peer(store, {'state': 'done', 'status': 200, 'body': '{"order": 7}', 'fingerprint': 'f'})
+    assert store.begin('k', 'f') == ('replay', (200, '{"order": 7}'))
+    assert store.lookup('k')['state'] == 'done'
+
+
+def test_older_claim_on_the_peer_wins(store):
+    with_peer(store, {'state': 'pending', 'created_at': time.time() - 1, 'node': 'order-replica'})
+    assert store.begin('k', 'f')[0] == 'conflict'
+    # Our claim is dropped so a retry can ask again
+    assert store.lookup('k')['state'] == 'unknown'
+
+
+def test_newer_claim_on_the_peer_loses(store):
+    with_peer(store, {'state': 'pending', 'created_at': time.time() + 60, 'node': 'order-replica'})
+    assert store.begin('k', 'f') == ('run', None)
+
+
+def test_unreachable_peer_makes_the_key_unavailable(store):
+    with_peer(store, requests.exceptions.ReadTimeout('slow'))
+    assert store.begin('k', 'f')[0] == 'unavailable'
+    assert store.lookup('k')['state'] == 'unknown'
+
+
+def test_purge_keeps_the_newest_max_keys(store):
+    store.max_keys = 2
+    for key in ('a', 'b', 'c'):
+        store.begin(key, 'f')
+        store.complete(key, 200, '{}')
+    assert store.purge() == 1
+    assert [store.lookup(key)['state'] for key in ('a', 'b', 'c')] == ['unknown', 'done', 'done']
+
+
+@pytest.fixture
+def client(store):
+    app = Flask(__name__)
+    runs = []
+
+    @app.post('/purchase/<int:id>')
+    @idempotency.idempotent(store)
+    def purchase(id):
+        runs.append(id)
+        if id in (503, 504):
+            return make_response(jsonify({'error': 'catalog trouble'}), id)
+        return jsonify({'order': len(runs)})
+
+    client = app.test_client()
+    client.runs = runs
+    return client
+
+
+def test_decorator_replays_the_stored_answer(client):
+    first = client.post('/purchase/1', headers={'Idempotency-Key': 'k'})
+    again = client.post('/purchase/1', headers={'Idempotency-Key': 'k'})
+    assert first.get_json() == again.get_json() == {'order': 1}
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert client.runs == [1]
+
+
+def test_decorator_rejects_reuse_for_another_request(client):
+    client.post('/purchase/1', headers={'Idempotency-Key': 'k'})
+    assert client.post('/purchase/2', headers={'Idempotency-Key': 'k'}).status_code == 422
+    assert client.post('/purchase/1', headers={'Idempotency-Key': 'a/b'}).status_code == 400
+
+
+def test_decorator_releases_the_key_when_nothing_ran(client):
+    assert client.post('/purchase/503', headers={'Idempotency-Key': 'k'}).status_code == 503
+    assert client.post('/purchase/503', headers={'Idempotency-Key': 'k'}).status_code == 503
+    assert client.runs == [503, 503]
+
+
+def test_decorator_keeps_the_key_when_the_outcome_is_unknown(client):
+    assert client.post('/purchase/504', headers={'Idempotency-Key': 'k'}).status_code == 504
+    again = client.post('/purchase/504', headers={'Idempotency-Key': 'k'})
+    assert again.status_code == 504
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert client.runs == [504]
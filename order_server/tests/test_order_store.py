@@ -0,0 +1,74 @@
+import json
+
+import order_store
+
+
+def columns(engine, table):
+    with engine.connect() as conn:
+        return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table}")')}
+
+
+def rows(engine, sql):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(sql).all()
+
+
+def test_migration_converts_rows_and_drops_legacy_columns(legacy_engine, add_legacy_order):
+    add_legacy_order(legacy_engine, json.dumps({'books': {'count': 6, 'id': 1, 'name': 'test_1'}}))
+    add_legacy_order(legacy_engine, json.dumps({'books': {'id': 2, 'price': 4.5}}), count=3)
+
+    assert order_store.migrate_legacy_orders(legacy_engine, 'order', log=lambda message: None) == 2
+
+    assert not set(order_store.LEGACY_COLUMNS) & columns(legacy_engine, 'order')
+    converted = rows(legacy_engine, 'SELECT book_id, unit_price, quantity, purchased_at FROM "order" ORDER BY id')
+    # The original schema has no price; it stays NULL rather than guessed
+    assert [row[:3] for row in converted] == [(1, None, 1), (2, 4.5, 3)]
+    assert all(row[3] for row in converted)
+
+
+def test_migration_keeps_unparseable_rows_in_legacy_table(legacy_engine, add_legacy_order):
+    add_legacy_order(legacy_engine, json.dumps({'books': {'id': 1, 'name': 'ok'}}))
+    add_legacy_order(legacy_engine, json.dumps({'books': {'name': 'no id'}}))
+    add_legacy_order(legacy_engine, 'not json')
+    add_legacy_order(legacy_engine, json.dumps({'books': {'id': 3}}), purchase_date='yesterday')
+
+    assert order_store.migrate_legacy_orders(legacy_engine, 'order', chunk_size=2, log=lambda message: None) == 1
+
+    assert rows(legacy_engine, 'SELECT book_id FROM "order"') == [(1,)]
+    kept = rows(legacy_engine, 'SELECT id, book_data FROM order_legacy ORDER BY id')
+    assert [row[0] for row in kept] == [2, 3, 4]
+    assert kept[0][1] == json.dumps({'books': {'name': 'no id'}})
+
+
+def test_migration_is_a_no_op_on_the_current_schema(legacy_engine):
+    order_store.migrate_legacy_orders(legacy_engine, 'order', log=lambda message: None)
+    assert order_store.migrate_legacy_orders(legacy_engine, 'order', log=lambda message: None) == 0
+
+
+def add_order(engine, book_id, purchased_at):
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            'INSERT INTO "order" (book_id, unit_price, quantity, purchased_at) VALUES (?, 2.0, 1, ?)',
+            (book_id, purchased_at))
+
+
+def test_archiver_is_off_without_retention(legacy_engine):
+    order_store.migrate_legacy_orders(legacy_engine, 'order', log=lambda message: None)
+    archiver = order_store.OrderArchiver(legacy_engine, 'order')
+    archiver.start()
+    assert archiver._thread is None
+    assert archiver.stats()['enabled'] is False
+
+
+def test_archiver_moves_only_orders_past_retention(legacy_engine):
+    order_store.migrate_legacy_orders(legacy_engine, 'order', log=lambda message: None)
+    now = 1_700_000_000
+    for days_old in (100, 95, 10):
+        add_order(legacy_engine, 1, now - days_old * 86400)
+    archiver = order_store.OrderArchiver(legacy_engine, 'order', retention_days=90, chunk_size=1)
+
+    assert archiver.archive_once(now=now) == 2
+
+    assert rows(legacy_engine, 'SELECT COUNT(*) FROM "order"') == [(1,)]
+    assert rows(legacy_engine, 'SELECT COUNT(*) FROM order_archive') == [(2,)]
+    assert archiver.stats()['archived'] == 2